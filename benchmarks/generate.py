@@ -0,0 +1,145 @@
+"""Synthetic consolidated synapse files, for benchmarks.
+
+Synapses follow the schema of the FAFB consolidators (``skid``,
+``flywire_id``, ``connector_id``, ``x``, ``y``, ``z``, ``hemilineage``,
+``lineage``, ``compartment``, ``region``, ``neurotransmitter``) with
+realistic skews: skeleton sizes are heavy tailed, each skeleton has a single
+neurotransmitter (drawn with the skew below) and hemilineage, regions are
+Zipf distributed, and a fraction of synapses is repeated, either identically
+or with conflicting content.
+"""
+from synapse_io import write_synapses
+import argparse
+import numpy as np
+
+# relative frequencies, roughly as in FAFB
+NEUROTRANSMITTER_WEIGHTS = {
+    'acetylcholine': 0.55,
+    'gaba': 0.2,
+    'glutamate': 0.17,
+    'dopamine': 0.04,
+    'serotonin': 0.025,
+    'octopamine': 0.015,
+}
+
+# size of FAFB in nm (zyx)
+EXTENT = (280000, 320000, 1000000)
+
+
+def zipf_choice(random, num_values, size, exponent=1.2):
+
+    weights = 1.0 / np.arange(1, num_values + 1)**exponent
+    return random.choice(num_values, size=size, p=weights / weights.sum())
+
+
+def generate_synapses(
+        num_synapses,
+        seed=42,
+        synapses_per_skeleton=200,
+        num_hemi_lineages=150,
+        num_regions=80,
+        duplicate_rate=0.01,
+        conflicting_rate=0.2):
+    """Create ``num_synapses`` synapses as a dict of columns.
+
+    ``duplicate_rate`` is the fraction of synapses that repeat the ID of
+    another one, ``conflicting_rate`` the fraction of those that differ in
+    content.
+    """
+
+    random = np.random.RandomState(seed)
+
+    num_duplicates = int(num_synapses * duplicate_rate)
+    num_unique = num_synapses - num_duplicates
+
+    # heavy tailed skeleton sizes
+    num_skeletons = max(1, num_unique // synapses_per_skeleton)
+    sizes = random.lognormal(mean=0.0, sigma=1.5, size=num_skeletons)
+    skeleton_of = random.choice(
+        num_skeletons,
+        size=num_unique,
+        p=sizes / sizes.sum())
+
+    neurotransmitters = np.array(list(NEUROTRANSMITTER_WEIGHTS.keys()))
+    weights = np.array(list(NEUROTRANSMITTER_WEIGHTS.values()))
+    skeleton_nts = random.choice(
+        len(neurotransmitters),
+        size=num_skeletons,
+        p=weights / weights.sum())
+    skeleton_hemi_lineages = zipf_choice(
+        random,
+        num_hemi_lineages,
+        num_skeletons,
+        exponent=0.8)
+    skeleton_ids = random.permutation(np.unique(random.randint(
+        1,
+        np.iinfo(np.int32).max,
+        size=2 * num_skeletons,
+        dtype=np.int64))[:num_skeletons])
+
+    # skeletons are spatially clustered around a center each
+    centers = random.uniform(0, 1, size=(num_skeletons, 3)) * EXTENT
+    positions = centers[skeleton_of] + random.normal(
+        scale=20000,
+        size=(num_unique, 3))
+    positions = np.clip(positions, 0, np.array(EXTENT) - 1)
+    # z in sections of 40nm, as in the source data
+    positions[:, 0] = np.floor(positions[:, 0] / 40) * 40
+
+    connector_ids = random.randint(
+        1,
+        2**62,
+        size=num_unique,
+        dtype=np.int64)
+    regions = zipf_choice(random, num_regions, num_unique)
+
+    # repeat some synapses, changing the region of the conflicting ones
+    repeated = random.randint(0, num_unique, size=num_duplicates)
+    order = np.concatenate([np.arange(num_unique), repeated])
+    random.shuffle(order)
+
+    skeletons = skeleton_of[order]
+    synapse_regions = regions[order]
+    _, first = np.unique(order, return_index=True)
+    duplicate = np.ones(len(order), dtype=bool)
+    duplicate[first] = False
+    change = duplicate & (random.uniform(size=len(order)) < conflicting_rate)
+    synapse_regions = np.where(
+        change,
+        (synapse_regions + 1) % num_regions,
+        synapse_regions)
+
+    hemi_lineage_names = np.array([f'HL{i:03d}' for i in range(num_hemi_lineages)])
+    region_names = np.array([f'R{i:02d}' for i in range(num_regions)])
+
+    return {
+        'skid': skeleton_ids[skeletons],
+        'flywire_id': np.full(len(order), None, dtype=object),
+        'connector_id': connector_ids[order],
+        'x': positions[order, 2],
+        'y': positions[order, 1],
+        'z': positions[order, 0],
+        'hemilineage': hemi_lineage_names[skeleton_hemi_lineages[skeletons]].astype(object),
+        'lineage': np.full(len(order), None, dtype=object),
+        'compartment': np.full(len(order), None, dtype=object),
+        'region': region_names[synapse_regions].astype(object),
+        'neurotransmitter': neurotransmitters[skeleton_nts[skeletons]].astype(object),
+    }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic consolidated synapse file")
+    parser.add_argument('num_synapses', type=int)
+    parser.add_argument('output', help="Output file (.npz or JSON)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--duplicate-rate', type=float, default=0.01)
+    args = parser.parse_args()
+
+    synapses = generate_synapses(
+        args.num_synapses,
+        seed=args.seed,
+        duplicate_rate=args.duplicate_rate)
+    write_synapses(synapses, args.output)
+    print(f"Wrote {args.num_synapses} synapses to {args.output}")
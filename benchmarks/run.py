@@ -0,0 +1,232 @@
+"""Benchmark of the ingest and split pipeline on synthetic data.
+
+For each requested size, a synthetic consolidated synapse file is generated
+(see ``generate.py``) and run through ``ingest.py`` (read, deduplicate,
+write to the DB, compute splits, write splits) and the loading of
+``dataset_comparison.py``. Each stage records its wall time, CPU time,
+throughput and peak resident memory (see ``instrumentation.py``), including
+the stages recorded within ``ingest.py``. The database is an in-memory
+``mongomock`` stand-in by default, or any MongoDB given with
+``--mongo-uri``. ``mongomock`` evaluates queries by scanning all documents,
+DB stages (in particular ``write_splits``) are therefore not representative
+with it beyond ~10^5 synapses.
+
+Usage::
+
+    python -m benchmarks.run 100000 1000000 --output report.json
+
+(from the repository root).
+"""
+from benchmarks.generate import generate_synapses
+from dataset_comparison import datasets_to_dataframe, load_datasets
+from ingest import (
+    create_split_lookups,
+    create_synapse_split,
+    ingest_synapses,
+    read_synapses)
+from instrumentation import stage
+from synapse_io import write_synapses
+from synister import SynisterDb
+from synister_datasets import DATASETS
+from synister_mongo import BulkWriter
+import argparse
+import contextlib
+import datetime
+import instrumentation
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import tempfile
+
+DB_NAME = 'synister_benchmark'
+
+
+def synister_templates():
+    """A ``SynisterDb`` for its document templates, as used by
+    ``ingest_synapses``. Nothing is written through it, its client never
+    connects."""
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        credentials = os.path.join(tmp_dir, 'credentials.ini')
+        with open(credentials, 'w') as f:
+            f.write(
+                "[Credentials]\n"
+                "user = benchmark\n"
+                "password = benchmark\n"
+                "host = localhost\n"
+                "port = 27017\n")
+        return SynisterDb(credentials, DB_NAME)
+
+
+@contextlib.contextmanager
+def benchmark_stage(name, items=None, verbose=False):
+
+    with stage(name, items) as current:
+        if verbose:
+            yield current
+        else:
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                yield current
+
+    throughput = (
+        current.items / current.wall_time
+        if current.items and current.wall_time > 0 else None)
+    print(
+        f"  {name:<36} {current.wall_time:9.3f}s "
+        f"{current.peak_rss / 2**20:9.1f} MB" +
+        (f" {throughput:12.0f} items/s" if throughput else ""))
+
+
+def get_client(mongo_uri):
+
+    if mongo_uri is None:
+        import mongomock
+        return mongomock.MongoClient()
+
+    from pymongo import MongoClient
+    return MongoClient(mongo_uri)
+
+
+def run(num_synapses, client, args):
+
+    print(f"Benchmarking {num_synapses} synapses...")
+    instrumentation.reset()
+
+    def timed(name, items=None):
+        return benchmark_stage(name, items, args.verbose)
+
+    client.drop_database(DB_NAME)
+    database = client[DB_NAME]
+    writer = BulkWriter(database, args.chunk_size, args.num_workers)
+    templates = synister_templates()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        filename = os.path.join(tmp_dir, 'synapses.npz')
+        with timed('generate', num_synapses):
+            write_synapses(
+                generate_synapses(num_synapses, seed=args.seed),
+                filename)
+
+        with timed('read_synapses', num_synapses):
+            synapses = read_synapses(
+                [filename],
+                DATASETS['fafb']['voxel_size'])
+
+    with timed('ingest_synapses', len(synapses)):
+        writer.drop_indexes()
+        ingest_synapses(synapses, templates, writer)
+
+    with timed('create_indexes'):
+        writer.create_indexes()
+
+    splits = {}
+    for split_name, split_attribute in [
+            ('skeleton', 'skeleton_id'),
+            ('brain_region', 'brain_region')]:
+
+        with timed(f'split_lookups:{split_attribute}', len(synapses)):
+            lookups = create_split_lookups(synapses, split_attribute)
+
+        with timed(f'create_synapse_split:{split_name}', len(synapses)):
+            splits[split_name] = create_synapse_split(
+                lookups,
+                split_attribute,
+                split_name,
+                test_fraction=0.2,
+                validation_fraction=0.2)
+        del lookups
+
+    splits = {
+        split_name: split
+        for split_name, split in splits.items()
+        if split is not None
+    }
+    with timed('write_splits', len(synapses)):
+        writer.write_splits(splits)
+    del synapses
+
+    with timed('load_datasets'):
+        records = load_datasets(None, [DB_NAME], client=client)
+
+    num_records = len(records[DB_NAME]['synapses'])
+    with timed('datasets_to_dataframe', num_records):
+        datasets_to_dataframe(records)
+    del records
+
+    client.drop_database(DB_NAME)
+
+    return {
+        'num_synapses': num_synapses,
+        'stages': instrumentation.results()
+    }
+
+
+def environment():
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'date': datetime.datetime.now().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ingest and split pipeline on synthetic "
+                    "data")
+    parser.add_argument(
+        'sizes',
+        type=int,
+        nargs='*',
+        default=[100000],
+        help="Numbers of synapses to benchmark")
+    parser.add_argument(
+        '--mongo-uri',
+        help="MongoDB to use instead of the in-memory mongomock stand-in "
+             "(recommended for more than a few million synapses)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--num-workers', type=int, default=4)
+    parser.add_argument(
+        '--output',
+        default='benchmark_report.json',
+        help="JSON report to write")
+    parser.add_argument(
+        '--profile',
+        help="Profile each stage with cProfile, and write the profiles to "
+             "this directory")
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help="Show the output of the benchmarked stages")
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        instrumentation.enable_profiling(args.profile)
+
+    client = get_client(args.mongo_uri)
+    report = {
+        'environment': environment(),
+        'database': 'mongomock' if args.mongo_uri is None else 'mongodb',
+        'runs': [run(size, client, args) for size in args.sizes]
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote report to {args.output}")
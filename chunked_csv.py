@@ -0,0 +1,86 @@
+"""Parallel parsing of large CSV files.
+
+The file is split into chunks of whole lines, which are parsed independently
+in worker processes. Quoted values must not contain line breaks.
+
+Usage::
+
+    def parse_chunk(text, columns, **kwargs):
+        # parse the lines in `text`, with header `columns`
+        ...
+
+    results = parse_chunks(filename, parse_chunk, num_workers, **kwargs)
+
+``results`` holds the return values of ``parse_chunk`` in file order, such
+that row-order dependent logic can be applied after merging them.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import functools
+import os
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024  # bytes
+
+
+def line_chunks(filename, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Split ``filename`` into chunks of about ``chunk_size`` bytes.
+
+    Returns the header columns and a list of ``(begin, end)`` byte offsets,
+    all at line boundaries.
+    """
+
+    size = os.path.getsize(filename)
+
+    with open(filename, 'rb') as f:
+
+        header = f.readline()
+        columns = next(csv.reader([header.decode('utf-8-sig')]))
+
+        chunks = []
+        begin = f.tell()
+        while begin < size:
+            f.seek(min(begin + chunk_size, size))
+            f.readline()  # continue to the end of the current line
+            end = min(f.tell(), size)
+            chunks.append((begin, end))
+            begin = end
+
+    return columns, chunks
+
+
+def read_chunk(filename, begin, end):
+
+    with open(filename, 'rb') as f:
+        f.seek(begin)
+        return f.read(end - begin).decode('utf-8')
+
+
+def parse_chunk_of(filename, parse_chunk, columns, kwargs, chunk):
+
+    begin, end = chunk
+    return parse_chunk(read_chunk(filename, begin, end), columns, **kwargs)
+
+
+def parse_chunks(
+        filename,
+        parse_chunk,
+        num_workers=None,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        **kwargs):
+    """Call ``parse_chunk(text, columns, **kwargs)`` on all chunks of
+    ``filename``, in ``num_workers`` processes (or in this process, if
+    ``num_workers`` is 1). Returns the results in file order."""
+
+    columns, chunks = line_chunks(filename, chunk_size)
+    parse = functools.partial(
+        parse_chunk_of,
+        filename,
+        parse_chunk,
+        columns,
+        kwargs)
+
+    if num_workers == 1 or len(chunks) <= 1:
+        return [parse(chunk) for chunk in chunks]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as pool:
+        return list(pool.map(parse, chunks))
@@ -1,13 +1,27 @@
 from collections import defaultdict
-from synister import SynisterDb
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from synister_mongo import LAST_MODIFIED, META_COLLECTION, get_client
 import argparse
+import glob
+import hashlib
+import json
 import matplotlib.pyplot as plt
+import os
 import pandas as pd
 
 
 ALL_SPLITS = ["brain_region", "synapse", "skeleton", "hemi_lineage", "known"]
 
 
+def count(dataframe, by):
+    # Aggregated dataframes (see `aggregate_datasets`) have one row per group
+    # with a `count` column, otherwise each row is a synapse.
+    groups = dataframe.groupby(by, observed=True)
+    if "count" in dataframe.columns:
+        return groups["count"].sum()
+    return groups.size()
+
+
 def plot_comparison(
     dataframe,
     splits,
@@ -31,7 +45,7 @@ def plot_comparison(
 
     # Top-left plot is raw NT counts for each dataset.
     nt_ax = axs.flat[0]
-    nt_counts = dataframe.groupby(["dataset", "nt"]).size()
+    nt_counts = count(dataframe, ["dataset", "nt"])
     nt_counts.unstack(0).plot(kind="bar", ax=nt_ax)
     nt_ax.legend().set_visible(False)
     nt_ax.set(xlabel=None, xticks=[])
@@ -55,8 +69,8 @@ def plot_comparison(
             df = dataframe[dataframe[split_col].notna()]
 
         ds_n_nt = defaultdict(lambda: 0)
-        for dataset, dfset in df.groupby(["dataset"]):
-            nt_counts = dfset.groupby([split_col, "nt"]).size()
+        for dataset, dfset in df.groupby(["dataset"], observed=True):
+            nt_counts = count(dfset, [split_col, "nt"])
             nt_counts = nt_counts.unstack()
             nts = sorted(list(nt_counts.columns))
             ds_n_nt[dataset] = nt_counts.shape[1]
@@ -103,55 +117,270 @@ def plot_comparison(
     return fig
 
 
-def load_datasets(credentials, db_names):
-    dbs = {db_name: SynisterDb(credentials, db_name) for db_name in db_names}
+# fields needed for the comparison, per collection
+FIELDS = {
+    "skeletons": ("skeleton_id", ["nt_known"]),
+    "synapses": ("synapse_id", ["skeleton_id", "splits"]),
+}
+
+
+def fetch(database, collection):
+    key, fields = FIELDS[collection]
+    projection = {"_id": False, key: True, **{field: True for field in fields}}
+    return {
+        document[key]: document
+        for document in database[collection].find({}, projection)
+    }
+
+
+def run_concurrently(jobs, num_workers=None):
+    # `jobs` maps names to (function, args), returns a dict of results.
+    # All jobs share the connection pool of the client passed in `args`.
+    if num_workers is None:
+        num_workers = len(jobs)
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as pool:
+        futures = {
+            pool.submit(function, *args): name
+            for name, (function, args) in jobs.items()
+        }
+        for i, future in enumerate(as_completed(futures)):
+            name = futures[future]
+            results[name] = future.result()
+            print(f"Loaded {name} ({i + 1}/{len(futures)})")
+    return results
+
+
+def load_datasets(credentials, db_names, num_workers=None, client=None):
+    if client is None:
+        client = get_client(credentials)
+
+    jobs = {
+        f"{db_name}.{collection}": (fetch, (client[db_name], collection))
+        for db_name in db_names
+        for collection in FIELDS.keys()
+    }
+    results = run_concurrently(jobs, num_workers)
 
     records = {
-        name: {
-            "skeletons": db.get_skeletons(),
-            "synapses": db.get_synapses(),  # No need to fetch splits, as this will fetch the union set.
+        db_name: {
+            collection: results[f"{db_name}.{collection}"]
+            for collection in FIELDS.keys()
         }
-        for name, db in dbs.items()
+        for db_name in db_names
     }
 
     return records
 
 
+def aggregate_dataset(database, name, splits):
+    # Count synapses per (NT, partitions) on the server. Synapses are first
+    # grouped by skeleton, such that the skeleton NT is looked up once per
+    # skeleton instead of once per synapse.
+    partitions = {f"split_{split}": f"$splits.{split}" for split in splits}
+    regrouped = {column: f"$_id.{column}" for column in partitions}
+
+    groups = database["synapses"].aggregate(
+        [
+            {"$match": {"skeleton_id": {"$ne": None}}},
+            {
+                "$group": {
+                    "_id": {"skeleton_id": "$skeleton_id", **partitions},
+                    "count": {"$sum": 1},
+                }
+            },
+            {
+                "$lookup": {
+                    "from": "skeletons",
+                    "localField": "_id.skeleton_id",
+                    "foreignField": "skeleton_id",
+                    "as": "skeleton",
+                }
+            },
+            {
+                "$group": {
+                    "_id": {
+                        # first NT of the (first) skeleton, null if unknown
+                        "nt": {
+                            "$arrayElemAt": [
+                                {
+                                    "$ifNull": [
+                                        {"$arrayElemAt": ["$skeleton.nt_known", 0]},
+                                        [None],
+                                    ]
+                                },
+                                0,
+                            ]
+                        },
+                        **regrouped,
+                    },
+                    "count": {"$sum": "$count"},
+                }
+            },
+        ],
+        allowDiskUse=True,
+    )
+
+    keys = ["nt"] + list(partitions.keys())
+    counts = pd.DataFrame.from_records(
+        [
+            {**{key: group["_id"].get(key) for key in keys}, "count": group["count"]}
+            for group in groups
+        ],
+        columns=keys + ["count"],
+    )
+    counts.insert(0, "dataset", name)
+    return counts
+
+
+def aggregate_datasets(credentials, db_names, splits, num_workers=None, client=None):
+    if client is None:
+        client = get_client(credentials)
+
+    jobs = {
+        db_name: (aggregate_dataset, (client[db_name], db_name, splits))
+        for db_name in db_names
+    }
+    return run_concurrently(jobs, num_workers)
+
+
+def dataset_to_dataframe(name, dataset, drop_missing_skids=True):
+    # Only the columns needed for the comparison are kept: `skeleton_id`,
+    # `dataset`, `nt` and one `split_<name>` column per split.
+    nt_by_skeleton = pd.Series(
+        {
+            skeleton_id: skeleton["nt_known"][0]
+            if skeleton["nt_known"] is not None
+            else None
+            for skeleton_id, skeleton in dataset["skeletons"].items()
+            if skeleton_id is not None  # get rid of errant `None` skeleton IDs
+        },
+        dtype=object,
+    )
+
+    synapses = dataset["synapses"].values()
+    syn_df = pd.DataFrame(
+        {"skeleton_id": [synapse["skeleton_id"] for synapse in synapses]},
+        index=pd.Index(list(dataset["synapses"].keys()), name="synapse_id"),
+    )
+    if drop_missing_skids:
+        syn_df = syn_df[syn_df["skeleton_id"].notna()].astype({"skeleton_id": "int64"})
+        nt_by_skeleton.index = nt_by_skeleton.index.astype("int64")
+
+    syn_df["dataset"] = name
+    syn_df["nt"] = syn_df["skeleton_id"].map(nt_by_skeleton)
+
+    # Expand the `splits` dicts into one column per split.
+    splits = pd.DataFrame.from_records(
+        [
+            dataset["synapses"][synapse_id].get("splits") or {}
+            for synapse_id in syn_df.index
+        ],
+        index=syn_df.index,
+    ).add_prefix("split_")
+
+    syn_df = pd.concat([syn_df, splits], axis=1)
+    categorical = ["dataset", "nt"] + list(splits.columns)
+    return syn_df.astype({column: "category" for column in categorical})
+
+
 def datasets_to_dataframe(datasets, drop_missing_skids=True):
-    dataframe = None
-    for name, dataset in datasets.items():
-        skel_df = pd.DataFrame.from_dict(dataset["skeletons"], orient="index")
-        skel_df = skel_df.loc[
-            skel_df.index.dropna()
-        ]  # Must `dropna` to get rid of errant `None` skeleton IDs
-        skel_df.index = skel_df.index.astype("int64")
-        syn_df = pd.DataFrame.from_dict(dataset["synapses"], orient="index")
-        syn_df["dataset"] = name
-
-        if drop_missing_skids:
-            syn_df = syn_df[syn_df["skeleton_id"].notna()]
-        syn_df["nt"] = (
-            skel_df.loc[syn_df["skeleton_id"], "nt_known"]
-            .map(lambda x: x[0] if x is not None else None)
-            .values
-        )
-
-        syn_df = pd.concat(
-            [
-                syn_df,
-                pd.DataFrame(
-                    syn_df["splits"].values.tolist(), index=syn_df.index
-                ).add_prefix("split_"),
-            ],
-            axis=1,
-        )
-
-        if dataframe is None:
-            dataframe = syn_df
+    return concat_dataframes(
+        [
+            dataset_to_dataframe(name, dataset, drop_missing_skids)
+            for name, dataset in datasets.items()
+        ]
+    )
+
+
+def concat_dataframes(frames):
+    # Categories differ between datasets, concatenating would fall back to
+    # `object` columns.
+    dataframe = pd.concat(frames)
+    categorical = [
+        column
+        for column in dataframe.columns
+        if column == "dataset" or column == "nt" or column.startswith("split_")
+    ]
+    return dataframe.astype({column: "category" for column in categorical})
+
+
+def dataset_version(database):
+    # Changes with every write through `synister_mongo.BulkWriter`. For
+    # databases written otherwise, document counts and the newest `_id` still
+    # catch added or removed documents.
+    version = {
+        collection: {
+            "count": database[collection].estimated_document_count(),
+            "newest": database[collection].find_one(
+                {}, {"_id": True}, sort=[("_id", -1)]
+            ),
+        }
+        for collection in FIELDS.keys()
+    }
+    version["last_modified"] = database[META_COLLECTION].find_one(
+        {"_id": LAST_MODIFIED}
+    )
+    return hashlib.blake2b(
+        json.dumps(version, sort_keys=True, default=str).encode(), digest_size=16
+    ).hexdigest()
+
+
+def cache_filename(cache_dir, db_name, kind, version):
+    return os.path.join(cache_dir, f"{db_name}.{kind}.{version}.pkl")
+
+
+def read_cache(cache_dir, db_name, kind, version):
+    filename = cache_filename(cache_dir, db_name, kind, version)
+    if not os.path.exists(filename):
+        return None
+    return pd.read_pickle(filename)
+
+
+def write_cache(cache_dir, db_name, kind, version, dataframe):
+    os.makedirs(cache_dir, exist_ok=True)
+    filename = cache_filename(cache_dir, db_name, kind, version)
+    for stale in glob.glob(cache_filename(cache_dir, db_name, kind, "*")):
+        os.remove(stale)
+    dataframe.to_pickle(filename + ".tmp")
+    os.replace(filename + ".tmp", filename)
+
+
+def load_dataframe(
+    credentials, db_names, splits, aggregate=False, cache_dir=None, num_workers=None
+):
+    client = get_client(credentials)
+
+    frames = {}
+    if cache_dir is not None:
+        kind = f"aggregate-{'-'.join(splits)}" if aggregate else "synapses"
+        versions = {
+            db_name: dataset_version(client[db_name]) for db_name in db_names
+        }
+        for db_name in db_names:
+            frame = read_cache(cache_dir, db_name, kind, versions[db_name])
+            if frame is not None:
+                print(f"Using cached {kind} of {db_name}")
+                frames[db_name] = frame
+
+    missing = [db_name for db_name in db_names if db_name not in frames]
+    if missing:
+        if aggregate:
+            loaded = aggregate_datasets(
+                credentials, missing, splits, num_workers, client=client
+            )
         else:
-            dataframe = dataframe.append(syn_df)
+            records = load_datasets(credentials, missing, num_workers, client=client)
+            loaded = {
+                db_name: dataset_to_dataframe(db_name, records.pop(db_name))
+                for db_name in missing
+            }
+        for db_name, frame in loaded.items():
+            if cache_dir is not None:
+                write_cache(cache_dir, db_name, kind, versions[db_name], frame)
+            frames[db_name] = frame
 
-    return dataframe
+    return concat_dataframes([frames[db_name] for db_name in db_names])
 
 
 if __name__ == "__main__":
@@ -173,12 +402,40 @@ if __name__ == "__main__":
         help="Comma-separated list of split names to analyze",
     )
 
+    parser.add_argument(
+        "--aggregate",
+        "-a",
+        action="store_true",
+        help="Count synapses in MongoDB instead of fetching all of them",
+    )
+
+    parser.add_argument(
+        "--num-workers",
+        "-n",
+        type=int,
+        default=None,
+        help="Number of concurrent queries (default: all at once)",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Directory to cache query results in, reused until a database changes",
+    )
+
     args = parser.parse_args()
 
-    records = load_datasets(args.credentials, args.dataset_databases)
-    dataframe = datasets_to_dataframe(records)
+    dataframe = load_dataframe(
+        args.credentials,
+        args.dataset_databases,
+        args.splits,
+        aggregate=args.aggregate,
+        cache_dir=args.cache_dir,
+        num_workers=args.num_workers,
+    )
 
-    fig = plot_comparison(records, args.splits)
+    fig = plot_comparison(dataframe, args.splits)
 
-    filename = f"{'_'.join(args.dataset_databases.join)}_{'_'.join(args.splits)}.svg"
+    filename = f"{'_'.join(args.dataset_databases)}_{'_'.join(args.splits)}.svg"
     fig.savefig(filename)
@@ -0,0 +1,190 @@
+"""Aggregated diagnostics of skipped and rejected records.
+
+Instead of printing every skipped record, events are counted per type, and
+a bounded random sample of their details is kept (reservoir sampling)::
+
+    import diagnostics
+
+    diagnostics.record(diagnostics.FILTERED_NT, synapse)
+
+    # many events at once, details are only created for sampled events
+    diagnostics.record_many(
+        diagnostics.SKIPPED_SKELETON,
+        len(skids),
+        lambda i: {'skid': skids[i]})
+
+    diagnostics.print_summary()
+    diagnostics.write_report('diagnostics.json')
+
+Full detail is available on request: with ``enable_detail(filename)``,
+every event is also written to ``filename`` as one JSON line.
+"""
+import json
+import numpy as np
+import random
+
+FILTERED_NT = 'filtered_nt'
+SKIPPED_SKELETON = 'skipped_skeleton'
+BAD_COORDINATES = 'bad_coordinates'
+DUPLICATE = 'duplicate'
+CONFLICTING_DUPLICATE = 'conflicting_duplicate'
+
+DESCRIPTIONS = {
+    FILTERED_NT: "synapses skipped for a filtered neurotransmitter",
+    SKIPPED_SKELETON: "skeletons skipped",
+    BAD_COORDINATES: "synapses skipped for invalid coordinates",
+    DUPLICATE: "identical duplicate synapse IDs, deduplicated",
+    CONFLICTING_DUPLICATE: "conflicting duplicate synapse IDs, removed",
+}
+
+DEFAULT_SAMPLE_SIZE = 10
+
+
+def to_json(value):
+
+    # numpy scalars (e.g., IDs from arrays) as plain numbers
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+class Diagnostics:
+    """Counts and samples of events, see the module documentation."""
+
+    def __init__(self, sample_size=DEFAULT_SAMPLE_SIZE, seed=1912):
+
+        self.sample_size = sample_size
+        self.seed = seed
+        self.detail_file = None
+        self.reset()
+
+    def reset(self):
+
+        if self.detail_file is not None:
+            self.detail_file.close()
+            self.detail_file = None
+        self.counts = {}
+        self.samples = {}
+        self.random = random.Random(self.seed)
+
+    def enable_detail(self, filename):
+
+        if self.detail_file is not None:
+            self.detail_file.close()
+        self.detail_file = open(filename, 'w')
+
+    def record(self, kind, detail):
+
+        seen = self.counts.get(kind, 0)
+        self.counts[kind] = seen + 1
+        sample = self.samples.setdefault(kind, [])
+
+        if seen < self.sample_size:
+            sample.append(detail)
+        else:
+            i = self.random.randrange(seen + 1)
+            if i < self.sample_size:
+                sample[i] = detail
+
+        if self.detail_file is not None:
+            self.write_detail(kind, detail)
+
+    def record_many(self, kind, num, detail):
+        """Record ``num`` events of ``kind``, ``detail(i)`` returns the
+        details of the ``i``-th event and is only called for sampled events
+        (unless all details are written)."""
+
+        if num == 0:
+            return
+
+        seen = self.counts.get(kind, 0)
+        self.counts[kind] = seen + num
+        sample = self.samples.setdefault(kind, [])
+
+        # the same as record() for each event, but only looking at the
+        # events that replace an entry of the sample
+        positions = np.arange(seen, seen + num)
+        random_state = np.random.RandomState(self.random.randrange(2**32))
+        slots = np.floor(
+            random_state.random_sample(num) * (positions + 1)).astype(np.int64)
+        slots[positions < self.sample_size] = positions[
+            positions < self.sample_size]
+        for i in np.flatnonzero(slots < self.sample_size).tolist():
+            if slots[i] == len(sample):
+                sample.append(detail(i))
+            else:
+                sample[slots[i]] = detail(i)
+
+        if self.detail_file is not None:
+            for i in range(num):
+                self.write_detail(kind, detail(i))
+
+    def write_detail(self, kind, detail):
+
+        self.detail_file.write(
+            json.dumps({'event': kind, 'detail': detail}, default=to_json))
+        self.detail_file.write('\n')
+
+    def report(self):
+
+        if self.detail_file is not None:
+            self.detail_file.flush()
+
+        return {
+            kind: {
+                'description': DESCRIPTIONS.get(kind, kind),
+                'count': count,
+                'samples': self.samples[kind]
+            }
+            for kind, count in self.counts.items()
+        }
+
+    def summary(self, num_samples=3):
+
+        lines = []
+        for kind, count in self.counts.items():
+            lines.append(f"{count} {DESCRIPTIONS.get(kind, kind)}, e.g.:")
+            for detail in self.samples[kind][:num_samples]:
+                lines.append(f"\t{json.dumps(detail, default=to_json)}")
+        if self.detail_file is not None:
+            lines.append(f"All events are listed in {self.detail_file.name}")
+        return lines
+
+
+events = Diagnostics()
+
+
+def record(kind, detail):
+    events.record(kind, detail)
+
+
+def record_many(kind, num, detail):
+    events.record_many(kind, num, detail)
+
+
+def reset():
+    events.reset()
+
+
+def enable_detail(filename):
+    events.enable_detail(filename)
+
+
+def counts():
+    return events.counts
+
+
+def report():
+    return events.report()
+
+
+def print_summary(num_samples=3):
+    for line in events.summary(num_samples):
+        print(line)
+
+
+def write_report(filename):
+
+    with open(filename, 'w') as f:
+        json.dump(report(), f, indent=2, default=to_json)
+    print(f"Wrote diagnostics to {filename}")
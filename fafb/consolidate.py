@@ -1,6 +1,21 @@
-from csv import DictReader
-import json
+"""Consolidate the FAFB synapse CSVs.
+
+Run from the repository root as ``python -m fafb.consolidate``, paths below
+are relative to this directory.
+"""
+from chunked_csv import parse_chunks
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from spatial_index import write_index
+from synapse_io import write_synapses
+from synister_datasets import DATASETS
+import argparse
+import contextlib
+import diagnostics
+import io
+import numpy as np
 import os
+import pandas as pd
 
 out_path = "consolidated/2021-12-08"
 files = {
@@ -27,161 +42,415 @@ files = {
     },
 }
 
+NEUROTRANSMITTERS = [
+    'gaba',
+    'acetylcholine',
+    'glutamate',
+    'octopamine',
+    'serotonin',
+    'dopamine']
+
+# all columns read_csv might use, everything else is not loaded
+COLUMNS = {
+    'skid',
+    'flywire.id',
+    'known.classic.transmitter',
+    'known.other.transmitter',
+    'putative.classic.transmitter',
+    'transmitter',
+    'known.neurotransmitter',
+    'neurotransmitter.verified',
+    'ItoLee.Hemilineage',
+    'ItoLee.Lineage',
+    'compartment',
+    'connector_id',
+    'inside',
+    'x',
+    'y',
+    'z',
+}
+
+
+def known(column, unknown=('unknown',)):
+    return column.where(~column.isin(unknown))
+
+
+def to_int64(column):
+
+    # parse via Python int, going through float would lose precision of the
+    # 64-bit IDs
+    return pd.Series(
+        column.to_numpy(dtype=object).astype(np.int64),
+        index=column.index)
+
+
+def to_int64_or_missing(column):
+
+    # like to_int64, values int() can't parse are returned as missing, with
+    # a mask of them
+    try:
+        return to_int64(column), pd.Series(False, index=column.index)
+    except (ValueError, OverflowError):
+        pass
+
+    def parse(value):
+        try:
+            return np.int64(int(value))
+        except (ValueError, OverflowError):
+            return None
+
+    values = [parse(value) for value in column]
+    malformed = pd.Series([v is None for v in values], index=column.index)
+    return (
+        pd.Series(
+            [0 if v is None else v for v in values],
+            index=column.index,
+            dtype=np.int64),
+        malformed)
+
+
+def to_float(column):
+
+    # parse with float(), values it can't parse (like 'unknown') become NaN,
+    # with the error message in the second returned series
+    values = column.to_numpy(dtype=object)
+    try:
+        return (
+            pd.Series(values.astype(float), index=column.index),
+            pd.Series(None, index=column.index, dtype=object))
+    except ValueError:
+        pass
+
+    def parse(value):
+        try:
+            return float(value), None
+        except ValueError as e:
+            return np.nan, str(e)
+
+    parsed, errors = zip(*(parse(value) for value in values))
+    return (
+        pd.Series(parsed, index=column.index, dtype=float),
+        pd.Series(errors, index=column.index, dtype=object))
+
+
+def resolve_classic_other(classic, other):
+    return known(classic).fillna(known(other))
+
+
+def parse_chunk(
+        text,
+        columns,
+        classic_other=False,
+        putative_other=False,
+        verified_column=False,
+        flywire=False,
+        kc_only=False):
+
+    # everything that depends only on the row itself, see read_csv for the
+    # rest
+    skid_column = 'flywire.id' if flywire else 'skid'
+    rows = pd.read_csv(
+        io.StringIO(text),
+        header=None,
+        names=columns,
+        usecols=lambda name: name in COLUMNS,
+        dtype=str,
+        keep_default_na=False,
+        na_filter=False)
+    skid = to_int64(rows[skid_column])
+
+    if classic_other:
+
+        neurotransmitter = resolve_classic_other(
+            rows['known.classic.transmitter'],
+            rows['known.other.transmitter'])
+
+        if putative_other:
+            neurotransmitter = neurotransmitter.fillna(
+                resolve_classic_other(
+                    rows['putative.classic.transmitter'],
+                    rows['known.other.transmitter']))
+    else:
+        if 'transmitter' in rows.columns:
+            neurotransmitter = rows['transmitter']
+        else:
+            neurotransmitter = rows['known.neurotransmitter']
+        neurotransmitter = known(neurotransmitter)
+
+    neurotransmitter = neurotransmitter.str.lower()
+    is_kc = neurotransmitter == 'kc_acetylcholine'
+    neurotransmitter[is_kc] = 'acetylcholine'
+    if kc_only:
+        not_kc = neurotransmitter.notna() & ~is_kc
+    else:
+        not_kc = pd.Series(False, index=rows.index)
+
+    if verified_column:
+        verified = rows['neurotransmitter.verified'].str.lower() == 'true'
+        neurotransmitter = neurotransmitter.where(verified)
+
+    hemi_lineage = known(rows['ItoLee.Hemilineage'], ('', 'NA', 'unknown'))
+    lineage = known(rows['ItoLee.Lineage'], ('', 'NA', 'unknown'))
+
+    if 'compartment' in rows.columns:
+        compartment = rows['compartment']
+    else:
+        compartment = pd.Series(None, index=rows.index, dtype=object)
+
+    # malformed IDs only fail the run if the row is kept, see read_csv
+    known_connector = rows['connector_id'] != 'unknown'
+    parsed_connector_id, malformed = to_int64_or_missing(
+        rows['connector_id'].where(known_connector, '0'))
+    connector_id = pd.Series(
+        pd.arrays.IntegerArray(
+            parsed_connector_id.values,
+            (~known_connector | malformed).values),
+        index=rows.index)
+    malformed_connector_id = rows['connector_id'].where(malformed)
+
+    if 'inside' in rows.columns:
+        region = known(rows['inside'])
+    else:
+        region = pd.Series(None, index=rows.index, dtype=object)
+
+    x, x_error = to_float(rows['x'])
+    y, y_error = to_float(rows['y'])
+    z, z_error = to_float(rows['z'])
+    z -= 40.0  # from CATMAID v14 to FAFB v14 N5 space
+
+    # the first error, as parsing x, y, z in turn would raise it, with the
+    # original coordinates
+    error = x_error.fillna(y_error).fillna(z_error)
+    invalid = error.notna()
+    coordinate_error = pd.Series(None, index=rows.index, dtype=object)
+    coordinate_error[invalid] = (
+        '(' + rows['x'][invalid] + ', ' + rows['y'][invalid] + ', ' +
+        rows['z'][invalid] + '): ' + error[invalid])
+
+    return pd.DataFrame({
+        'skid': skid,
+        'connector_id': connector_id,
+        'malformed_connector_id': malformed_connector_id,
+        'x': x,
+        'y': y,
+        'z': z,
+        'hemilineage': hemi_lineage,
+        'lineage': lineage,
+        'compartment': compartment,
+        'region': region,
+        'neurotransmitter': neurotransmitter,
+        'is_kc': is_kc,
+        'not_kc': not_kc,
+        'coordinate_error': coordinate_error
+    })
+
+
 def read_csv(
         filename,
         classic_other=False,
         putative_other=False,
         verified_column=False,
         flywire=False,
-        kc_only=False):
+        kc_only=False,
+        mark_kc=False,
+        num_workers=None):
 
     print(f"Reading {filename}")
 
-    unexpected_nt_types = set()
-
-    with open(filename, 'r') as f:
-
-        reader = DictReader(f)
-
-        skids = set()
-        skip_skids = set()
-
-        synapses = []
-
-        for row in reader:
-
-            if flywire:
-                skid = int(row['flywire.id'])
-            else:
-                skid = int(row['skid'])
-            skids.add(skid)
-
-            if skid in skip_skids:
-                continue
-
-            if classic_other:
-
-                classic = row['known.classic.transmitter']
-                other = row['known.other.transmitter']
-
-                neurotransmitter = (
-                    classic if classic != 'unknown' else (
-                        other if other != 'unknown' else None
-                    )
-                )
-
-                if neurotransmitter is None and putative_other:
-
-                    classic = row['putative.classic.transmitter']
-                    other = row['known.other.transmitter']
-
-                    neurotransmitter = (
-                        classic if classic != 'unknown' else (
-                            other if other != 'unknown' else None
-                        )
-                    )
-            else:
-                if 'transmitter' in row:
-                    neurotransmitter = row['transmitter']
-                else:
-                    neurotransmitter = row['known.neurotransmitter']
-                if neurotransmitter == 'unknown':
-                    neurotransmitter = None
-
-            if neurotransmitter is not None:
-                neurotransmitter = neurotransmitter.lower()
-                if neurotransmitter == 'kc_acetylcholine':
-                    neurotransmitter = 'acetylcholine'
-                elif kc_only:
-                    continue
-
-            if verified_column:
-                verified = (row['neurotransmitter.verified'].lower() == 'true')
-                if not verified:
-                    neurotransmitter = None
-
-            if neurotransmitter is None:
-                skip_skids.add(skid)
-                print(f"Skipping skeleton {skid} (no known NT)")
-                continue
-
-            if neurotransmitter not in [
-                    'gaba',
-                    'acetylcholine',
-                    'glutamate',
-                    'octopamine',
-                    'serotonin',
-                    'dopamine']:
-                unexpected_nt_types.add(neurotransmitter)
-
-            hemi_lineage = row['ItoLee.Hemilineage']
-            lineage = row['ItoLee.Lineage']
-            if hemi_lineage == '' or hemi_lineage == 'NA' or hemi_lineage == 'unknown':
-                hemi_lineage = None
-            if lineage == '' or lineage == 'NA' or lineage == 'unknown':
-                lineage = None
-
-            compartment = None
-            if 'compartment' in row:
-                compartment = row['compartment']
-
-            connector_id = row['connector_id']
-            if connector_id == 'unknown':
-                connector_id = None
-            else:
-                connector_id = int(connector_id)
-
-            region = None
-            if 'inside' in row:
-                region = row['inside']
-                if region == 'unknown':
-                    region = None
-
-            try:
-                x = float(row['x'])
-                y = float(row['y'])
-                z = float(row['z']) - 40.0  # from CATMAID v14 to FAFB v14 N5 space
-            except ValueError as e:
-                print(
-                    f"Error parsing coordinates of synapse {connector_id} "
-                    f"(skid = {skid}): {e}")
-                print("Skipping this synapse")
-                continue
-
-            flywire_id = None
-            if flywire:
-                flywire_id = skid
-                skid = None
-
-            synapses.append({
-                'skid': skid,
-                'flywire_id': flywire_id,
-                'connector_id': connector_id,
-                'x': x,
-                'y': y,
-                'z': z,
-                'hemilineage': hemi_lineage,
-                'lineage': lineage,
-                'compartment': compartment,
-                'region': region,
-                'neurotransmitter': neurotransmitter
-            })
-
-        print(f"Skipped {len(skip_skids)}/{len(skids)} skeletons")
-
-        print(f"Encountered unexpected NT types: {unexpected_nt_types}")
-        return synapses
-
-
-for file_description, file in files.items():
-    print(f"Consolidating {file_description} synapses...")
-    synapses = read_csv(file["in_file"], **file["kwargs"])
-
-    if "out_file" in file:
-        out_file = file["out_file"]
+    rows = pd.concat(
+        parse_chunks(
+            filename,
+            parse_chunk,
+            num_workers,
+            classic_other=classic_other,
+            putative_other=putative_other,
+            verified_column=verified_column,
+            flywire=flywire,
+            kc_only=kc_only),
+        ignore_index=True)
+    skid = rows['skid']
+    num_skids = skid.nunique()
+    neurotransmitter = rows['neurotransmitter']
+    not_kc = rows['not_kc']
+
+    # the first row without known NT marks its skeleton as skipped, every
+    # later row of the same skeleton is skipped as well
+    no_nt = neurotransmitter.isna() & ~not_kc
+    row_index = pd.Series(np.arange(len(rows)), index=rows.index)
+    first_no_nt = row_index[no_nt].groupby(skid[no_nt]).min()
+    skipped = row_index >= skid.map(first_no_nt).fillna(len(rows))
+
+    skipped_skids = first_no_nt.sort_values().index
+    diagnostics.record_many(
+        diagnostics.SKIPPED_SKELETON,
+        len(skipped_skids),
+        lambda i: {'skid': skipped_skids[i], 'reason': "no known NT"})
+
+    keep = ~skipped & ~not_kc
+
+    malformed = keep & rows['malformed_connector_id'].notna()
+    if malformed.any():
+        first = malformed.idxmax()
+        raise ValueError(
+            f"Invalid connector_id {rows['malformed_connector_id'][first]!r} "
+            f"of skeleton {skid[first]}")
+
+    unexpected_nt_types = set(
+        neurotransmitter[keep & ~neurotransmitter.isin(NEUROTRANSMITTERS)])
+
+    invalid = keep & rows['coordinate_error'].notna()
+    invalid_index = invalid[invalid].index
+    diagnostics.record_many(
+        diagnostics.BAD_COORDINATES,
+        len(invalid_index),
+        lambda i: {
+            'connector_id': rows['connector_id'][invalid_index[i]],
+            'skid': skid[invalid_index[i]],
+            'error': rows['coordinate_error'][invalid_index[i]]
+        })
+    print(f"Skipped {invalid.sum()} synapses with invalid coordinates")
+    keep &= ~invalid
+
+    if flywire:
+        flywire_id = skid
+        skid = pd.Series(None, index=rows.index, dtype=object)
     else:
-        base_file = os.path.basename(file["in_file"])
-        out_file = os.path.join(out_path, base_file)
+        flywire_id = pd.Series(None, index=rows.index, dtype=object)
+
+    synapses = pd.DataFrame({
+        'skid': skid,
+        'flywire_id': flywire_id,
+        'connector_id': rows['connector_id'],
+        'x': rows['x'],
+        'y': rows['y'],
+        'z': rows['z'],
+        'hemilineage': rows['hemilineage'],
+        'lineage': rows['lineage'],
+        'compartment': rows['compartment'],
+        'region': rows['region'],
+        'neurotransmitter': neurotransmitter
+    })
+    if mark_kc:
+        # to derive the KC-only variant later, see `kc_only_variant`
+        synapses['is_kc'] = rows['is_kc']
+    synapses = synapses[keep].reset_index(drop=True)
+
+    print(f"Skipped {len(first_no_nt)}/{num_skids} skeletons")
+
+    print(f"Encountered unexpected NT types: {unexpected_nt_types}")
+    return synapses
+
 
-    with open(out_file, 'w') as f:
-        json.dump(synapses, f, indent=2)
+def kc_only_variant(synapses):
+
+    # same as read_csv(..., kc_only=True) on synapses read with mark_kc=True,
+    # unless verified_column is set: unverified non-KC rows don't skip their
+    # skeleton with kc_only
+    return synapses[synapses['is_kc']].reset_index(drop=True)
+
+
+def out_file_for(file):
+
+    if "out_file" in file:
+        return file["out_file"]
+    base_file = os.path.basename(file["in_file"])
+    return os.path.join(out_path, base_file)
+
+
+def diagnostics_file_for(in_file):
+
+    base_file = os.path.splitext(os.path.basename(in_file))[0]
+    return os.path.join(out_path, base_file + '.diagnostics.json')
+
+
+def consolidate(in_file, kwargs, variants, json_output, num_workers, detail):
+
+    # run in a worker, collect the output to show it in order
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+
+        diagnostics_file = diagnostics_file_for(in_file)
+        diagnostics.reset()
+        if detail:
+            diagnostics.enable_detail(
+                os.path.splitext(diagnostics_file)[0] + '.jsonl')
+
+        synapses = read_csv(
+            in_file,
+            **kwargs,
+            mark_kc=True,
+            num_workers=num_workers)
+
+        diagnostics.print_summary()
+        diagnostics.write_report(diagnostics_file)
+
+        for file_description, out_file, kc_only in variants:
+            print(f"Consolidating {file_description} synapses...")
+            variant = kc_only_variant(synapses) if kc_only else synapses
+            variant = variant.drop(columns='is_kc')
+
+            npz_file = os.path.splitext(out_file)[0] + '.npz'
+            write_synapses(variant, npz_file)
+            write_index(npz_file, DATASETS['fafb']['voxel_size'])
+            if json_output:
+                write_synapses(variant, out_file)
+
+    return output.getvalue()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--no-json',
+        action='store_true',
+        help="Only write the .npz files, not the JSON files ingest.py reads")
+    parser.add_argument(
+        '--num-workers',
+        type=int,
+        default=None,
+        help="Number of input files to consolidate concurrently")
+    parser.add_argument(
+        '--parse-workers',
+        type=int,
+        default=None,
+        help="Number of processes parsing each input file (default: the "
+             "available cores, divided by the number of input files)")
+    parser.add_argument(
+        '--diagnostics-detail',
+        action='store_true',
+        help="List every skipped skeleton and synapse in a .diagnostics.jsonl "
+             "file per input, next to its .diagnostics.json summary")
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    # each distinct input (file and parse options) is read once, variants
+    # are derived from it
+    inputs = defaultdict(list)
+    for file_description, file in files.items():
+        kwargs = dict(file["kwargs"])
+        kc_only = False
+        if not kwargs.get("verified_column", False):
+            kc_only = kwargs.pop("kc_only", False)
+        key = (file["in_file"], tuple(sorted(kwargs.items())))
+        inputs[key].append((file_description, out_file_for(file), kc_only))
+
+    parse_workers = args.parse_workers
+    if parse_workers is None:
+        parse_workers = max(1, (os.cpu_count() or 1) // len(inputs))
+
+    with ProcessPoolExecutor(max_workers=args.num_workers) as pool:
+        futures = [
+            pool.submit(
+                consolidate,
+                in_file,
+                dict(kwargs),
+                variants,
+                not args.no_json,
+                parse_workers,
+                args.diagnostics_detail)
+            for (in_file, kwargs), variants in inputs.items()
+        ]
+        for future in futures:
+            print(future.result(), end='')
@@ -1,100 +1,230 @@
-from csv import DictReader
-import json
-import numpy as np
+"""Consolidate the hemibrain synapse CSV.
+
+Run from the repository root as ``python -m hemi.consolidate``, paths below
+are relative to this directory.
+"""
+from chunked_csv import parse_chunks
+from fafb.consolidate import known, to_float, to_int64, to_int64_or_missing
+from spatial_index import write_index
+from synapse_io import write_synapses
+from synister_datasets import DATASETS
 from synistereq.repositories import HemiNeuprint
+import argparse
+import diagnostics
+import io
+import numpy as np
+import os
+import pandas as pd
 
 in_file = 'original/2021-10-27/hemibrain_connectors_by_hemi_lineage_October2021.csv'
 out_file = 'consolidated/2021-10-27/hemibrain_connectors_by_hemi_lineage_October2021.json'
 
-def read_csv(filename):
+# number of positions to send to the repository in one transform call
+transform_chunk_size = 100000
+
+
+def transform_positions(repository, synapses, positions):
+
+    transformed = []
+    for i in range(0, len(positions), transform_chunk_size):
+        chunk = positions[i:i + transform_chunk_size]
+        try:
+            transformed.append(repository.transform_positions(chunk))
+        except ValueError:
+            # find the offending synapse(s), transform the rest one by one
+            for (connector_id, body_id), position in zip(
+                    synapses[['connector_id', 'body_id']].iloc[
+                        i:i + transform_chunk_size].itertuples(index=False),
+                    chunk):
+                try:
+                    transformed.append(
+                        repository.transform_positions(position[None, :]))
+                except ValueError as e:
+                    diagnostics.record(diagnostics.BAD_COORDINATES, {
+                        'connector_id': as_int_or_none(connector_id),
+                        'body_id': int(body_id),
+                        'error': f"transform failed: {e}"
+                    })
+                    transformed.append(np.full((1, 3), np.nan))
+
+    if not transformed:
+        return np.empty((0, 3))
+    return np.concatenate(transformed)
+
+
+def as_int_or_none(value):
+
+    return None if pd.isna(value) else int(value)
+
+
+def parse_chunk(text, columns):
+
+    # everything that depends only on the row itself, the skipping of
+    # skeletons depends on the row order and is done in read_csv
+    rows = pd.read_csv(
+        io.StringIO(text),
+        header=None,
+        names=columns,
+        dtype=str,
+        keep_default_na=False,
+        na_filter=False)
+    body_id = to_int64(rows['bodyid'])
+
+    classic = rows['known.classic.transmitter']
+    other = rows['known.other.transmitter']
+    neurotransmitter = known(classic).fillna(known(other)).str.lower()
+    neurotransmitter[neurotransmitter == 'kc_acetylcholine'] = 'acetylcholine'
+
+    hemi_lineage = known(rows['ItoLee.Hemilineage'], ('', 'NA', 'unknown'))
+
+    if 'Label' in rows.columns:
+        compartment = rows['Label']
+    else:
+        compartment = pd.Series(None, index=rows.index, dtype=object)
+
+    # malformed IDs only fail the run if the row is kept, see read_csv
+    known_connector = rows['connector_id'] != 'unknown'
+    parsed_connector_id, malformed = to_int64_or_missing(
+        rows['connector_id'].where(known_connector, '0'))
+    connector_id = pd.Series(
+        pd.arrays.IntegerArray(
+            parsed_connector_id.values,
+            (~known_connector | malformed).values),
+        index=rows.index)
+    malformed_connector_id = rows['connector_id'].where(malformed)
+
+    # coordinates of rows without NT are not parsed, such rows are skipped
+    has_nt = neurotransmitter.notna()
+    x, x_error = to_float(rows['x'].where(has_nt, 'nan'))
+    y, y_error = to_float(rows['y'].where(has_nt, 'nan'))
+    z, z_error = to_float(rows['z'].where(has_nt, 'nan'))
+    # the first error, as parsing x, y, z in turn would raise it
+    coordinate_error = x_error.fillna(y_error).fillna(z_error)
+
+    return pd.DataFrame({
+        'body_id': body_id,
+        'connector_id': connector_id,
+        'malformed_connector_id': malformed_connector_id,
+        'x': x,
+        'y': y,
+        'z': z,
+        'coordinate_error': coordinate_error,
+        'hemilineage': hemi_lineage,
+        'compartment': compartment,
+        'region': rows['inside'],
+        'neurotransmitter': neurotransmitter
+    })
+
+
+def read_csv(filename, num_workers=None):
 
     print(f"Reading {filename}")
     repository = HemiNeuprint()
 
-    with open(filename, 'r') as f:
-
-        reader = DictReader(f)
-
-        body_ids = set()
-        skip_body_ids = set()
-
-        synapses = []
-
-        for row in reader:
-
-            body_id = int(row['bodyid'])
-            body_ids.add(body_id)
-
-            if body_id in skip_body_ids:
-                continue
-
-
-            classic = row['known.classic.transmitter']
-            other = row['known.other.transmitter']
-
-            neurotransmitter = (
-                classic if classic != 'unknown' else (
-                    other if other != 'unknown' else None
-                )
-            )
-
-            if neurotransmitter is not None:
-                neurotransmitter = neurotransmitter.lower()
-                if neurotransmitter == 'kc_acetylcholine':
-                    neurotransmitter = 'acetylcholine'
-
-            if neurotransmitter is None:
-                skip_body_ids.add(body_id)
-                print(f"Skipping skeleton {body_id} (no known NT)")
-                continue
-
-            hemi_lineage = row['ItoLee.Hemilineage']
-            lineage = None
-            if hemi_lineage == '' or hemi_lineage == 'NA' or hemi_lineage == 'unknown':
-                hemi_lineage = None
-
-            compartment = None
-            if 'Label' in row:
-                compartment = row['Label']
-
-            connector_id = row['connector_id']
-            if connector_id == 'unknown':
-                connector_id = None
-            else:
-                connector_id = int(connector_id)
-
-            region = row['inside']
-
-            try:
-                x = float(row['x'])
-                y = float(row['y'])
-                z = float(row['z'])
-                [pos] = repository.transform_positions(np.array([[z, y, x]]))
-                [z, y, x] = [float(i) for i in pos]
-            except ValueError as e:
-                print(
-                    f"Error parsing coordinates of synapse {connector_id} "
-                    f"(body_id = {body_id}): {e}")
-                print("Skipping this synapse")
-                continue
-
-            synapses.append({
-                'body_id': body_id,
-                'connector_id': connector_id,
-                'x': x,
-                'y': y,
-                'z': z,
-                'hemilineage': hemi_lineage,
-                'lineage': lineage,
-                'compartment': compartment,
-                'region': region,
-                'neurotransmitter': neurotransmitter
-            })
-
-        print(f"Skipped {len(skip_body_ids)}/{len(body_ids)} skeletons")
-        return synapses
-
-
-synapses = read_csv(in_file)
-with open(out_file, 'w') as f:
-    json.dump(synapses, f, indent=2)
+    rows = pd.concat(
+        parse_chunks(filename, parse_chunk, num_workers),
+        ignore_index=True)
+    body_id = rows['body_id']
+
+    # the first row without known NT marks its skeleton as skipped, every
+    # later row of the same skeleton is skipped as well
+    no_nt = rows['neurotransmitter'].isna()
+    row_index = pd.Series(np.arange(len(rows)), index=rows.index)
+    first_no_nt = row_index[no_nt].groupby(body_id[no_nt]).min()
+    keep = row_index < body_id.map(first_no_nt).fillna(len(rows))
+
+    skipped_body_ids = first_no_nt.sort_values().index
+    diagnostics.record_many(
+        diagnostics.SKIPPED_SKELETON,
+        len(skipped_body_ids),
+        lambda i: {
+            'body_id': int(skipped_body_ids[i]),
+            'reason': "no known NT"
+        })
+
+    malformed = keep & rows['malformed_connector_id'].notna()
+    if malformed.any():
+        # fails like parsing it right away would have
+        int(rows['malformed_connector_id'][malformed.idxmax()])
+
+    invalid = keep & rows['coordinate_error'].notna()
+    invalid_index = invalid[invalid].index
+    diagnostics.record_many(
+        diagnostics.BAD_COORDINATES,
+        len(invalid_index),
+        lambda i: {
+            'connector_id': as_int_or_none(
+                rows['connector_id'][invalid_index[i]]),
+            'body_id': int(body_id[invalid_index[i]]),
+            'error': rows['coordinate_error'][invalid_index[i]]
+        })
+    keep &= ~invalid
+
+    print(f"Skipped {len(first_no_nt)}/{body_id.nunique()} skeletons")
+
+    synapses = pd.DataFrame({
+        'body_id': body_id,
+        'connector_id': rows['connector_id'],
+        'x': rows['x'],
+        'y': rows['y'],
+        'z': rows['z'],
+        'hemilineage': rows['hemilineage'],
+        'lineage': pd.Series(None, index=rows.index, dtype=object),
+        'compartment': rows['compartment'],
+        'region': rows['region'],
+        'neurotransmitter': rows['neurotransmitter']
+    })
+    synapses = synapses[keep].reset_index(drop=True)
+
+    print(f"Transforming {len(synapses)} synapse positions")
+    positions = transform_positions(
+        repository,
+        synapses,
+        synapses[['z', 'y', 'x']].to_numpy(dtype=float))
+    synapses['z'] = positions[:, 0]
+    synapses['y'] = positions[:, 1]
+    synapses['x'] = positions[:, 2]
+    synapses = synapses[~np.isnan(positions[:, 0])].reset_index(drop=True)
+
+    print(
+        f"Skipped {diagnostics.counts().get(diagnostics.BAD_COORDINATES, 0)} "
+        "synapses with invalid coordinates")
+
+    return synapses
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--no-json',
+        action='store_true',
+        help="Only write the .npz files, not the JSON files ingest.py reads")
+    parser.add_argument(
+        '--num-workers',
+        type=int,
+        default=None,
+        help="Number of processes parsing the input file")
+    parser.add_argument(
+        '--diagnostics-detail',
+        action='store_true',
+        help="List every skipped skeleton and synapse in a .diagnostics.jsonl "
+             "file, next to the .diagnostics.json summary")
+    args = parser.parse_args()
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    diagnostics_file = os.path.splitext(out_file)[0] + '.diagnostics.json'
+    if args.diagnostics_detail:
+        diagnostics.enable_detail(
+            os.path.splitext(diagnostics_file)[0] + '.jsonl')
+
+    synapses = read_csv(in_file, args.num_workers)
+    diagnostics.print_summary()
+    diagnostics.write_report(diagnostics_file)
+
+    npz_file = os.path.splitext(out_file)[0] + '.npz'
+    write_synapses(synapses, npz_file)
+    write_index(npz_file, DATASETS['hemi']['voxel_size'])
+    if not args.no_json:
+        write_synapses(synapses, out_file)
@@ -0,0 +1,333 @@
+"""Incremental updates of an existing synister database.
+
+Synapses are compared by ``synapse_id`` and ``content_hash`` against what is
+already stored, and only inserted, changed or removed documents are written.
+Synapses keep their partitions in existing splits, only new synapses are
+assigned to one.
+"""
+from collections import defaultdict
+import hashlib
+import json
+import random
+
+PARTITIONS = ['train', 'test', 'validation']
+
+# per synapse fields that are not part of its content
+NON_CONTENT_FIELDS = {'_id', 'splits', 'content_hash'}
+
+
+def content_hash(document):
+
+    content = {
+        key: value
+        for key, value in document.items()
+        if key not in NON_CONTENT_FIELDS
+    }
+    return hashlib.blake2b(
+        json.dumps(content, sort_keys=True, default=str).encode(),
+        digest_size=16).hexdigest()
+
+
+def read_state(database):
+    """Read what is needed to diff against the current content of
+    ``database``."""
+
+    print("Reading current database state...")
+
+    synapses = {
+        synapse['synapse_id']: synapse
+        for synapse in database['synapses'].find(
+            {},
+            {
+                '_id': False,
+                'synapse_id': True,
+                'skeleton_id': True,
+                'brain_region': True,
+                'content_hash': True,
+                'splits': True
+            })
+    }
+    skeletons = {
+        skeleton['skeleton_id']: skeleton
+        for skeleton in database['skeletons'].find({}, {'_id': False})
+    }
+    hemi_lineages = {
+        hemi_lineage['hemi_lineage_name']: hemi_lineage
+        for hemi_lineage in database['hemi_lineages'].find({}, {'_id': False})
+    }
+
+    print(
+        f"Found {len(synapses)} synapses, {len(skeletons)} skeletons and "
+        f"{len(hemi_lineages)} hemi lineages")
+
+    return {
+        'synapses': synapses,
+        'skeletons': skeletons,
+        'hemi_lineages': hemi_lineages
+    }
+
+
+def update_database(writer, previous, synapses, skeletons, hemi_lineages):
+    """Write the difference between ``previous`` (see ``read_state``) and
+    the given documents."""
+
+    previous_synapses = previous['synapses']
+    synapse_ids = set()
+
+    inserted = []
+    updated = []
+
+    for synapse in synapses:
+
+        synapse_id = synapse['synapse_id']
+        synapse_ids.add(synapse_id)
+        before = previous_synapses.get(synapse_id)
+
+        if before is None:
+            inserted.append(synapse)
+        elif before.get('content_hash') != synapse['content_hash']:
+            # keep the current partitions, they are updated separately
+            updated.append({**synapse, 'splits': before.get('splits', {})})
+
+    deleted = [
+        synapse_id
+        for synapse_id in previous_synapses.keys()
+        if synapse_id not in synapse_ids
+    ]
+
+    print(
+        f"Synapses: {len(inserted)} new, {len(updated)} changed, "
+        f"{len(deleted)} removed")
+
+    writer.write(synapses=inserted)
+    writer.replace('synapses', 'synapse_id', updated)
+    writer.delete('synapses', 'synapse_id', deleted)
+
+    for collection, key, documents in [
+            ('skeletons', 'skeleton_id', skeletons),
+            ('hemi_lineages', 'hemi_lineage_name', hemi_lineages)]:
+
+        before = previous[collection]
+        changed = [
+            document
+            for document in documents
+            if before.get(document[key]) != strip_id(document)
+        ]
+        keys = set(document[key] for document in documents)
+        removed = [k for k in before.keys() if k not in keys]
+
+        print(
+            f"{collection.capitalize().replace('_', ' ')}: "
+            f"{len(changed)} new or changed, {len(removed)} removed")
+
+        writer.replace(collection, key, changed)
+        writer.delete(collection, key, removed)
+
+
+def strip_id(document):
+
+    return {
+        key: value
+        for key, value in document.items()
+        if key != '_id'
+    }
+
+
+def random_split(synapse_ids, a_fraction):
+
+    # per synapse, as for NTs that fall back to a random split in ingest.py
+    synapse_ids = list(synapse_ids)
+    random.seed(19120623)
+    random.shuffle(synapse_ids)
+    split_index = int(a_fraction * len(synapse_ids))
+    return synapse_ids[:split_index], synapse_ids[split_index:]
+
+
+def update_synapse_split(
+        synapses,
+        split_attribute,
+        split_name,
+        previous,
+        test_fraction,
+        validation_fraction):
+    """Update a split with the synapses that don't have a partition yet.
+
+    Synapses keep their previous partition, even if they changed, such that
+    no synapse moves between train, test and validation. As in ingest.py,
+    new synapses are split in two steps, (train ∪ validation) / test and
+    train / validation, independently per neurotransmitter. In each step:
+
+    * if the neurotransmitter was split by superset, new synapses go to the
+      set of the other synapses of their superset, and new supersets as a
+      whole to the set that is furthest below its target fraction
+    * if the neurotransmitter was split randomly per synapse (recognized by
+      a superset with synapses in both sets), new synapses are split
+      randomly per synapse as well
+    """
+
+    print()
+    print()
+    print(f"Updating split {split_name} by {split_attribute}...")
+
+    targets = {
+        'train': (1.0 - test_fraction) * (1.0 - validation_fraction),
+        'test': test_fraction,
+        'validation': (1.0 - test_fraction) * validation_fraction
+    }
+
+    previous_synapses = previous['synapses']
+    partitions = {}
+    counts = defaultdict(lambda: defaultdict(int))
+    totals = defaultdict(int)
+    superset_partitions = defaultdict(set)
+    # NT -> superset -> new synapse IDs
+    pending = defaultdict(lambda: defaultdict(list))
+
+    for synapse_id, superset, neurotransmitter in zip(
+            synapses.values('synapse_id'),
+            synapses.values(split_attribute),
+            synapses.values('neurotransmitter')):
+
+        if superset is None or neurotransmitter is None:
+            continue
+
+        totals[neurotransmitter] += 1
+        partition = previous_synapses.get(synapse_id, {}).get(
+            'splits', {}).get(split_name)
+
+        if partition is None:
+            pending[neurotransmitter][superset].append(synapse_id)
+        else:
+            partitions[synapse_id] = partition
+            counts[neurotransmitter][partition] += 1
+            superset_partitions[(superset, neurotransmitter)].add(partition)
+
+    def split_step(neurotransmitter, groups, a_partitions, b_partitions, a_fraction):
+        """Divide ``groups`` (superset -> synapse IDs) between sets A and
+        B."""
+
+        a_groups = defaultdict(list)
+        b_groups = defaultdict(list)
+
+        randomly = any(
+            found & a_partitions and found & b_partitions
+            for (_, nt), found in superset_partitions.items()
+            if nt == neurotransmitter)
+        if randomly:
+            a_set, b_set = random_split(
+                [
+                    (superset, synapse_id)
+                    for superset, synapse_ids in groups.items()
+                    for synapse_id in synapse_ids
+                ],
+                a_fraction)
+            for set_groups, assigned in [(a_groups, a_set), (b_groups, b_set)]:
+                for superset, synapse_id in assigned:
+                    set_groups[superset].append(synapse_id)
+            return a_groups, b_groups
+
+        def deficit(set_partitions, added):
+            return sum(
+                targets[p] * totals[neurotransmitter] -
+                counts[neurotransmitter][p]
+                for p in set_partitions) - added
+
+        added = {'a': 0, 'b': 0}
+        # large new supersets first, to balance with the small ones
+        for superset, synapse_ids in sorted(
+                groups.items(),
+                key=lambda item: -len(item[1])):
+
+            found = superset_partitions[(superset, neurotransmitter)]
+            if found & b_partitions:
+                to_a = False
+            elif found & a_partitions:
+                to_a = True
+            else:
+                to_a = (
+                    deficit(a_partitions, added['a']) >=
+                    deficit(b_partitions, added['b']))
+
+            (a_groups if to_a else b_groups)[superset] += synapse_ids
+            added['a' if to_a else 'b'] += len(synapse_ids)
+
+        return a_groups, b_groups
+
+    num_assigned = 0
+    for neurotransmitter, groups in pending.items():
+
+        train_validation, test = split_step(
+            neurotransmitter,
+            groups,
+            {'train', 'validation'},
+            {'test'},
+            1.0 - test_fraction)
+        train, validation = split_step(
+            neurotransmitter,
+            train_validation,
+            {'train'},
+            {'validation'},
+            1.0 - validation_fraction)
+
+        for partition, assigned in [
+                ('train', train),
+                ('test', test),
+                ('validation', validation)]:
+            for synapse_ids in assigned.values():
+                for synapse_id in synapse_ids:
+                    partitions[synapse_id] = partition
+                num_assigned += len(synapse_ids)
+
+    print(f"Assigned {num_assigned} new synapses")
+
+    return tuple(
+        [
+            synapse_id
+            for synapse_id, p in partitions.items()
+            if p == partition
+        ]
+        for partition in PARTITIONS
+    )
+
+
+def changed_split_assignments(splits, previous):
+    """Restrict splits to the synapses whose partition changed.
+
+    Returns the restricted splits, and by split name the synapses that had
+    a partition before but are not part of the split anymore (``None``
+    splits lose all of their synapses).
+    """
+
+    previous_synapses = previous['synapses']
+
+    def previous_partition(synapse_id, split_name):
+        return previous_synapses.get(synapse_id, {}).get(
+            'splits', {}).get(split_name)
+
+    changed = {
+        split_name: tuple(
+            [
+                synapse_id
+                for synapse_id in synapse_ids
+                if previous_partition(synapse_id, split_name) != partition
+            ]
+            for partition, synapse_ids in zip(PARTITIONS, split)
+        )
+        for split_name, split in splits.items()
+        if split is not None
+    }
+
+    unassigned = {}
+    for split_name, split in splits.items():
+        assigned = set() if split is None else set(
+            synapse_id
+            for synapse_ids in split
+            for synapse_id in synapse_ids)
+        unassigned[split_name] = [
+            synapse_id
+            for synapse_id in previous_synapses.keys()
+            if previous_partition(synapse_id, split_name) is not None and
+            synapse_id not in assigned
+        ]
+
+    return changed, unassigned
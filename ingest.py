@@ -1,81 +1,27 @@
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from configparser import ConfigParser
+import contextlib
+import io
 import itertools
 from funlib.math import cantor_number
 from synister import SynisterDb, find_optimal_split, ImpossibleSplit
+from incremental import (
+    changed_split_assignments,
+    content_hash,
+    read_state,
+    update_database,
+    update_synapse_split)
+from instrumentation import count, stage
+import diagnostics
+import instrumentation
+from synapse_io import Categorical
+from synapse_table import concatenate, read_table
+from synister_datasets import DATASETS
+from synister_mongo import BulkWriter, get_database
 import argparse
-import json
 import numpy as np
 import random
 
-DATASETS = {
-    "fafb": {
-        "files": [
-            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_connectors_by_hemi_lineage_v4.csv',
-            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_verified_predicted_synapses_by_transmitter_v4.csv',
-        ],
-        "holdout_files": [
-            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_connectors_by_hemi_lineage_confident_v4.csv',
-        ],
-        "voxel_size": (40, 4, 4),
-        "db_name": 'synister_fafb_v4',
-        "test_fraction": 0.2,       # fraction of whole dataset to use for testing
-        "validation_fraction": 0.2  # fraction of remaining data to use for validation
-    },
-    "fafb_confident": {
-        "files": [
-            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_connectors_by_hemi_lineage_confident_v4.csv',
-        ],
-        "voxel_size": (40, 4, 4),
-        "db_name": 'synister_fafb_v4_confident',
-        "test_fraction": 0.0,       # fraction of whole dataset to use for testing
-        "validation_fraction": 1.0  # fraction of remaining data to use for validation
-    },
-    "fafb_v3updated": {
-        "files": [
-            'fafb/consolidated/2021-12-08/2021-11-23_FAFB_connectors_by_hemi_lineage_v3.csv',
-        ],
-        "holdout_files": [
-            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_connectors_by_hemi_lineage_confident_v4.csv',
-        ],
-        "voxel_size": (40, 4, 4),
-        "db_name": 'synister_fafb_v4_v3updated',
-        "test_fraction": 0.2,       # fraction of whole dataset to use for testing
-        "validation_fraction": 0.2  # fraction of remaining data to use for validation
-    },
-    "fafb_v3updatedKC": {
-        "files": [
-            'fafb/consolidated/2021-12-08/2021-11-23_FAFB_connectors_by_hemi_lineage_v3.csv',
-            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_connectors_by_hemi_lineage_v4_KC_only.csv',
-        ],
-        "holdout_files": [
-            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_connectors_by_hemi_lineage_confident_v4.csv',
-        ],
-        "voxel_size": (40, 4, 4),
-        "db_name": 'synister_fafb_v4_v3updatedKC',
-        "test_fraction": 0.2,       # fraction of whole dataset to use for testing
-        "validation_fraction": 0.2  # fraction of remaining data to use for validation
-    },
-    "hemi": {
-        "files": [
-            'hemi/consolidated/2021-10-27/hemibrain_connectors_by_hemi_lineage_October2021.json'
-        ],
-        "voxel_size": (8, 8, 8),
-        "db_name": 'synister_hemi_v1',
-        "test_fraction": 0.2,       # fraction of whole dataset to use for testing
-        "validation_fraction": 0.2  # fraction of remaining data to use for validation
-    },
-    "malevnc": {
-        "files": [
-            'malevnc/consolidated/vnc_filtered_090621/synapses.json'
-        ],
-        "voxel_size": (8, 8, 8),
-        "db_name": 'synister_malevnc_v0',
-        "test_fraction": 0.2,       # fraction of whole dataset to use for testing
-        "validation_fraction": 0.2  # fraction of remaining data to use for validation
-    }
-}
-
 NT_SYNAPSES_THRESHOLD = 1000
 NT_SKELETONS_THRESHOLD = 3
 
@@ -91,209 +37,532 @@ parser.add_argument(
     type=str,
     required=True,
     help="MongoDB credential file")
+parser.add_argument(
+    '--chunk-size',
+    type=int,
+    default=10000,
+    help="Number of documents per bulk write request")
+parser.add_argument(
+    '--num-workers',
+    type=int,
+    default=4,
+    help="Number of concurrent bulk write requests")
+parser.add_argument(
+    '--split-workers',
+    type=int,
+    default=3,
+    help="Number of processes to compute splits in")
+parser.add_argument(
+    '--incremental',
+    action='store_true',
+    help="Update the existing database with the differences to the input "
+         "files only, instead of recreating it")
+parser.add_argument(
+    '--report',
+    type=str,
+    help="Write a JSON report of the time and memory used per stage to this "
+         "file")
+parser.add_argument(
+    '--profile',
+    type=str,
+    help="Profile each stage, and write the profiles to this directory")
+parser.add_argument(
+    '--profiler',
+    choices=instrumentation.PROFILERS,
+    default='cprofile',
+    help="Profiler to use with --profile")
+parser.add_argument(
+    '--diagnostics',
+    type=str,
+    help="Write counts and samples of skipped and duplicate synapses to this "
+         "JSON file")
+parser.add_argument(
+    '--diagnostics-detail',
+    type=str,
+    help="Write every skipped and duplicate synapse to this file (one JSON "
+         "object per line)")
+parser.add_argument(
+    '--max-split-deviation',
+    type=float,
+    help="Split an NT randomly per synapse right away if its largest superset "
+         "alone makes its split deviate more than this from the target "
+         "fraction, instead of retrying the solver once per NT that can't be "
+         "split")
 
 
 def read_synapses(synapse_files, voxel_size):
 
-    synapses = []
-    for filename in synapse_files:
-        with open(filename, 'r') as f:
-            synapses += json.load(f)
-
     # connector_id -> synapse_id
 
-    def get_synapse_id(synapse):
+    def get_synapse_ids(synapses):
 
         # use connector_id if available
-        if synapse['connector_id'] is not None:
-            return synapse['connector_id']
+        connector_ids = synapses['connector_id']
+        missing = synapses.is_missing('connector_id')
+        if isinstance(connector_ids, Categorical) or \
+                connector_ids.dtype.kind not in 'iu':
+            synapse_ids = np.array(
+                synapses.values('connector_id') + [None],
+                dtype=object)[:-1]
+        else:
+            synapse_ids = np.ma.getdata(connector_ids).astype(np.int64)
+        if not missing.any():
+            return synapse_ids
 
         # fall back to Cantor number of coordinates (int, in voxels)
-        return cantor_number(tuple(
-            int(synapse[d]) // voxel_size[i]
-            for i, d in enumerate(['z', 'y', 'x'])
-        ))
-
-    def get_skeleton_id(synapse):
-        fields = ["skid", "flywire_id", "body_id"]
+        without_connector = synapses.select(missing)
+        fallback = [
+            cantor_number(tuple(
+                int(coordinate) // voxel_size[i]
+                for i, coordinate in enumerate(position)))
+            for position in zip(*(
+                without_connector.values(d)
+                for d in ['z', 'y', 'x']))
+        ]
+        try:
+            synapse_ids[missing] = np.array(fallback, dtype=synapse_ids.dtype)
+        except OverflowError:
+            # too large for int64
+            synapse_ids = synapse_ids.astype(object)
+            synapse_ids[missing] = fallback
+        return synapse_ids
+
+    def get_skeleton_ids(synapses):
+
+        fields = [
+            f for f in ["skid", "flywire_id", "body_id"]
+            if f in synapses
+        ]
+        numeric = all(
+            not isinstance(synapses[f], Categorical) and
+            synapses[f].dtype.kind in 'iu'
+            for f in fields)
+
+        found = np.zeros(len(synapses), dtype=bool)
+        skeleton_ids = np.zeros(len(synapses), dtype=np.int64 if numeric else object)
         for f in fields:
-            val = synapse.get(f)
-            if val is not None:
-                return val
-        return None
-
-    # bring into synapse format as expected by SynisterDb
-    synapses = [
-        {
-            **synapse,
-            # synister DB expects int for coordinates
-            'x': int(synapse['x']),
-            'y': int(synapse['y']),
-            'z': int(synapse['z']),
-            'synapse_id': get_synapse_id(synapse),
-            'skeleton_id': get_skeleton_id(synapse),
-            'brain_region': synapse['region']
-        }
-        for synapse in synapses
-    ]
+            use = ~found & ~synapses.is_missing(f)
+            if numeric:
+                skeleton_ids[use] = np.ma.getdata(synapses[f])[use]
+            else:
+                values = np.array(synapses.values(f) + [None], dtype=object)[:-1]
+                skeleton_ids[use] = values[use]
+            found |= use
+
+        if found.all():
+            return skeleton_ids
+        if numeric:
+            return np.ma.MaskedArray(skeleton_ids, ~found)
+        skeleton_ids[~found] = None
+        return skeleton_ids
+
+    def to_int(synapses, name):
+
+        values = synapses[name]
+        if synapses.is_missing(name).any():
+            raise ValueError(f"Found synapses without '{name}' coordinate")
+        if isinstance(values, Categorical) or values.dtype == object:
+            return np.array(synapses.values(name), dtype=np.int64)
+        # truncates like int()
+        return np.ma.getdata(values).astype(np.int64)
+
+    # bring into synapse format as expected by SynisterDb and count synapses
+    # and skeletons per neurotransmitter
+
+    with stage('read') as read:
+        synapses = concatenate([
+            read_table(filename)
+            for filename in synapse_files
+        ])
+
+        synapses['synapse_id'] = get_synapse_ids(synapses)
+        synapses['skeleton_id'] = get_skeleton_ids(synapses)
+        synapses['brain_region'] = synapses['region']
+        # synister DB expects int for coordinates
+        for d in ['x', 'y', 'z']:
+            synapses[d] = to_int(synapses, d)
+        read.items = len(synapses)
+
+        # in order of first occurrence
+        neurotransmitters, _, nt_codes = synapses.factorize('neurotransmitter')
+        _, _, skeleton_codes = synapses.factorize('skeleton_id')
+        synapse_counts = np.bincount(nt_codes, minlength=len(neurotransmitters))
+        nt_skeletons = np.unique(
+            nt_codes * (skeleton_codes.max(initial=0) + 1) + skeleton_codes)
+        skeleton_counts = np.bincount(
+            nt_skeletons // (skeleton_codes.max(initial=0) + 1),
+            minlength=len(neurotransmitters))
 
     # filter underrepresented neurotransmitters
-    neurotransmitter_counts = defaultdict(lambda: {"synapse": 0, "skeleton": set()})
-    for synapse in synapses:
-        counts = neurotransmitter_counts[synapse["neurotransmitter"]]
-        counts["synapse"] += 1
-        counts["skeleton"].add(synapse["skeleton_id"])
-
-    for nt in neurotransmitter_counts.keys():
-        neurotransmitter_counts[nt]["skeleton"] = len(neurotransmitter_counts[nt]["skeleton"])
+    neurotransmitter_counts = {
+        nt: {"synapse": int(synapse_counts[i]), "skeleton": int(skeleton_counts[i])}
+        for i, nt in enumerate(neurotransmitters)
+    }
     print("Neurotransmitter counts")
     print(neurotransmitter_counts)
 
-    accepted_neurotransmitters = []
-    for nt, c in neurotransmitter_counts.items():
+    accepted = np.zeros(len(neurotransmitters), dtype=bool)
+    for i, (nt, c) in enumerate(neurotransmitter_counts.items()):
         if c["synapse"] >= NT_SYNAPSES_THRESHOLD and c["skeleton"] >= NT_SKELETONS_THRESHOLD:
-            accepted_neurotransmitters.append(nt)
+            accepted[i] = True
         else:
             print(f"Excluding {nt}")
 
-    filtered_synapses = []
-    for synapse in synapses:
-        if synapse['neurotransmitter'] not in accepted_neurotransmitters:
-            print(f"Skipping {synapse} with filtered neurotransmitter")
-            continue
-        filtered_synapses.append(synapse)
-    synapses = filtered_synapses
+    with stage('nt_filter', len(synapses)):
+        keep = accepted[nt_codes]
+        filtered = np.flatnonzero(~keep)
+        diagnostics.record_many(
+            diagnostics.FILTERED_NT,
+            len(filtered),
+            lambda i: synapses.row(filtered[i]))
+        count('filtered', len(filtered))
+        print(
+            f"Skipped {len(filtered)}/{len(synapses)} synapses "
+            "with filtered neurotransmitter")
+        synapses = synapses.select(keep)
 
     return synapses
 
 
-def ingest_synapses(synapses, db):
+def differs_from_first(synapses):
+    """For each synapse, whether it differs from the first synapse with the
+    same ID, compared as dicts. Only synapses with a repeated ID are
+    compared."""
+
+    _, id_codes, id_counts = np.unique(
+        synapses['synapse_id'],
+        return_inverse=True,
+        return_counts=True)
+    id_codes = id_codes.reshape(-1)
+    repeated = np.flatnonzero(id_counts[id_codes] > 1)
+
+    differs = np.zeros(len(synapses), dtype=bool)
+    first = {}
+    for index, id_code, synapse in zip(
+            repeated.tolist(),
+            id_codes[repeated].tolist(),
+            synapses.select(repeated).to_documents()):
+        reference = first.setdefault(id_code, synapse)
+        differs[index] = synapse != reference
+
+    return differs
+
+
+def find_duplicates(synapse_ids, differs):
+    """Group synapses by ID with a single sort.
+
+    ``differs`` marks synapses that differ from the first synapse of their
+    ID (see ``differs_from_first``), duplicates of an ID are identical if
+    none of them differs. Returns a dict with ``retain``, the sorted indices
+    of synapses to keep (unique IDs and the first of each group of identical
+    duplicates), and for ``identical`` and ``conflicting`` duplicates the
+    ``ids``, ``counts`` and ``starts`` of each group, such that
+    ``order[start:start + count]`` are the indices of the group's synapses.
+    """
+
+    order = np.argsort(synapse_ids, kind='stable')
+    sorted_ids = synapse_ids[order]
+    sorted_differs = differs[order]
+
+    is_start = np.ones(len(order), dtype=bool)
+    is_start[1:] = sorted_ids[1:] != sorted_ids[:-1]
+    starts = np.flatnonzero(is_start)
+    counts = np.diff(np.append(starts, len(order)))
+
+    if len(order) > 0:
+        same_content = ~np.logical_or.reduceat(sorted_differs, starts)
+    else:
+        same_content = np.ones(0, dtype=bool)
+
+    multiple = counts > 1
+    is_identical = multiple & same_content
+    is_conflicting = multiple & ~same_content
+
+    # stable sort: the first index of each group is its first occurrence
+    retain = np.sort(order[starts[~is_conflicting]])
+
+    def groups(mask):
+        return {
+            'ids': sorted_ids[starts[mask]],
+            'counts': counts[mask],
+            'starts': starts[mask]
+        }
+
+    return {
+        'num_duplicate_ids': int(multiple.sum()),
+        'identical': groups(is_identical),
+        'conflicting': groups(is_conflicting),
+        'retain': retain,
+        'order': order
+    }
+
+
+def ingest_synapses(synapses, db, writer, previous=None):
 
     # check for duplicate IDs
-    synapse_ids = np.array([
-        synapse['synapse_id']
-        for synapse in synapses])
-    ids, unique_idxs, inverse_idxs, counts = np.unique(
-        synapse_ids, return_index=True, return_inverse=True, return_counts=True)
-    multiple = (counts > 1)
-    duplicate_ids = ids[multiple]
-    duplicate_ids_idxs = unique_idxs[multiple]
-    duplicate_counts = counts[multiple]
-    nonduplicated_idxs = unique_idxs[~multiple]
-
-    if len(duplicate_ids) > 0:
-        print(f"Found {len(duplicate_ids)} duplicate synapse IDs")
-
-        # Find identical duplicates.
-        identical_duplicates = np.empty(len(ids), dtype=bool)
-        identical_duplicates[multiple] = True
-        for uniq_idx, s in zip(inverse_idxs, synapses):
-            if not identical_duplicates[uniq_idx]:
-                continue
-            reference = synapses[unique_idxs[uniq_idx]]
-            identical_duplicates[uniq_idx] = reference == s
-        identical_duplicates = identical_duplicates[multiple]
-        identical_reference_ids = duplicate_ids_idxs[identical_duplicates]
-
-        def print_duplicates(ids, counts):
-            for duplicate, count in zip(ids, counts):
-                print(f"{duplicate} repeats {count} times:")
-                indices = (synapse_ids == duplicate).nonzero()[0]
-                for index in indices:
-                    print(synapses[index])
-
-        print(f"Of these, {sum(identical_duplicates)} IDs are identical and will be deduplicated:")
-        print("(showing at most 100)")
-        print_duplicates(
-            duplicate_ids[identical_duplicates][:100],
-            duplicate_counts[identical_duplicates][:100])
-
-        print(f"The remaining {sum(~identical_duplicates)} IDs are not identical and will be removed:")
-        print("(showing at most 100)")
-        print_duplicates(
-            duplicate_ids[~identical_duplicates][:100],
-            duplicate_counts[~identical_duplicates][:100])
-
-        # Deduplicate identical duplicates and remove non-identical duplicates.
-        num_deduplicated = sum(duplicate_counts[identical_duplicates]) - len(identical_reference_ids)
-        print(f"Removing {num_deduplicated} identical duplicated synapses.")
-        print(len(synapses))
-        retain_mask = np.zeros(len(synapse_ids), dtype=bool)
-        retain_mask[nonduplicated_idxs] = True
-        retain_mask[identical_reference_ids] = True
-        synapses = np.asarray(synapses)[retain_mask].tolist()
-        print(len(synapses))
+    with stage('dedup', len(synapses)):
+        duplicates = find_duplicates(
+            synapses['synapse_id'],
+            differs_from_first(synapses))
+        identical = duplicates['identical']
+        conflicting = duplicates['conflicting']
+
+        if duplicates['num_duplicate_ids'] > 0:
+            print(f"Found {duplicates['num_duplicate_ids']} duplicate synapse IDs")
+
+            def record_duplicates(kind, groups):
+                # the synapses of a group are only collected if it is sampled
+                diagnostics.record_many(
+                    kind,
+                    len(groups['ids']),
+                    lambda i: {
+                        'synapse_id': groups['ids'][i:i + 1].tolist()[0],
+                        'count': int(groups['counts'][i]),
+                        'synapses': [
+                            synapses.row(index)
+                            for index in duplicates['order'][
+                                groups['starts'][i]:
+                                groups['starts'][i] + groups['counts'][i]]
+                        ]
+                    })
+
+            print(f"Of these, {len(identical['ids'])} IDs are identical and will be deduplicated.")
+            record_duplicates(diagnostics.DUPLICATE, identical)
+
+            print(f"The remaining {len(conflicting['ids'])} IDs are not identical and will be removed.")
+            record_duplicates(diagnostics.CONFLICTING_DUPLICATE, conflicting)
+
+            # Deduplicate identical duplicates and remove non-identical duplicates.
+            num_deduplicated = identical['counts'].sum() - len(identical['ids'])
+            print(f"Removing {num_deduplicated} identical duplicated synapses.")
+            print(len(synapses))
+            count('duplicate_ids', duplicates['num_duplicate_ids'])
+            count('removed', len(synapses) - len(duplicates['retain']))
+            synapses = synapses.select(duplicates['retain'])
+            print(len(synapses))
 
 
     # hemi_lineage_id, hemi_lineage_name
 
-    hemi_lineages = {}
-    hemi_lineage_id = 0
-    for synapse in synapses:
-        hemi_lineage_name = synapse['hemilineage']
-        if hemi_lineage_name not in hemi_lineages:
-            hemi_lineages[hemi_lineage_name] = {
+    # keep the IDs of already ingested hemi lineages
+    previous_hemi_lineage_ids = {}
+    if previous is not None:
+        previous_hemi_lineage_ids = {
+            name: hemi_lineage['hemi_lineage_id']
+            for name, hemi_lineage in previous['hemi_lineages'].items()
+        }
+
+    with stage('hemi_lineages', len(synapses)):
+        hemi_lineage_names, _, hemi_lineage_codes = synapses.factorize('hemilineage')
+        hemi_lineages = []
+        hemi_lineage_id = max(previous_hemi_lineage_ids.values(), default=-1) + 1
+        for hemi_lineage_name in hemi_lineage_names:
+            if hemi_lineage_name in previous_hemi_lineage_ids:
+                hemi_lineages.append({
+                    **db.hemi_lineage,
+                    'hemi_lineage_name': hemi_lineage_name,
+                    'hemi_lineage_id': previous_hemi_lineage_ids[hemi_lineage_name]
+                })
+                continue
+            hemi_lineages.append({
                 **db.hemi_lineage,
                 'hemi_lineage_name': hemi_lineage_name,
                 'hemi_lineage_id': hemi_lineage_id
-            }
+            })
             hemi_lineage_id += 1
-    synister_hemi_lineages = list(hemi_lineages.values())
+        synister_hemi_lineages = hemi_lineages
 
     # skeleton_id, hemi_lineage_id, nt_known, type=None, match=None, quality=None
 
-    skeletons = {}
-    for synapse in synapses:
-        skeleton_id = synapse["skeleton_id"]
-        if skeleton_id not in skeletons:
-            skeletons[skeleton_id] = {
+    with stage('skeletons', len(synapses)):
+        # from the first synapse of each skeleton
+        skeleton_ids, first, _ = synapses.factorize('skeleton_id')
+        first_synapses = synapses.select(first)
+        synister_skeletons = [
+            {
                 **db.skeleton,
                 'skeleton_id': skeleton_id,
-                'hemi_lineage_id': hemi_lineages[synapse['hemilineage']]['hemi_lineage_id'],
-                'nt_known': [synapse['neurotransmitter']]
+                'hemi_lineage_id': hemi_lineages[hemi_lineage_code]['hemi_lineage_id'],
+                'nt_known': [neurotransmitter]
             }
-    synister_skeletons = list(skeletons.values())
+            for skeleton_id, hemi_lineage_code, neurotransmitter in zip(
+                skeleton_ids,
+                hemi_lineage_codes[first].tolist(),
+                first_synapses.values('neurotransmitter'))
+        ]
 
     # write to DB
 
-    db.write(
-        synapses=synapses,
-        skeletons=synister_skeletons,
-        hemi_lineages=synister_hemi_lineages)
+    # to find changed synapses in later incremental ingests
+    with stage('content_hash', len(synapses)):
+        content_hashes = np.empty(len(synapses), dtype=object)
+        content_hashes[:] = [
+            content_hash(synapse)
+            for synapse in synapses.to_documents()
+        ]
+        synapses['content_hash'] = content_hashes
+
+    with stage('write', len(synapses)):
+        # documents are only created here, a chunk at a time
+        if previous is not None:
+            update_database(
+                writer,
+                previous,
+                synapses=synapses,
+                skeletons=synister_skeletons,
+                hemi_lineages=synister_hemi_lineages)
+            return
+
+        writer.write(
+            synapses=synapses,
+            skeletons=synister_skeletons,
+            hemi_lineages=synister_hemi_lineages)
+
+
+def create_split_lookups(synapses, split_attribute):
+
+    def unique(values):
+        # sorted distinct values, and the index of each value among them
+        if isinstance(values, Categorical):
+            # categories are sorted, and so are their codes
+            codes, inverse = np.unique(values.codes, return_inverse=True)
+            return values.categories[codes].tolist(), inverse.reshape(-1)
+        uniques, inverse = np.unique(np.ma.getdata(values), return_inverse=True)
+        return uniques.tolist(), inverse.reshape(-1)
+
+    missing_attribute = synapses.is_missing(split_attribute)
+    missing_nt = ~missing_attribute & synapses.is_missing('neurotransmitter')
+    skipped_attribute = int(np.count_nonzero(missing_attribute))
+    skipped_nt = int(np.count_nonzero(missing_nt))
+    rows = np.flatnonzero(~missing_attribute & ~missing_nt)
+
+    # a repeated synapse ID keeps the position of its first and the values of
+    # its last occurrence
+    ids = synapses['synapse_id'][rows]
+    _, first = np.unique(ids, return_index=True)
+    _, last = np.unique(ids[::-1], return_index=True)
+    last = len(ids) - 1 - last
+    order = np.argsort(first, kind='stable')
+    synapse_ids = ids[first[order]]
+    selected = synapses.select(rows[last[order]])
+
+    # splits are computed on superset and neurotransmitter codes, i.e.,
+    # indices into the sorted unique values
+    supersets, superset_codes = unique(selected[split_attribute])
+    neurotransmitters, nt_codes = unique(selected['neurotransmitter'])
+
+    # NT -> indices of its synapses
+    order = np.argsort(nt_codes, kind='stable')
+    boundaries = np.searchsorted(
+        nt_codes[order],
+        np.arange(len(neurotransmitters) + 1))
+    nt_partitions = [
+        order[begin:end]
+        for begin, end in zip(boundaries[:-1], boundaries[1:])
+    ]
+
+    return {
+        'num_synapses': len(synapses),
+        'skipped_attribute': skipped_attribute,
+        'skipped_nt': skipped_nt,
+        'synapse_ids': synapse_ids,
+        'supersets': supersets,
+        'superset_codes': superset_codes,
+        'neurotransmitters': neurotransmitters,
+        'nt_codes': nt_codes,
+        'nt_partitions': nt_partitions
+    }
+
+
+# lookups by split attribute, shared by all splits computed in a process
+split_lookups = {}
+
+
+def init_split_worker(lookups, profiling_options):
+
+    global split_lookups
+    split_lookups = lookups
+    if profiling_options is not None:
+        instrumentation.enable_profiling(*profiling_options)
+
+
+def compute_split(
+        split_name,
+        split_attribute,
+        test_fraction,
+        validation_fraction,
+        max_deviation=None):
+
+    # run in a worker, collect the output and stages to show them in order
+    instrumentation.reset()
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), stage(f'split:{split_name}'):
+        split = create_synapse_split(
+            split_lookups[split_attribute],
+            split_attribute,
+            split_name,
+            test_fraction=test_fraction,
+            validation_fraction=validation_fraction,
+            max_deviation=max_deviation)
+    return split, output.getvalue(), instrumentation.results()
+
+
+def compute_splits(synapses, split_specs, num_workers, max_deviation=None):
+    """Compute several splits concurrently.
+
+    ``split_specs`` is a list of ``(split_name, split_attribute,
+    test_fraction, validation_fraction)``. The lookup tables are built once
+    per split attribute and shared by all splits on that attribute. Returns
+    a dict from split name to ``(train, test, validation)`` synapse IDs, or
+    ``None`` if a split could not be created. See ``--max-split-deviation``
+    for ``max_deviation``.
+    """
+
+    lookups = {}
+    for split_attribute in set(spec[1] for spec in split_specs):
+        with stage(f'lookups:{split_attribute}', len(synapses)):
+            lookups[split_attribute] = create_split_lookups(
+                synapses,
+                split_attribute)
+
+    with ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=init_split_worker,
+            initargs=(lookups, instrumentation.profiling_options())) as pool:
+
+        futures = [
+            pool.submit(compute_split, *split_spec, max_deviation)
+            for split_spec in split_specs
+        ]
+
+        splits = {}
+        for (split_name, *_), future in zip(split_specs, futures):
+            split, output, results = future.result()
+            print(output, end='')
+            instrumentation.merge(results)
+            splits[split_name] = split
+
+    return splits
 
 
 def create_synapse_split(
-        synapses,
+        lookups,
         split_attribute,
         split_name,
         test_fraction,
-        validation_fraction):
+        validation_fraction,
+        max_deviation=None):
 
     print()
     print()
-    print(f"Creating split by {split_attribute}, test fraction = "
+    print(f"Creating split {split_name} by {split_attribute}, test fraction = "
           f"{test_fraction}, validation fraction = {validation_fraction}...")
 
-    skipped_attribute = 0
-    skipped_nt = 0
-    nt_by_synapse_id = {}
-    superset_by_synapse_id = {}
-    for synapse in synapses:
-        if synapse[split_attribute] is None:
-            skipped_attribute += 1
-            continue
-        if synapse['neurotransmitter'] is None:
-            skipped_nt += 1
-            continue
-        synapse_id = synapse['synapse_id']
-        attribute = synapse[split_attribute]
-        neurotransmitter = synapse['neurotransmitter']
-        nt_by_synapse_id[synapse_id] = (neurotransmitter,)  # synister wants a tuple
-        superset_by_synapse_id[synapse_id] = attribute
-
-    supersets = list(set(superset_by_synapse_id.values()))
-    neurotransmitters = list(set(nt_by_synapse_id.values()))
-    synapse_ids = list(nt_by_synapse_id.keys())
+    num_synapses = lookups['num_synapses']
+    skipped_attribute = lookups['skipped_attribute']
+    skipped_nt = lookups['skipped_nt']
+    supersets = lookups['supersets']
+    synapse_ids = lookups['synapse_ids']
 
     print()
     print(f"Found {len(supersets)} different values for {split_attribute}")
@@ -301,189 +570,337 @@ def create_synapse_split(
         print(supersets)
     else:
         print(f"{supersets[:100]} (and {len(supersets) - 100} more...)")
-    print(f"Skipped {skipped_attribute}/{len(synapses)} synapses without a "
+    print(f"Skipped {skipped_attribute}/{num_synapses} synapses without a "
           f"'{split_attribute}' attribute")
-    print(f"Skipped {skipped_nt}/{len(synapses)} synapses without a "
+    print(f"Skipped {skipped_nt}/{num_synapses} synapses without a "
           "'neurotransmitter' attribute")
-    print(f"Found neurotransmitters {list([n[0] for n in neurotransmitters])}")
+    print(f"Found neurotransmitters {lookups['neurotransmitters']}")
 
-    if not synapse_ids:
+    if len(synapse_ids) == 0:
         print("No synapses left with the required attributes, skipping split")
         return
 
-    train_validation_synapse_ids, test_synapse_ids, neurotransmitters, synapse_split_nts = find_optimal_split_or_fallback(
-        synapse_ids=synapse_ids,
-        superset_by_synapse_id=superset_by_synapse_id,
-        nt_by_synapse_id=nt_by_synapse_id,
-        supersets=supersets,
-        neurotransmitters=neurotransmitters,
-        synapse_split_nts=[],
-        set_b_fraction=test_fraction,
-        set_a_name="(train ∪ validation)",
-        set_b_name="test",
-        split_attribute=split_attribute,
-    )
-
-    train_synapse_ids, validation_synapse_ids, neurotransmitters, synapse_split_nts = find_optimal_split_or_fallback(
-        synapse_ids=train_validation_synapse_ids,
-        superset_by_synapse_id=superset_by_synapse_id,
-        nt_by_synapse_id=nt_by_synapse_id,
-        supersets=supersets,
-        neurotransmitters=neurotransmitters,
-        synapse_split_nts=synapse_split_nts,
-        set_b_fraction=validation_fraction,
-        set_a_name="train",
-        set_b_name="validation",
-        split_attribute=split_attribute,
-    )
-
-    # store split in DB
-
-    db.make_split(
-       split_name,
-       train_synapse_ids,
-       test_synapse_ids,
-       validation_synapse_ids)
+    # splits are computed on indices into the lookup arrays, and only turned
+    # into synapse IDs at the end
+    neurotransmitters = list(range(len(lookups['neurotransmitters'])))
+    solver_inputs = create_solver_inputs(lookups)
+
+    with stage('test', len(synapse_ids)):
+        train_validation_idxs, test_idxs, neurotransmitters, synapse_split_nts = find_optimal_split_or_fallback(
+            lookups=lookups,
+            solver_inputs=solver_inputs,
+            synapse_idxs=np.arange(len(synapse_ids)),
+            neurotransmitters=neurotransmitters,
+            synapse_split_nts=[],
+            set_b_fraction=test_fraction,
+            set_a_name="(train ∪ validation)",
+            set_b_name="test",
+            split_attribute=split_attribute,
+            max_deviation=max_deviation,
+        )
+
+    with stage('validation', len(train_validation_idxs)):
+        train_idxs, validation_idxs, neurotransmitters, synapse_split_nts = find_optimal_split_or_fallback(
+            lookups=lookups,
+            solver_inputs=solver_inputs,
+            synapse_idxs=train_validation_idxs,
+            neurotransmitters=neurotransmitters,
+            synapse_split_nts=synapse_split_nts,
+            set_b_fraction=validation_fraction,
+            set_a_name="train",
+            set_b_name="validation",
+            split_attribute=split_attribute,
+            max_deviation=max_deviation,
+        )
 
     return (
-        train_synapse_ids,
-        test_synapse_ids,
-        validation_synapse_ids)
+        synapse_ids[train_idxs].tolist(),
+        synapse_ids[test_idxs].tolist(),
+        synapse_ids[validation_idxs].tolist())
+
+
+def create_solver_inputs(lookups):
+
+    # synister's solver works on synapse IDs, with the superset and a tuple of
+    # NTs per synapse
+    synapse_ids = lookups['synapse_ids'].tolist()
+    supersets = np.array(lookups['supersets'] + [None], dtype=object)[:-1]
+    nt_keys = [(nt_name,) for nt_name in lookups['neurotransmitters']]
+
+    return {
+        'nt_keys': nt_keys,
+        'index_by_synapse_id': dict(zip(synapse_ids, range(len(synapse_ids)))),
+        'superset_by_synapse_id': dict(zip(
+            synapse_ids,
+            supersets[lookups['superset_codes']].tolist())),
+        'nt_by_synapse_id': dict(zip(
+            synapse_ids,
+            [nt_keys[nt] for nt in lookups['nt_codes'].tolist()]))
+    }
+
+
+def partition_by_nt(lookups, synapse_idxs):
+
+    # restrict the NT partitions to the given synapses, keeping their order
+    selected = np.zeros(len(lookups['synapse_ids']), dtype=bool)
+    selected[synapse_idxs] = True
+    return [
+        partition[selected[partition]]
+        for partition in lookups['nt_partitions']
+    ]
 
 
 def find_optimal_split_or_fallback(
-        synapse_ids,
-        superset_by_synapse_id,
-        nt_by_synapse_id,
-        supersets,
+        lookups,
+        solver_inputs,
+        synapse_idxs,
         neurotransmitters,
         synapse_split_nts,
         set_b_fraction,
         set_a_name,
         set_b_name,
         split_attribute,
+        max_deviation=None,
     ):
-        resplit = True
-
-        while resplit:
-            resplit = False
-            try:
-
-                print()
-                print(f"Creating {set_a_name} / {set_b_name} split, "
-                    f"objective is {1.0 - set_b_fraction}/{set_b_fraction}:")
-                filtered_synapse_ids = [sid for sid in synapse_ids if nt_by_synapse_id[sid] in neurotransmitters]
-
-                if set_b_fraction <= 0.0:
-
-                    print(f"({set_b_name} fraction is 0, no need to split)")
-                    a_set_synapse_ids = filtered_synapse_ids
-                    b_set_synapse_ids = []
-
-                elif set_b_fraction >= 1.0:
+        nt_names = lookups['neurotransmitters']
+        superset_codes = lookups['superset_codes']
 
-                    print(f"({set_b_name} fraction is 1, no need to split)")
-                    a_set_synapse_ids = []
-                    b_set_synapse_ids = filtered_synapse_ids
+        partitions = partition_by_nt(lookups, synapse_idxs)
+        a_set_idxs = []
+        b_set_idxs = []
 
-                else:
+        def fall_back(nt, reason):
 
-                    a_set, b_set = find_optimal_split(
-                        synapse_ids=filtered_synapse_ids,
-                        superset_by_synapse_id=superset_by_synapse_id,
-                        nt_by_synapse_id=nt_by_synapse_id,
-                        neurotransmitters=neurotransmitters,
-                        supersets=supersets,
-                        train_fraction=1.0 - set_b_fraction)
+            print()
+            print(
+                f"\tWARNING: failed to create optimal split for {nt_names[nt]} on "
+                f"attribute {split_attribute}!")
+            print(f"\t{reason}")
+            print()
+            print(f"\tFalling back to {set_a_name} / {set_b_name} split on {nt_names[nt]} synapses")
+            print()
 
-                    a_set_synapse_ids = list(itertools.chain(*a_set.values()))
-                    b_set_synapse_ids = list(itertools.chain(*b_set.values()))
+            neurotransmitters.remove(nt)
+            synapse_split_nts.append(nt)
+            count('fallbacks')
 
-            except ImpossibleSplit as e:
+        print()
+        print(f"Creating {set_a_name} / {set_b_name} split, "
+            f"objective is {1.0 - set_b_fraction}/{set_b_fraction}:")
 
-                print()
-                print(
-                    f"\tWARNING: failed to create optimal split for {e.nt} on "
-                    f"attribute {split_attribute}!")
-                print(
-                    f"\toptimal fraction {e.optimal_fraction} deviates too far from "
-                    f"target {e.target_fraction}")
-                print()
-                print(f"\tFalling back to {set_a_name} / {set_b_name} split on {e.nt} synapses")
-                print()
+        if set_b_fraction <= 0.0:
 
-                resplit = True
-                neurotransmitters.remove(e.nt)
-                synapse_split_nts.append(e.nt)
+            print(f"({set_b_name} fraction is 0, no need to split)")
+            a_set_idxs += [partitions[nt] for nt in neurotransmitters]
 
+        elif set_b_fraction >= 1.0:
 
-        for nt in synapse_split_nts:
+            print(f"({set_b_name} fraction is 1, no need to split)")
+            b_set_idxs += [partitions[nt] for nt in neurotransmitters]
 
-            synapse_ids = [
-                synapse_id
-                for synapse_id, _nt in nt_by_synapse_id.items()
-                if _nt == nt
-            ]
+        else:
 
-            random.seed(19120623)
-            random.shuffle(synapse_ids)
-            split_index = int((1.0 - set_b_fraction) * len(synapse_ids))
-            a_set_synapse_ids += synapse_ids[:split_index]
-            b_set_synapse_ids += synapse_ids[split_index:]
+            train_fraction = 1.0 - set_b_fraction
+
+            if max_deviation is not None:
+
+                # an NT is split by whole supersets, so the set that gets its
+                # largest superset has at least that superset's share of its
+                # synapses
+                for nt in list(neurotransmitters):
+                    counts = np.bincount(superset_codes[partitions[nt]])
+                    if len(counts) == 0:
+                        continue
+                    largest = counts.max() / counts.sum()
+                    deviation = largest - max(train_fraction, set_b_fraction)
+                    if deviation > max_deviation:
+                        fall_back(
+                            nt,
+                            f"largest {split_attribute} has {largest:.3f} of its "
+                            f"synapses, fraction deviates at least {deviation:.3f} "
+                            f"from target {train_fraction}")
+
+            with stage('optimizer', len(synapse_idxs)):
+
+                nt_keys = solver_inputs['nt_keys']
+                index_by_synapse_id = solver_inputs['index_by_synapse_id']
+
+                # synapse IDs per NT, so that a retry only drops the partition
+                # of the NT that could not be split
+                partition_ids = {
+                    nt: lookups['synapse_ids'][partitions[nt]].tolist()
+                    for nt in neurotransmitters
+                }
+
+                while neurotransmitters:
+
+                    try:
+                        a_set, b_set = find_optimal_split(
+                            synapse_ids=list(itertools.chain.from_iterable(
+                                partition_ids[nt] for nt in neurotransmitters)),
+                            superset_by_synapse_id=solver_inputs['superset_by_synapse_id'],
+                            nt_by_synapse_id=solver_inputs['nt_by_synapse_id'],
+                            neurotransmitters=[nt_keys[nt] for nt in neurotransmitters],
+                            supersets=lookups['supersets'],
+                            train_fraction=train_fraction)
+                    except ImpossibleSplit as e:
+                        fall_back(
+                            nt_keys.index(e.nt),
+                            f"optimal fraction {e.optimal_fraction} deviates too far "
+                            f"from target {e.target_fraction}")
+                        continue
+
+                    for set_idxs, found in [(a_set_idxs, a_set), (b_set_idxs, b_set)]:
+                        set_idxs.append(np.array(
+                            [
+                                index_by_synapse_id[synapse_id]
+                                for synapse_id in itertools.chain(*found.values())
+                            ],
+                            dtype=np.int64))
+                    break
+
+        with stage(
+                'random_split',
+                sum(len(partitions[nt]) for nt in synapse_split_nts)):
+            for nt in synapse_split_nts:
+
+                # only the given synapses of this NT are split
+                nt_synapse_idxs = partitions[nt].tolist()
+                if not nt_synapse_idxs:
+                    continue
+
+                random.seed(19120623)
+                random.shuffle(nt_synapse_idxs)
+                split_index = int((1.0 - set_b_fraction) * len(nt_synapse_idxs))
+                a_set_idxs.append(np.array(nt_synapse_idxs[:split_index], dtype=np.int64))
+                b_set_idxs.append(np.array(nt_synapse_idxs[split_index:], dtype=np.int64))
 
-            print(
-                f"Split {nt} randomly per synapse into "
-                f"{split_index}/{len(synapse_ids)} = "
-                f"{100.0 * split_index/len(synapse_ids)}%")
+                print(
+                    f"Split {nt_names[nt]} randomly per synapse into "
+                    f"{split_index}/{len(nt_synapse_idxs)} = "
+                    f"{100.0 * split_index/len(nt_synapse_idxs)}%")
 
-        return a_set_synapse_ids, b_set_synapse_ids, neurotransmitters, synapse_split_nts
+        empty = np.zeros(0, dtype=np.int64)
+        return (
+            np.concatenate([empty] + a_set_idxs),
+            np.concatenate([empty] + b_set_idxs),
+            neurotransmitters,
+            synapse_split_nts)
 
 if __name__ == '__main__':
 
     args = parser.parse_args()
     dataset = DATASETS[args.dataset]
 
+    if args.profile is not None:
+        instrumentation.enable_profiling(args.profile, args.profiler)
+    if args.diagnostics_detail is not None:
+        diagnostics.enable_detail(args.diagnostics_detail)
+
     db = SynisterDb(args.credentials, dataset["db_name"])
-    db.create(overwrite=True)
+    if not args.incremental:
+        db.create(overwrite=True)
+
+    writer = BulkWriter(
+        get_database(args.credentials, dataset["db_name"]),
+        chunk_size=args.chunk_size,
+        num_workers=args.num_workers,
+        synister_db=db)
+
+    if args.incremental:
+        previous = read_state(writer.database)
+    else:
+        previous = None
+        # synister's indexes are rebuilt after loading, instead of updated on
+        # every insert
+        writer.drop_indexes()
 
-    synapses = read_synapses(dataset['files'], dataset['voxel_size'])
+    with stage('read_synapses') as read:
+        synapses = read_synapses(dataset['files'], dataset['voxel_size'])
+        read.items = len(synapses)
 
-    ingest_synapses(synapses, db)
+    with stage('ingest_synapses', len(synapses)):
+        ingest_synapses(synapses, db, writer, previous)
+
+    if not args.incremental:
+        with stage('create_indexes'):
+            writer.create_indexes()
 
     has_holdout = "holdout_files" in dataset
     if has_holdout:
-        holdout_synapses = read_synapses(dataset['holdout_files'], dataset['voxel_size'])
-        holdout_synapse_ids = set(s["synapse_id"] for s in holdout_synapses)
-        original_len = len(synapses)
-        synapses = [s for s in synapses if not s["synapse_id"] in holdout_synapse_ids]
-        print(f"Excluded {original_len - len(synapses)}/{original_len} holdout synapses.")
-
-    db.init_splits()
-
-    create_synapse_split(
-        synapses,
-        'skeleton_id',
-        'skeleton',
-        test_fraction=dataset['test_fraction'],
-        validation_fraction=dataset['validation_fraction'])
-
-    snt_splits = create_synapse_split(
-        synapses,
-        'skeleton_id',
-        'skeleton_no_test',
-        test_fraction=0.0,
-        validation_fraction=dataset['validation_fraction'])
+        with stage('holdout'):
+            holdout_synapses = read_synapses(dataset['holdout_files'], dataset['voxel_size'])
+            holdout_synapse_ids = set(holdout_synapses.values("synapse_id"))
+            original_len = len(synapses)
+            synapses = synapses.select(~np.isin(
+                synapses["synapse_id"],
+                holdout_synapses["synapse_id"]))
+            print(f"Excluded {original_len - len(synapses)}/{original_len} holdout synapses.")
+
+    if not args.incremental:
+        db.init_splits()
+
+    # (split_name, split_attribute, test_fraction, validation_fraction)
+    split_specs = [
+        ('skeleton', 'skeleton_id', dataset['test_fraction'], dataset['validation_fraction']),
+        ('skeleton_no_test', 'skeleton_id', 0.0, dataset['validation_fraction']),
+        ('brain_region', 'brain_region', dataset['test_fraction'], dataset['validation_fraction']),
+    ]
 
-    if has_holdout:
-        snt_splits[0].extend(holdout_synapse_ids)
-        db.make_split(
-            "skeleton_no_test_including_holdout",
-            *snt_splits,
+    with stage('splits', len(synapses)):
+        if args.incremental:
+            splits = {}
+            for split_name, split_attribute, test_fraction, validation_fraction in split_specs:
+                with stage(f'split:{split_name}'):
+                    splits[split_name] = update_synapse_split(
+                        synapses,
+                        split_attribute,
+                        split_name,
+                        previous,
+                        test_fraction=test_fraction,
+                        validation_fraction=validation_fraction)
+        else:
+            splits = compute_splits(
+                synapses,
+                split_specs,
+                args.split_workers,
+                args.max_split_deviation)
+
+    snt_splits = splits['skeleton_no_test']
+    if has_holdout and snt_splits is not None:
+        splits["skeleton_no_test_including_holdout"] = (
+            snt_splits[0] + list(holdout_synapse_ids),
+            *snt_splits[1:],
         )
 
-    create_synapse_split(
-        synapses,
-        'brain_region',
-        'brain_region',
-        test_fraction=dataset['test_fraction'],
-        validation_fraction=dataset['validation_fraction'])
+    # write all splits in one go
+    unassigned = {}
+    if args.incremental:
+        splits, unassigned = changed_split_assignments(splits, previous)
+    splits = {
+        split_name: split
+        for split_name, split in splits.items()
+        if split is not None
+    }
+
+    with stage('write_splits') as write:
+        writer.write_splits(splits, unassigned)
+        write.items = sum(
+            len(synapse_ids)
+            for split in splits.values()
+            for synapse_ids in split) + sum(
+                len(synapse_ids)
+                for synapse_ids in unassigned.values())
+
+    print()
+    diagnostics.print_summary()
+    if args.diagnostics is not None:
+        diagnostics.write_report(args.diagnostics)
+
+    print()
+    instrumentation.print_summary()
+    if args.report is not None:
+        instrumentation.write_report(
+            args.report,
+            dataset=args.dataset,
+            incremental=args.incremental)
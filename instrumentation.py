@@ -0,0 +1,349 @@
+"""Per-stage timing and memory instrumentation.
+
+Stages are named blocks of code, which can be nested::
+
+    from instrumentation import count, stage
+
+    with stage('read') as s:
+        synapses = read(...)
+        s.items = len(synapses)
+        count('skipped', num_skipped)
+
+For each stage, the wall time, CPU time (of this process and of its
+finished child processes), peak resident memory and number of processed
+items are recorded. Nested stages are named by their path (e.g.,
+``ingest/dedup``), repeated stages are accumulated. ``count`` adds to named
+counters of the innermost stage. ``write_report`` writes all of it as JSON.
+
+Stages should only be entered from the main thread of a process. Stages of
+worker processes are recorded there and can be added to the report of the
+parent with ``merge(results())``.
+
+Profiling: with ``enable_profiling(directory)``, every outermost stage is
+run under ``cProfile`` and its statistics are written to
+``<directory>/<stage>.prof`` (for ``pstats``, ``snakeviz``, ...). With
+``profiler='py-spy'``, a ``py-spy record`` process is attached to this
+process for the duration of each outermost stage instead, writing a
+``<stage>.speedscope.json`` profile (needs ``py-spy`` and permission to
+ptrace this process). The report also contains the PID and the start and end
+times of each stage, to match externally recorded samples to stages.
+"""
+import contextlib
+import cProfile
+import datetime
+import json
+import os
+import re
+import resource
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+PROFILERS = ['cprofile', 'py-spy']
+
+
+def current_rss():
+
+    # in bytes, from /proc where available
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # peak so far, in KiB on Linux (bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def children_cpu_time():
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Stage:
+    """A running (or finished) stage, as returned by ``stage``."""
+
+    def __init__(self, name, items):
+
+        self.name = name
+        self.items = items
+        self.peak_rss = current_rss()
+        self.wall_time = None
+        self.cpu_time = None
+        self.children_cpu_time = None
+        self.counters = {}
+
+
+class Recorder:
+    """Collects the results of stages, see the module documentation."""
+
+    def __init__(self, interval=0.01):
+
+        self.interval = interval
+        self.profile_dir = None
+        self.profiler = None
+        self.sampler_pid = None
+        self.reset()
+
+    def reset(self):
+
+        self.started = time.time()
+        self.results = {}
+        self.counters = {}
+        self.active = []
+        self.profiles = {}
+
+    def enable_profiling(self, directory, profiler='cprofile'):
+
+        if profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler {profiler}, use one of {PROFILERS}")
+        os.makedirs(directory, exist_ok=True)
+        self.profile_dir = directory
+        self.profiler = profiler
+
+    def start_sampler(self):
+
+        # (re)start in forked workers as well, threads don't survive a fork
+        if self.sampler_pid == os.getpid():
+            return
+        self.sampler_pid = os.getpid()
+
+        def sample():
+            while True:
+                time.sleep(self.interval)
+                if not self.active:
+                    continue
+                rss = current_rss()
+                for active in list(self.active):
+                    active.peak_rss = max(active.peak_rss, rss)
+
+        threading.Thread(target=sample, daemon=True).start()
+
+    @contextlib.contextmanager
+    def stage(self, name, items=None):
+
+        self.start_sampler()
+
+        full_name = '/'.join([s.name for s in self.active[-1:]] + [name])
+        current = Stage(full_name, items)
+        profiled = self.profile_dir is not None and not self.active
+        self.active.append(current)
+
+        start_time = time.time()
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        start_children = children_cpu_time()
+        with self.profiling(full_name) if profiled else contextlib.nullcontext():
+            try:
+                yield current
+            finally:
+                current.wall_time = time.perf_counter() - start
+                current.cpu_time = time.process_time() - start_cpu
+                current.children_cpu_time = children_cpu_time() - start_children
+                current.peak_rss = max(current.peak_rss, current_rss())
+                self.active.pop()
+                self.add(current, start_time, time.time())
+
+    def add(self, current, start_time, end_time):
+
+        result = self.results.setdefault(current.name, {
+            'calls': 0,
+            'wall_time': 0.0,
+            'cpu_time': 0.0,
+            'children_cpu_time': 0.0,
+            'peak_rss_mb': 0.0,
+            'first_start': start_time,
+        })
+        result['calls'] += 1
+        result['wall_time'] += current.wall_time
+        result['cpu_time'] += current.cpu_time
+        result['children_cpu_time'] += current.children_cpu_time
+        result['peak_rss_mb'] = max(result['peak_rss_mb'], current.peak_rss / 2**20)
+        result['last_end'] = end_time
+        if current.items is not None:
+            result['items'] = result.get('items', 0) + current.items
+            result['throughput'] = (
+                result['items'] / result['wall_time']
+                if result['wall_time'] > 0 else None)
+        for key, n in current.counters.items():
+            counters = result.setdefault('counters', {})
+            counters[key] = counters.get(key, 0) + n
+
+        for active in self.active:
+            active.peak_rss = max(active.peak_rss, current.peak_rss)
+
+    def count(self, name, n=1):
+
+        counters = self.active[-1].counters if self.active else self.counters
+        counters[name] = counters.get(name, 0) + n
+
+    def merge(self, results):
+        """Add the results of another recorder (e.g., of a worker process)
+        below the current stage."""
+
+        prefix = ''.join(s.name + '/' for s in self.active[-1:])
+        for name, other in results.items():
+
+            name = prefix + name
+            if name not in self.results:
+                self.results[name] = dict(other)
+                continue
+
+            result = self.results[name]
+            for key in ['calls', 'wall_time', 'cpu_time', 'children_cpu_time']:
+                result[key] = result.get(key, 0) + other.get(key, 0)
+            result['peak_rss_mb'] = max(
+                result.get('peak_rss_mb', 0.0),
+                other.get('peak_rss_mb', 0.0))
+            if 'items' in other:
+                result['items'] = result.get('items', 0) + other['items']
+                result['throughput'] = (
+                    result['items'] / result['wall_time']
+                    if result['wall_time'] > 0 else None)
+            for key, n in other.get('counters', {}).items():
+                counters = result.setdefault('counters', {})
+                counters[key] = counters.get(key, 0) + n
+
+    @contextlib.contextmanager
+    def profiling(self, name):
+
+        filename = os.path.join(
+            self.profile_dir,
+            re.sub(r'[^\w.:-]', '_', name.replace('/', '.')))
+
+        if self.profiler == 'cprofile':
+            # repeated stages accumulate in the same profile
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                profile.dump_stats(filename + '.prof')
+            return
+
+        try:
+            process = subprocess.Popen([
+                'py-spy', 'record',
+                '--pid', str(os.getpid()),
+                '--format', 'speedscope',
+                '--output', filename + '.speedscope.json',
+                '--nonblocking'],
+                stdout=subprocess.DEVNULL)
+        except OSError as e:
+            print(f"Could not start py-spy: {e}")
+            process = None
+        try:
+            yield
+        finally:
+            if process is not None:
+                # py-spy writes its output on SIGINT
+                process.send_signal(signal.SIGINT)
+                process.wait()
+
+    def ordered_results(self):
+
+        # nested stages finish (and are added) before their parents, order
+        # them by start below their parent instead
+        def key(name):
+            parts = name.split('/')
+            return [
+                self.results.get('/'.join(parts[:i + 1]), {}).get(
+                    'first_start', 0.0)
+                for i in range(len(parts))
+            ]
+
+        return {
+            name: self.results[name]
+            for name in sorted(self.results, key=key)
+        }
+
+    def report(self):
+
+        return {
+            'pid': os.getpid(),
+            'command': sys.argv,
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat(),
+            'wall_time': time.time() - self.started,
+            'cpu_time': time.process_time(),
+            'children_cpu_time': children_cpu_time(),
+            'peak_rss_mb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / (
+                    2**20 if sys.platform == 'darwin' else 2**10),
+            'counters': self.counters,
+            'stages': self.ordered_results()
+        }
+
+    def summary(self):
+
+        lines = [
+            f"{'stage':<48} {'calls':>6} {'wall (s)':>10} {'cpu (s)':>10} "
+            f"{'peak (MB)':>10} {'items':>12}"
+        ]
+        for name, result in self.ordered_results().items():
+            depth = name.count('/')
+            label = '  ' * depth + name.rsplit('/', 1)[-1]
+            cpu_time = result['cpu_time'] + result['children_cpu_time']
+            items = result.get('items', '')
+            lines.append(
+                f"{label:<48} {result['calls']:>6} "
+                f"{result['wall_time']:>10.2f} {cpu_time:>10.2f} "
+                f"{result['peak_rss_mb']:>10.1f} {items:>12}")
+        return lines
+
+
+recorder = Recorder()
+
+
+def stage(name, items=None):
+    """Context manager recording the stage ``name``, yields a ``Stage``
+    whose ``items`` can be set from within."""
+    return recorder.stage(name, items)
+
+
+def count(name, n=1):
+    """Add ``n`` to the counter ``name`` of the current stage."""
+    recorder.count(name, n)
+
+
+def merge(results):
+    recorder.merge(results)
+
+
+def results():
+    return recorder.ordered_results()
+
+
+def reset():
+    recorder.reset()
+
+
+def enable_profiling(directory, profiler='cprofile'):
+    recorder.enable_profiling(directory, profiler)
+
+
+def profiling_options():
+    """Arguments to ``enable_profiling`` in worker processes, or ``None``."""
+    if recorder.profile_dir is None:
+        return None
+    return recorder.profile_dir, recorder.profiler
+
+
+def report():
+    return recorder.report()
+
+
+def print_summary():
+    for line in recorder.summary():
+        print(line)
+
+
+def write_report(filename, **extra):
+    """Write the JSON run report, with optional ``extra`` top-level
+    entries."""
+
+    with open(filename, 'w') as f:
+        json.dump({**report(), **extra}, f, indent=2)
+    print(f"Wrote run report to {filename}")
@@ -1,5 +1,15 @@
+"""Consolidate the male VNC synapse CSVs.
+
+Run from the repository root as ``python -m malevnc.consolidate``, paths
+below are relative to this directory.
+"""
 from csv import DictReader
-import json
+from spatial_index import write_index
+from synapse_io import write_synapses
+from synister_datasets import DATASETS
+import argparse
+import diagnostics
+import os
 
 ach_in_file = 'original/vnc_filtered_090621/acetylcholine.csv'
 gaba_in_file = 'original/vnc_filtered_090621/gaba.csv'
@@ -48,10 +58,11 @@ def read_csv(
                 y = float(row['y']) * 8
                 z = float(row['z']) * 8
             except ValueError as e:
-                print(
-                    f"Error parsing coordinates of synapse {synapse_id} "
-                    f"(skeleton_id = {skeleton_id}): {e}")
-                print("Skipping this synapse")
+                diagnostics.record(diagnostics.BAD_COORDINATES, {
+                    'connector_id': synapse_id,
+                    'body_id': skeleton_id,
+                    'error': str(e)
+                })
                 continue
 
             synapses.append({
@@ -71,9 +82,32 @@ def read_csv(
         return synapses
 
 
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '--no-json',
+    action='store_true',
+    help="Only write the .npz files, not the JSON files ingest.py reads")
+parser.add_argument(
+    '--diagnostics-detail',
+    action='store_true',
+    help="List every skipped synapse in a .diagnostics.jsonl file, next to "
+         "the .diagnostics.json summary")
+args = parser.parse_args()
+
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+diagnostics_file = os.path.splitext(out_file)[0] + '.diagnostics.json'
+if args.diagnostics_detail:
+    diagnostics.enable_detail(os.path.splitext(diagnostics_file)[0] + '.jsonl')
+
 synapses = read_csv(ach_in_file, neurotransmitter='acetylcholine')
 synapses += read_csv(gaba_in_file, neurotransmitter='gaba')
 synapses += read_csv(glut_in_file, neurotransmitter='glutamate')
-
-with open(out_file, 'w') as f:
-    json.dump(synapses, f, indent=2)
+diagnostics.print_summary()
+diagnostics.write_report(diagnostics_file)
+
+npz_file = os.path.splitext(out_file)[0] + '.npz'
+write_synapses(synapses, npz_file)
+write_index(npz_file, DATASETS['malevnc']['voxel_size'])
+if not args.no_json:
+    write_synapses(synapses, out_file)
@@ -1,5 +1,5 @@
+import csv
 import numpy as np
-import copy
 from synister.synister_db import SynisterDb
 
 def ingest(db_credentials, db_name, synapses, skeletons, overwrite=False):
@@ -12,39 +12,39 @@ def read_csv(file_path, skeleton_id_column, synapse_id_column, x_column, y_colum
     Reads specified columns from a csv and returns list of synapses and skeleton dicts 
     ready to be ingested into the database.
     """
-    name_map = {synapse_id_column: "synapse_id", skeleton_id_column: "skeleton_id", x_column: "x", y_column: "y", z_column: "z"}
-    data = np.genfromtxt(file_path, delimiter=",", dtype=None, encoding="utf-8", case_sensitive="lower")
-    header = list(data[0])
+    with open(file_path, "r", encoding="utf-8") as f:
+        # column names are matched case-insensitively
+        header = [name.strip().lower() for name in next(csv.reader(f))]
 
-    name_to_column = {"synapse_id": header.index(synapse_id_column), 
-                      "skeleton_id": header.index(skeleton_id_column),
-                      "x": header.index(x_column),
-                      "y": header.index(y_column),
-                      "z": header.index(z_column)}
+    keys = ["synapse_id", "skeleton_id", "x", "y", "z"]
+    columns = [synapse_id_column, skeleton_id_column, x_column, y_column, z_column]
 
-    synapse = {"x": None, "y": None, "z": None, "synapse_id": None, "skeleton_id": None}
-    skeleton = {"skeleton_id": None, "nt_known": None, "hemi_lineage_id": None}
+    # parsed as int64 directly (numpy >= 1.23), exact for 64-bit IDs
+    data = np.loadtxt(
+        file_path,
+        delimiter=",",
+        skiprows=1,
+        usecols=[header.index(column.lower()) for column in columns],
+        dtype=np.int64,
+        ndmin=2)
 
+    # voxels to nm (truncated), as make_physical does for a single synapse
+    data[:, 2:] = (data[:, 2:] * np.asarray(voxel_size)[::-1]).astype(np.int64)
 
-    synapses = []
-    skeletons = []
-    skids = set([])
+    values = dict(zip(keys, (column.tolist() for column in data.T)))
+    synapses = [
+        {"x": x, "y": y, "z": z, "synapse_id": synapse_id, "skeleton_id": skid}
+        for x, y, z, synapse_id, skid in zip(
+            values["x"], values["y"], values["z"],
+            values["synapse_id"], values["skeleton_id"])
+    ]
 
-    for row in data[1:]:
-        synapse_tmp = copy.copy(synapse)
-        for key in synapse:
-            synapse_tmp[key] = int(row[name_to_column[key]])
-
-        synapse_tmp = make_physical(voxel_size,synapse_tmp)
-        synapses.append(synapse_tmp)
-        
-        skid = int(row[name_to_column["skeleton_id"]])
-        if not skid in skids:
-            skids.add(skid)
-            skeleton_tmp = copy.copy(skeleton)
-            skeleton_tmp["skeleton_id"] = skid
-            skeleton_tmp["nt_known"] = [nt]
-            skeletons.append(skeleton_tmp)
+    # one skeleton per skeleton ID, in order of first appearance
+    skids, first_rows = np.unique(data[:, 1], return_index=True)
+    skeletons = [
+        {"skeleton_id": skid, "nt_known": [nt], "hemi_lineage_id": None}
+        for skid in skids[np.argsort(first_rows)].tolist()
+    ]
 
     return synapses, skeletons
 
@@ -0,0 +1,441 @@
+"""Run consolidation and ingestion as one pipeline, redoing only what changed.
+
+The pipeline is a DAG of stages::
+
+    consolidate:<source>   <source>/original/*  ->  <source>/consolidated/*
+    ingest:<dataset>       consolidated files   ->  database + splits
+
+Each stage is keyed by a content hash of its inputs (files), parameters
+(voxel size, thresholds, split fractions, ...) and code. A stage is skipped
+if its key didn't change since its last run and its outputs are still there.
+Ingest stages are keyed by the content of the consolidated files they read,
+such that re-consolidating without changes to the output doesn't trigger a
+new ingest, and changes to one source (e.g., ``hemi``) don't touch the
+others.
+
+Keys and file hashes of consolidation are kept in a state file. Ingested
+databases record their key and inputs in a ``provenance`` document of their
+``ingest_meta`` collection, which is what ingest stages are compared
+against.
+
+Usage::
+
+    python pipeline.py -c credentials.ini            # all datasets
+    python pipeline.py -c credentials.ini hemi       # only what hemi needs
+    python pipeline.py -c credentials.ini --dry-run
+"""
+from ingest import NT_SKELETONS_THRESHOLD, NT_SYNAPSES_THRESHOLD
+from synister_datasets import DATASETS
+from synister_mongo import get_database, read_provenance, write_provenance
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# per source directory, the consolidation script and the inputs it reads
+# (relative to the source directory), and other modules the script uses
+# (relative to the repository)
+SOURCES = {
+    'fafb': {
+        'script': 'consolidate.py',
+        'inputs': ['original'],
+    },
+    'hemi': {
+        'script': 'consolidate.py',
+        'inputs': ['original'],
+        'code': ['fafb/consolidate.py'],
+    },
+    'malevnc': {
+        'script': 'consolidate.py',
+        'inputs': ['original'],
+    },
+}
+
+# shared modules whose changes change the results of a stage
+CONSOLIDATE_CODE = [
+    'chunked_csv.py',
+    'diagnostics.py',
+    'spatial_index.py',
+    'synapse_io.py'
+]
+INGEST_CODE = [
+    'ingest.py',
+    'incremental.py',
+    'synapse_io.py',
+    'synapse_table.py',
+    'synister_mongo.py'
+]
+
+
+def hash_bytes(data):
+
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_hash(path, cache):
+    """Content hash of ``path``, cached by size and modification time."""
+
+    stat = os.stat(path)
+    cached = cache.get(path)
+    if (
+            cached is not None and
+            cached['size'] == stat.st_size and
+            cached['mtime_ns'] == stat.st_mtime_ns):
+        return cached['hash']
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            digest.update(block)
+
+    cache[path] = {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'hash': digest.hexdigest()
+    }
+    return cache[path]['hash']
+
+
+def tree_hash(path, cache):
+    """Content hash of a file, or of all files (and their names) below a
+    directory."""
+
+    if not os.path.isdir(path):
+        return file_hash(path, cache)
+
+    hashes = {}
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            hashes[os.path.relpath(filename, path)] = file_hash(filename, cache)
+    return hash_bytes(json.dumps(hashes, sort_keys=True).encode())
+
+
+def stage_key(name, inputs, parameters, code):
+
+    return hash_bytes(json.dumps(
+        {
+            'stage': name,
+            'inputs': inputs,
+            'parameters': parameters,
+            'code': code
+        },
+        sort_keys=True,
+        default=str).encode())
+
+
+def load_state(filename):
+
+    if not os.path.exists(filename):
+        return {'files': {}, 'stages': {}}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def save_state(state, filename):
+
+    # never leave a partially written state behind
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+
+def source_of(filename):
+
+    return filename.split('/')[0]
+
+
+def dataset_files(dataset):
+
+    return DATASETS[dataset]['files'] + DATASETS[dataset].get('holdout_files', [])
+
+
+def consolidated_files(source):
+    """All consolidated files of ``source`` read by any dataset."""
+
+    return sorted(set(
+        filename
+        for dataset in DATASETS
+        for filename in dataset_files(dataset)
+        if source_of(filename) == source
+    ))
+
+
+def code_hashes(filenames, cache):
+
+    return {
+        filename: file_hash(os.path.join(BASE_DIR, filename), cache)
+        for filename in filenames
+    }
+
+
+def consolidate_stage(source, state):
+
+    cache = state['files']
+    source_dir = os.path.join(BASE_DIR, source)
+    spec = SOURCES[source]
+
+    inputs = {
+        os.path.join(source, path): tree_hash(os.path.join(source_dir, path), cache)
+        for path in spec['inputs']
+    }
+    parameters = {'voxel_size': DATASETS[source]['voxel_size']}
+    code = code_hashes(
+        [os.path.join(source, spec['script'])] +
+        spec.get('code', []) +
+        CONSOLIDATE_CODE,
+        cache)
+    name = f'consolidate:{source}'
+
+    return {
+        'name': name,
+        'key': stage_key(name, inputs, parameters, code),
+        'inputs': inputs,
+        'parameters': parameters,
+        'code': code,
+        'outputs': consolidated_files(source),
+        # run as a module from the repository root, such that the shared
+        # modules can be imported
+        'command': [
+            sys.executable,
+            '-m',
+            f"{source}.{os.path.splitext(spec['script'])[0]}"],
+        'cwd': BASE_DIR
+    }
+
+
+def ingest_stage(dataset, state):
+
+    cache = state['files']
+    spec = DATASETS[dataset]
+
+    inputs = {
+        filename: file_hash(os.path.join(BASE_DIR, filename), cache)
+        for filename in dataset_files(dataset)
+    }
+    parameters = {
+        **spec,
+        'nt_synapses_threshold': NT_SYNAPSES_THRESHOLD,
+        'nt_skeletons_threshold': NT_SKELETONS_THRESHOLD
+    }
+    code = code_hashes(INGEST_CODE, cache)
+    name = f'ingest:{dataset}'
+
+    return {
+        'name': name,
+        'key': stage_key(name, inputs, parameters, code),
+        'inputs': inputs,
+        'parameters': parameters,
+        'code': code,
+        'sources': sorted(set(source_of(f) for f in dataset_files(dataset)))
+    }
+
+
+def outputs_unchanged(stage, previous, cache):
+
+    for filename in stage['outputs']:
+        path = os.path.join(BASE_DIR, filename)
+        if not os.path.exists(path):
+            return False
+        if file_hash(path, cache) != previous['outputs'].get(filename):
+            return False
+    return True
+
+
+def git_commit():
+
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=BASE_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def as_entries(hashes):
+
+    # file names contain dots, which MongoDB doesn't accept in field names
+    return [
+        {'path': path, 'hash': digest}
+        for path, digest in sorted(hashes.items())
+    ]
+
+
+def source_provenance(state, source):
+
+    stage = state['stages'].get(f'consolidate:{source}')
+    if stage is None:
+        return {'source': source}
+    return {
+        'source': source,
+        'key': stage['key'],
+        'inputs': as_entries(stage['inputs']),
+        'code': as_entries(stage['code']),
+        'outputs': as_entries(stage['outputs']),
+        'finished': stage['finished']
+    }
+
+
+def run(command, cwd):
+
+    print(f"Running {' '.join(command)} in {cwd}")
+    subprocess.run(command, cwd=cwd, check=True)
+
+
+def run_consolidation(source, state, args):
+
+    stage = consolidate_stage(source, state)
+    previous = state['stages'].get(stage['name'])
+
+    if (
+            previous is not None and
+            previous['key'] == stage['key'] and
+            source not in args.force and
+            outputs_unchanged(stage, previous, state['files'])):
+        print(f"Skipping {stage['name']}, inputs unchanged")
+        return False
+
+    if args.dry_run:
+        print(f"Would run {stage['name']}")
+        return True
+
+    run(stage['command'], stage['cwd'])
+
+    state['stages'][stage['name']] = {
+        'key': stage['key'],
+        'inputs': stage['inputs'],
+        'parameters': stage['parameters'],
+        'code': stage['code'],
+        'outputs': {
+            filename: file_hash(os.path.join(BASE_DIR, filename), state['files'])
+            for filename in stage['outputs']
+        },
+        'finished': datetime.datetime.now(datetime.timezone.utc).isoformat()
+    }
+    save_state(state, args.state)
+    return True
+
+
+def run_ingest(dataset, state, args, pending_sources):
+
+    name = f'ingest:{dataset}'
+    sources = set(source_of(f) for f in dataset_files(dataset))
+
+    if args.dry_run and sources & pending_sources:
+        print(f"Would run {name} if consolidation changes its inputs")
+        return
+
+    stage = ingest_stage(dataset, state)
+    database = get_database(args.credentials, DATASETS[dataset]['db_name'])
+    provenance = read_provenance(database)
+
+    if (
+            provenance is not None and
+            provenance['key'] == stage['key'] and
+            dataset not in args.force):
+        print(f"Skipping {name}, inputs unchanged")
+        return
+
+    if args.dry_run:
+        print(f"Would run {name}")
+        return
+
+    command = [
+        sys.executable,
+        'ingest.py',
+        dataset,
+        '--credentials', args.credentials
+    ]
+    if args.incremental and provenance is not None:
+        command.append('--incremental')
+    run(command, BASE_DIR)
+
+    write_provenance(database, {
+        'key': stage['key'],
+        'stage': name,
+        'inputs': as_entries(stage['inputs']),
+        'parameters': stage['parameters'],
+        'code': as_entries(stage['code']),
+        'sources': [
+            source_provenance(state, source)
+            for source in stage['sources']
+        ],
+        'incremental': '--incremental' in command,
+        'commit': git_commit(),
+        'finished': datetime.datetime.now(datetime.timezone.utc)
+    })
+    state['stages'][name] = {
+        'key': stage['key'],
+        'finished': datetime.datetime.now(datetime.timezone.utc).isoformat()
+    }
+    save_state(state, args.state)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Consolidate and ingest datasets, skipping every stage "
+                    "whose inputs didn't change")
+    parser.add_argument(
+        'datasets',
+        nargs='*',
+        help=f"Datasets to bring up to date, out of {list(DATASETS.keys())} "
+             "(default: all)")
+    parser.add_argument(
+        '--credentials',
+        '-c',
+        type=str,
+        required=True,
+        help="MongoDB credential file")
+    parser.add_argument(
+        '--state',
+        type=str,
+        default=os.path.join(BASE_DIR, 'pipeline_state.json'),
+        help="File to keep the state of consolidation stages in")
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help="Update previously ingested databases incrementally, instead of "
+             "recreating them")
+    parser.add_argument(
+        '--force',
+        nargs='+',
+        default=[],
+        help="Rerun the stages of these sources or datasets, even if their "
+             "inputs didn't change")
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help="Only show which stages would run")
+    args = parser.parse_args()
+
+    for dataset in args.datasets:
+        if dataset not in DATASETS:
+            parser.error(f"unknown dataset {dataset}")
+
+    datasets = args.datasets or list(DATASETS.keys())
+    state = load_state(args.state)
+
+    sources = sorted(set(
+        source_of(filename)
+        for dataset in datasets
+        for filename in dataset_files(dataset)
+    ))
+    pending_sources = set(
+        source
+        for source in sources
+        if run_consolidation(source, state, args)
+    )
+
+    for dataset in datasets:
+        run_ingest(dataset, state, args, pending_sources)
+
+    # keep the file hashes, to not read unchanged inputs again
+    save_state(state, args.state)
@@ -0,0 +1,414 @@
+"""Export of consolidated synapses as a neuroglancer precomputed annotation
+source.
+
+Synapses are written as ``POINT`` annotations (z, y, x in nm) with enum
+properties (e.g., neurotransmitter and hemilineage), in a multi-level spatial
+index: level 0 is a single chunk covering all synapses, each further level
+halves the chunk size (along the longest axes). Each chunk holds at most
+``limit`` randomly chosen synapses that were not included in a coarser level,
+the last level holds all remaining ones. Neuroglancer then only fetches the
+chunks in view, at a density that fits the zoom level.
+
+The annotation ID of a synapse is its row in the consolidated synapse file.
+The ``by_id`` index is written in the sharded format, such that millions of
+synapses end up in a few hundred shard files.
+"""
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from synapse_io import Categorical, as_list, read_columns
+from synapse_table import read_table, to_objects
+import argparse
+import functools
+import json
+import numpy as np
+import os
+import shutil
+import threading
+
+DIMENSIONS = ['z', 'y', 'x']
+DEFAULT_PROPERTIES = ['neurotransmitter', 'hemilineage']
+SOURCE_FILE = 'source.json'
+
+
+def load_columns(filename):
+
+    if filename.endswith('.npz'):
+        return read_columns(filename)
+    # streamed, instead of loading all synapse dicts at once, with string
+    # columns as object arrays (as read_columns returns them)
+    return {
+        name: to_objects(values) if isinstance(values, Categorical) else values
+        for name, values in read_table(filename).columns.items()
+    }
+
+
+def encode_property(values):
+
+    values = np.asarray(as_list(values), dtype=object)
+    missing = np.array([v is None for v in values], dtype=bool)
+    labels, codes = np.unique(values[~missing].astype(str), return_inverse=True)
+    labels = labels.tolist()
+    all_codes = np.full(len(values), len(labels), dtype=np.int64)
+    all_codes[~missing] = codes
+    if missing.any():
+        labels.append('none')
+
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if len(labels) <= np.iinfo(dtype).max + 1:
+            break
+
+    return all_codes.astype(dtype), labels
+
+
+def annotation_dtype(properties):
+
+    # properties are packed by decreasing size, followed by padding to a
+    # multiple of 4 bytes
+    fields = [('point', '<f4', 3)]
+    size = 12
+    for name, (codes, _) in properties.items():
+        fields.append((name, codes.dtype.newbyteorder('<')))
+        size += codes.dtype.itemsize
+    if size % 4:
+        fields.append(('padding', 'u1', 4 - size % 4))
+
+    return np.dtype(fields)
+
+
+def write_annotations(
+        synapses,
+        output_dir,
+        properties=DEFAULT_PROPERTIES,
+        limit=10000,
+        max_levels=10,
+        seed=1912,
+        source=None):
+    """Write ``synapses`` (a dict of columns) to ``output_dir``.
+
+    If given, ``source`` (see :func:`source_description`) is stored next to
+    the info, such that :func:`is_current` can tell whether the annotations
+    need to be rewritten."""
+
+    positions = np.stack(
+        [np.asarray(synapses[d], dtype=np.float64) for d in DIMENSIONS],
+        axis=1)
+    num_synapses = len(positions)
+    ids = np.arange(num_synapses, dtype='<u8')
+
+    encoded = {
+        name: encode_property(synapses[name])
+        for name in properties
+        if name in synapses
+    }
+    encoded = dict(sorted(
+        encoded.items(),
+        key=lambda item: -item[1][0].dtype.itemsize))
+
+    dtype = annotation_dtype(encoded)
+    records = np.zeros(num_synapses, dtype=dtype)
+    records['point'] = positions
+    for name, (codes, _) in encoded.items():
+        records[name] = codes
+
+    lower = np.floor(positions.min(axis=0)) if num_synapses else np.zeros(3)
+    upper = np.floor(positions.max(axis=0)) + 1 if num_synapses else np.ones(3)
+
+    print(f"Writing {num_synapses} annotations to {output_dir}...")
+    os.makedirs(output_dir, exist_ok=True)
+    # remove chunks of a previous export, they might not be overwritten
+    for entry in os.listdir(output_dir):
+        if entry.startswith('spatial') or entry == 'by_id':
+            shutil.rmtree(os.path.join(output_dir, entry))
+
+    spatial = write_spatial_index(
+        output_dir,
+        positions,
+        records,
+        ids,
+        lower,
+        upper,
+        limit,
+        max_levels,
+        np.random.RandomState(seed))
+    sharding = write_by_id(output_dir, records, ids)
+
+    info = {
+        '@type': 'neuroglancer_annotations_v1',
+        'dimensions': {d: [1, 'nm'] for d in DIMENSIONS},
+        'lower_bound': lower.tolist(),
+        'upper_bound': upper.tolist(),
+        'annotation_type': 'POINT',
+        'properties': [
+            {
+                'id': name,
+                'type': np.dtype(codes.dtype).name,
+                'enum_values': list(range(len(labels))),
+                'enum_labels': labels
+            }
+            for name, (codes, labels) in encoded.items()
+        ],
+        'relationships': [],
+        'by_id': {'key': 'by_id', 'sharding': sharding},
+        'spatial': spatial
+    }
+    with open(os.path.join(output_dir, 'info'), 'w') as f:
+        json.dump(info, f, indent=2)
+    if source is not None:
+        with open(os.path.join(output_dir, SOURCE_FILE), 'w') as f:
+            json.dump(source, f, indent=2)
+
+
+def source_description(filename, properties=DEFAULT_PROPERTIES, limit=10000):
+    """Describe the synapse file and parameters annotations are written
+    from."""
+
+    stat = os.stat(filename)
+    return {
+        'synapses': os.path.abspath(filename),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'properties': list(properties),
+        'limit': limit
+    }
+
+
+def is_current(output_dir, source):
+    """Whether ``output_dir`` holds annotations written from ``source``."""
+
+    if not os.path.exists(os.path.join(output_dir, 'info')):
+        return False
+    try:
+        with open(os.path.join(output_dir, SOURCE_FILE), 'r') as f:
+            return json.load(f) == source
+    except (OSError, ValueError):
+        return False
+
+
+def write_spatial_index(
+        output_dir,
+        positions,
+        records,
+        ids,
+        lower,
+        upper,
+        limit,
+        max_levels,
+        random):
+
+    grid_shape = np.ones(3, dtype=np.int64)
+    chunk_size = upper - lower
+    # random order, such that the first synapses of a chunk are a sample
+    remaining = random.permutation(len(positions))
+
+    levels = []
+    for level in range(max_levels):
+
+        cells = np.floor((positions[remaining] - lower) / chunk_size)
+        cells = np.clip(cells.astype(np.int64), 0, grid_shape - 1)
+        flat = np.ravel_multi_index(cells.T, grid_shape)
+
+        order = np.argsort(flat, kind='stable')
+        remaining = remaining[order]
+        cells = cells[order]
+        flat = flat[order]
+
+        starts = np.flatnonzero(np.diff(flat, prepend=-1))
+        counts = np.diff(np.append(starts, len(flat)))
+        rank = np.arange(len(flat)) - np.repeat(starts, counts)
+
+        last = level == max_levels - 1 or len(counts) == 0 or \
+            counts.max() <= limit
+        if last:
+            take = np.ones(len(flat), dtype=bool)
+        else:
+            take = rank < limit
+
+        key = f'spatial{level}'
+        os.makedirs(os.path.join(output_dir, key), exist_ok=True)
+        for start, count in zip(starts, counts):
+            chunk = slice(start, start + (count if last else min(count, limit)))
+            write_chunk(
+                os.path.join(
+                    output_dir,
+                    key,
+                    '_'.join(str(c) for c in cells[start])),
+                records[remaining[chunk]],
+                ids[remaining[chunk]])
+
+        levels.append({
+            'key': key,
+            'grid_shape': grid_shape.tolist(),
+            'chunk_size': chunk_size.tolist(),
+            'limit': int(counts.max()) if last and len(counts) else limit
+        })
+        print(
+            f"Level {level}: {int(take.sum())} annotations in "
+            f"{len(counts)} chunks")
+
+        remaining = remaining[~take]
+        if last:
+            break
+
+        # split the longest axes, to keep chunks roughly isotropic
+        split = chunk_size >= chunk_size.max() / 2
+        grid_shape = np.where(split, grid_shape * 2, grid_shape)
+        chunk_size = (upper - lower) / grid_shape
+
+    return levels
+
+
+def write_chunk(filename, records, ids):
+
+    with open(filename, 'wb') as f:
+        f.write(np.uint64(len(records)).astype('<u8').tobytes())
+        f.write(records.tobytes())
+        f.write(ids.astype('<u8').tobytes())
+
+
+def write_by_id(
+        output_dir,
+        records,
+        ids,
+        annotations_per_shard=2**16,
+        max_minishard_bits=6):
+    """Write the by_id index as ``neuroglancer_uint64_sharded_v1`` with the
+    identity hash. Returns the sharding spec for the info."""
+
+    id_bits = int(np.ceil(np.log2(max(len(ids), 1))))
+    minishard_bits = min(max_minishard_bits, id_bits)
+    shard_bits = max(0, id_bits - int(np.log2(annotations_per_shard)))
+    sharding = {
+        '@type': 'neuroglancer_uint64_sharded_v1',
+        'preshift_bits': 0,
+        'hash': 'identity',
+        'minishard_bits': minishard_bits,
+        'shard_bits': shard_bits,
+        'minishard_index_encoding': 'raw',
+        'data_encoding': 'raw'
+    }
+
+    by_id = os.path.join(output_dir, 'by_id')
+    os.makedirs(by_id, exist_ok=True)
+
+    ids = np.asarray(ids, dtype=np.uint64)
+    minishards = ids & np.uint64((1 << minishard_bits) - 1)
+    shards = (ids >> np.uint64(minishard_bits)) & \
+        np.uint64((1 << shard_bits) - 1)
+    order = np.lexsort((ids, minishards, shards))
+
+    starts = np.flatnonzero(np.diff(shards[order].astype(np.int64), prepend=-1))
+    for start, end in zip(starts, np.append(starts[1:], len(order))):
+        shard = int(shards[order[start]])
+        name = format(shard, 'x').zfill(int(np.ceil(shard_bits / 4)))
+        write_shard(
+            os.path.join(by_id, f'{name}.shard'),
+            records[order[start:end]],
+            ids[order[start:end]],
+            minishards[order[start:end]],
+            minishard_bits)
+
+    return sharding
+
+
+def write_shard(filename, records, ids, minishards, minishard_bits):
+
+    # every chunk is a single record, chunks of a minishard are followed by
+    # its index, offsets are relative to the end of the shard index
+    record_size = records.dtype.itemsize
+    shard_index = np.zeros((1 << minishard_bits, 2), dtype='<u8')
+    blobs = []
+    offset = 0
+
+    for minishard in range(1 << minishard_bits):
+
+        selected = minishards == minishard
+        num_chunks = int(selected.sum())
+        if num_chunks == 0:
+            shard_index[minishard] = offset
+            continue
+
+        blobs.append(records[selected].tobytes())
+        data_start = offset
+        offset += num_chunks * record_size
+
+        # keys are delta encoded, offsets relative to the end of the
+        # previous chunk
+        keys = ids[selected]
+        index = np.zeros((3, num_chunks), dtype='<u8')
+        index[0] = np.diff(keys, prepend=np.uint64(0))
+        index[1, 0] = data_start
+        index[2] = record_size
+        blobs.append(index.tobytes())
+
+        shard_index[minishard] = (offset, offset + index.nbytes)
+        offset += index.nbytes
+
+    with open(filename, 'wb') as f:
+        f.write(shard_index.tobytes())
+        for blob in blobs:
+            f.write(blob)
+
+
+class CorsRequestHandler(SimpleHTTPRequestHandler):
+
+    def end_headers(self):
+        self.send_header('Access-Control-Allow-Origin', '*')
+        super().end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory, port=9000, bind_address='0.0.0.0'):
+    """Serve ``directory`` over HTTP in a background thread. Returns the
+    server, the annotation source URL is
+    ``precomputed://http://<host>:<port>``."""
+
+    handler = functools.partial(CorsRequestHandler, directory=directory)
+    server = ThreadingHTTPServer((bind_address, port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Export consolidated synapses as a neuroglancer "
+                    "precomputed annotation source")
+    parser.add_argument(
+        'synapses',
+        help="Consolidated synapse file (JSON or .npz)")
+    parser.add_argument(
+        'output_dir',
+        help="Directory to write the annotation source to")
+    parser.add_argument(
+        '--properties',
+        type=lambda s: s.split(','),
+        default=DEFAULT_PROPERTIES,
+        help="Comma-separated synapse attributes to store as properties")
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=10000,
+        help="Maximal number of annotations per chunk and level")
+    parser.add_argument(
+        '--serve',
+        type=int,
+        default=None,
+        metavar='PORT',
+        help="Serve the annotation source on this port after writing")
+    args = parser.parse_args()
+
+    write_annotations(
+        load_columns(args.synapses),
+        args.output_dir,
+        properties=args.properties,
+        limit=args.limit,
+        source=source_description(args.synapses, args.properties, args.limit))
+
+    if args.serve is not None:
+        serve(args.output_dir, args.serve)
+        print(
+            f"Serving precomputed://http://localhost:{args.serve}, "
+            "press ENTER to quit")
+        input()
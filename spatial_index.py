@@ -0,0 +1,209 @@
+"""Spatial index over consolidated synapses.
+
+Synapses are bucketed into a regular grid of chunks of ``chunk_voxels``
+voxels (zyx) of the dataset's voxel size. The index is stored next to the
+``.npz`` synapse file as ``<name>.index.npz`` and contains, per chunk, the
+rows of its synapses in the synapse file and their positions (zyx, in nm),
+such that queries don't need to read the synapse file.
+
+Usage::
+
+    index = SpatialIndex('synapses.npz')
+    rows = index.query_roi((z0, y0, x0), (z1, y1, x1))
+    rows = index.query_radius((z, y, x), 1000)
+    rows = index.query_chunk((i, j, k))
+"""
+from synapse_io import memmap_member, read_columns, to_records
+from synister_datasets import DATASETS
+import argparse
+import json
+import numpy as np
+import os
+
+DEFAULT_CHUNK_VOXELS = (256, 256, 256)
+
+
+def index_filename(filename):
+
+    return os.path.splitext(filename)[0] + '.index.npz'
+
+
+def write_index(filename, voxel_size, chunk_voxels=DEFAULT_CHUNK_VOXELS):
+    """Build the index of the ``.npz`` synapse file ``filename``."""
+
+    columns = read_columns(filename, mmap=True)
+    positions = np.stack(
+        [
+            np.ma.filled(np.ma.asarray(columns[d], dtype=np.float64), np.nan)
+            for d in ['z', 'y', 'x']
+        ],
+        axis=1)
+    rows = np.flatnonzero(np.isfinite(positions).all(axis=1))
+    positions = positions[rows]
+
+    chunk_size = np.array(voxel_size, dtype=np.float64) * chunk_voxels
+    chunks = np.floor(positions / chunk_size).astype(np.int64)
+
+    order = np.lexsort(chunks.T[::-1])
+    rows = rows[order]
+    positions = positions[order]
+    chunks = chunks[order]
+
+    starts = np.flatnonzero(np.any(np.diff(chunks, axis=0, prepend=[[
+        np.iinfo(np.int64).min] * 3]) != 0, axis=1))
+    offsets = np.append(starts, len(rows))
+
+    print(
+        f"Indexed {len(rows)} synapses in {len(starts)} chunks of "
+        f"{chunk_size.tolist()} nm")
+
+    with open(index_filename(filename), 'wb') as f:
+        np.savez(
+            f,
+            voxel_size=np.array(voxel_size, dtype=np.int64),
+            chunk_size=chunk_size,
+            chunks=chunks[starts],
+            offsets=offsets,
+            rows=rows,
+            positions=positions)
+
+
+class SpatialIndex:
+    """Read access to the index of the ``.npz`` synapse file ``filename``.
+
+    All queries return rows of the synapse file, e.g., to be used with the
+    columns of ``synapse_io.read_columns``.
+    """
+
+    def __init__(self, filename):
+
+        filename = index_filename(filename)
+        with np.load(filename) as index:
+            self.voxel_size = index['voxel_size']
+            self.chunk_size = index['chunk_size']
+            self.chunks = index['chunks']
+            self.offsets = index['offsets']
+        # potentially large, read only where needed
+        self.rows = memmap_member(filename, 'rows')
+        self.positions = memmap_member(filename, 'positions')
+
+        self.chunk_ids = {
+            tuple(chunk): i
+            for i, chunk in enumerate(self.chunks.tolist())
+        }
+
+    def chunk_of(self, position):
+
+        return tuple(
+            np.floor(np.asarray(position) / self.chunk_size)
+            .astype(np.int64).tolist())
+
+    def query_chunk(self, chunk):
+        """Rows of synapses in the given chunk (grid coordinates)."""
+
+        i = self.chunk_ids.get(tuple(chunk))
+        if i is None:
+            return np.zeros((0,), dtype=np.int64)
+        return np.array(self.rows[self.offsets[i]:self.offsets[i + 1]])
+
+    def query_roi(self, begin, end):
+        """Rows of synapses with ``begin <= position < end`` (zyx, in nm)."""
+
+        rows, positions = self.candidates(begin, end)
+        inside = np.all(
+            (positions >= begin) & (positions < end),
+            axis=1)
+        return rows[inside]
+
+    def query_radius(self, center, radius):
+        """Rows of synapses within ``radius`` nm of ``center`` (zyx)."""
+
+        center = np.asarray(center, dtype=np.float64)
+        rows, positions = self.candidates(center - radius, center + radius)
+        inside = np.sum((positions - center)**2, axis=1) <= radius**2
+        return rows[inside]
+
+    def candidates(self, begin, end):
+
+        first = np.floor(np.asarray(begin) / self.chunk_size)
+        last = np.floor(np.asarray(end) / self.chunk_size)
+        selected = np.flatnonzero(np.all(
+            (self.chunks >= first) & (self.chunks <= last),
+            axis=1))
+
+        ranges = [
+            np.arange(self.offsets[i], self.offsets[i + 1])
+            for i in selected
+        ]
+        entries = np.concatenate(ranges) if ranges else \
+            np.zeros((0,), dtype=np.int64)
+
+        return np.array(self.rows[entries]), np.array(self.positions[entries])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description="Build or query the spatial index of a consolidated "
+                    "synapse file (.npz)")
+    parser.add_argument('synapses', help="Consolidated synapse file (.npz)")
+    parser.add_argument(
+        '--build',
+        choices=DATASETS.keys(),
+        metavar='DATASET',
+        help="(Re-)build the index, with the voxel size of this dataset")
+    parser.add_argument(
+        '--chunk-voxels',
+        type=int,
+        nargs=3,
+        default=DEFAULT_CHUNK_VOXELS,
+        help="Size of index chunks in voxels (zyx), when building")
+    parser.add_argument(
+        '--roi',
+        type=float,
+        nargs=6,
+        metavar=('Z0', 'Y0', 'X0', 'Z1', 'Y1', 'X1'),
+        help="Find synapses in this ROI (in nm)")
+    parser.add_argument(
+        '--radius',
+        type=float,
+        nargs=4,
+        metavar=('Z', 'Y', 'X', 'R'),
+        help="Find synapses within distance R (in nm) of a point")
+    parser.add_argument(
+        '--chunk',
+        type=int,
+        nargs=3,
+        metavar=('I', 'J', 'K'),
+        help="Find synapses in this chunk of the index")
+    parser.add_argument(
+        '--show',
+        type=int,
+        default=10,
+        help="Number of found synapses to print")
+    args = parser.parse_args()
+
+    if args.build is not None:
+        write_index(
+            args.synapses,
+            DATASETS[args.build]['voxel_size'],
+            args.chunk_voxels)
+
+    index = SpatialIndex(args.synapses)
+    rows = None
+    if args.roi is not None:
+        rows = index.query_roi(args.roi[:3], args.roi[3:])
+    elif args.radius is not None:
+        rows = index.query_radius(args.radius[:3], args.radius[3])
+    elif args.chunk is not None:
+        rows = index.query_chunk(args.chunk)
+
+    if rows is not None:
+        print(f"Found {len(rows)} synapses")
+        columns = read_columns(args.synapses, mmap=True)
+        shown = to_records({
+            name: values[rows[:args.show]]
+            for name, values in columns.items()
+        })
+        for synapse in shown:
+            print(json.dumps(synapse))
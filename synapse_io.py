@@ -0,0 +1,373 @@
+"""Reading and writing of consolidated synapse files.
+
+Two formats are supported, chosen by the file extension:
+
+  * ``.npz``: columnar, one typed array per synapse attribute. Integer, float
+    and bool columns are stored as ``int64``/``float64``/``bool`` arrays (with
+    a separate boolean ``<name>.missing`` array if some values are ``None``),
+    string
+    columns are dictionary encoded as ``<name>.codes`` (``int32``, ``-1`` for
+    ``None``) and ``<name>.categories``. The archive is not compressed, such
+    that numeric columns can be memory-mapped.
+
+  * anything else: JSON, a list of synapse dicts (the original format).
+"""
+from collections import namedtuple
+import json
+import numpy as np
+import re
+import struct
+import zipfile
+
+COLUMN_ORDER_KEY = '__columns__'
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# a dictionary encoded string column: ``int32`` codes into the sorted
+# ``categories`` (an object array of str), ``-1`` for missing values
+Categorical = namedtuple('Categorical', ['codes', 'categories'])
+
+
+def write_synapses(synapses, filename):
+    """Write synapses to ``filename``.
+
+    ``synapses`` is either a list of synapse dicts or a mapping (e.g., a
+    dict of arrays or a ``pandas.DataFrame``) from attribute name to column.
+    """
+
+    if filename.endswith('.npz'):
+        write_columns(to_columns(synapses), filename)
+    else:
+        with open(filename, 'w') as f:
+            json.dump(to_records(synapses), f, indent=2)
+
+
+def read_synapses(filename):
+    """Read a list of synapse dicts from ``filename``."""
+
+    if filename.endswith('.npz'):
+        return to_records(read_columns(filename))
+
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def iter_synapses(filename, chunk_size=100000):
+    """Iterate over the synapse dicts in ``filename``, without reading the
+    whole file into memory.
+
+    JSON lists are decoded one item at a time. Columns of ``.npz`` files are
+    memory-mapped (numeric) or kept as codes (strings) and converted to dicts
+    ``chunk_size`` rows at a time.
+    """
+
+    if not filename.endswith('.npz'):
+        with open(filename, 'r') as f:
+            yield from iter_json_list(f)
+        return
+
+    columns = read_columns(filename, mmap=True, categorical=True)
+    names = list(columns.keys())
+    lengths = [
+        len(values.codes) if isinstance(values, Categorical) else len(values)
+        for values in columns.values()
+    ]
+
+    for begin in range(0, lengths[0] if lengths else 0, chunk_size):
+        rows = slice(begin, begin + chunk_size)
+        values = [
+            as_list(slice_column(columns[name], rows))
+            for name in names
+        ]
+        for row in zip(*values):
+            yield dict(zip(names, row))
+
+
+def slice_column(values, rows):
+
+    if isinstance(values, Categorical):
+        return Categorical(values.codes[rows], values.categories)
+    return values[rows]
+
+
+def iter_json_list(f, block_size=2**20):
+    """Iterate over the items of the JSON list in file ``f``, reading
+    ``block_size`` characters at a time."""
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    end_of_file = False
+    # what comes next: '[', the first item or ']', ',' or ']', an item
+    expect = 'start'
+
+    while True:
+
+        position = WHITESPACE.match(buffer, position).end()
+
+        if position == len(buffer) or expect == 'item_partial':
+            if end_of_file:
+                raise ValueError(f"Unexpected end of JSON list in {f.name}")
+            block = f.read(block_size)
+            end_of_file = not block
+            buffer = buffer[position:] + block
+            position = 0
+            if expect == 'item_partial':
+                expect = 'item'
+            continue
+
+        char = buffer[position]
+
+        if expect == 'start':
+            if char != '[':
+                raise ValueError(f"Expected a JSON list in {f.name}")
+            position += 1
+            expect = 'first'
+            continue
+
+        if char == ']' and expect in ('first', 'separator'):
+            return
+
+        if expect == 'separator':
+            if char != ',':
+                raise ValueError(
+                    f"Expected ',' or ']' in JSON list in {f.name}")
+            position += 1
+            expect = 'item'
+            continue
+
+        # an item might be cut off at the end of the buffer, read more in
+        # that case (a cut number decodes without error, so make sure the
+        # separator after the item is in the buffer, too)
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if end_of_file:
+                raise
+            expect = 'item_partial'
+            continue
+        following = WHITESPACE.match(buffer, end).end()
+        if buffer[following:following + 1] not in (',', ']') and \
+                not end_of_file:
+            expect = 'item_partial'
+            continue
+
+        yield item
+        position = end
+        expect = 'separator'
+
+
+def write_columns(columns, filename):
+
+    arrays = {COLUMN_ORDER_KEY: np.array(list(columns.keys()))}
+    for name, values in columns.items():
+        arrays.update(encode_column(name, values))
+
+    with open(filename, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+def read_columns(filename, mmap=False, categorical=False):
+    """Read columns from a ``.npz`` synapse file.
+
+    Returns a dict from attribute name to array. Numeric columns with
+    missing values are returned as masked arrays, string columns as object
+    arrays with ``None`` for missing values (or as ``Categorical``, if
+    ``categorical`` is set). If ``mmap`` is set, numeric columns are
+    memory-mapped instead of read into memory.
+    """
+
+    with np.load(filename, allow_pickle=False) as npz:
+
+        names = npz[COLUMN_ORDER_KEY].tolist()
+
+        columns = {}
+        for name in names:
+
+            if f'{name}.codes' in npz.files:
+                codes = npz[f'{name}.codes']
+                categories = npz[f'{name}.categories'].astype(object)
+                if categorical:
+                    columns[name] = Categorical(codes, categories)
+                    continue
+                values = np.empty(len(codes), dtype=object)
+                present = codes >= 0
+                values[present] = categories[codes[present]]
+                columns[name] = values
+                continue
+
+            if mmap:
+                values = memmap_member(filename, name)
+            else:
+                values = npz[name]
+
+            if f'{name}.missing' in npz.files:
+                values = np.ma.MaskedArray(values, npz[f'{name}.missing'])
+
+            columns[name] = values
+
+    return columns
+
+
+def encode_column(name, values):
+
+    if isinstance(values, Categorical):
+        return {
+            f'{name}.codes': values.codes.astype(np.int32),
+            f'{name}.categories': values.categories.astype(str)
+        }
+
+    if hasattr(values, 'isna'):
+        # pandas column, possibly with nullable extension dtype
+        missing = np.asarray(values.isna())
+        if values.dtype.kind in 'iu':
+            data = values.to_numpy(dtype=np.int64, na_value=0)
+            return numeric_arrays(name, data, missing)
+        if values.dtype.kind == 'f':
+            data = values.to_numpy(dtype=np.float64, na_value=np.nan)
+            return numeric_arrays(name, data, missing)
+        if values.dtype.kind == 'b':
+            data = values.to_numpy(dtype=bool, na_value=False)
+            return numeric_arrays(name, data, missing)
+        values = values.to_numpy(dtype=object, copy=True)
+        values[missing] = None
+
+    if isinstance(values, np.ma.MaskedArray) and values.dtype.kind in 'biuf':
+        # as returned by read_columns
+        missing = np.ma.getmaskarray(values)
+        if values.dtype.kind == 'f':
+            return numeric_arrays(
+                name, values.filled(np.nan).astype(np.float64), missing)
+        if values.dtype.kind == 'b':
+            return numeric_arrays(
+                name, values.filled(False).astype(bool), missing)
+        return numeric_arrays(
+            name, values.filled(0).astype(np.int64), missing)
+
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        return {name: values.astype(np.int64)}
+    if values.dtype.kind == 'f':
+        return {name: values.astype(np.float64)}
+    if values.dtype.kind == 'b':
+        return {name: values}
+
+    values = values.astype(object)
+    missing = np.array([v is None for v in values], dtype=bool)
+    present = values[~missing]
+
+    if len(present) > 0 and all(
+            isinstance(v, (bool, np.bool_)) for v in present):
+        data = np.zeros(len(values), dtype=bool)
+        data[~missing] = present.astype(bool)
+        return numeric_arrays(name, data, missing)
+
+    if len(present) > 0 and all(
+            isinstance(v, (int, np.integer)) and not isinstance(v, bool)
+            for v in present):
+        data = np.zeros(len(values), dtype=np.int64)
+        data[~missing] = present.astype(np.int64)
+        return numeric_arrays(name, data, missing)
+
+    if len(present) > 0 and all(
+            isinstance(v, (int, float, np.number)) and not isinstance(v, bool)
+            for v in present):
+        data = np.full(len(values), np.nan)
+        data[~missing] = present.astype(np.float64)
+        return numeric_arrays(name, data, missing)
+
+    categories, codes = np.unique(
+        present.astype(str),
+        return_inverse=True)
+    all_codes = np.full(len(values), -1, dtype=np.int32)
+    all_codes[~missing] = codes
+    return {
+        f'{name}.codes': all_codes,
+        f'{name}.categories': categories
+    }
+
+
+def numeric_arrays(name, data, missing):
+
+    arrays = {name: data}
+    if missing.any():
+        arrays[f'{name}.missing'] = missing
+    return arrays
+
+
+def memmap_member(filename, name):
+
+    # np.savez stores members uncompressed, so the .npy data of each member
+    # is a contiguous byte range in the archive
+    with zipfile.ZipFile(filename) as archive:
+        info = archive.getinfo(f'{name}.npy')
+
+    with open(filename, 'rb') as f:
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, fortran_order, dtype = header
+        offset = f.tell()
+
+    return np.memmap(
+        filename,
+        dtype=dtype,
+        mode='r',
+        shape=shape,
+        offset=offset,
+        order='F' if fortran_order else 'C')
+
+
+def to_columns(synapses):
+
+    if not isinstance(synapses, list):
+        return synapses
+
+    names = list(synapses[0].keys()) if synapses else []
+    return {
+        name: [synapse[name] for synapse in synapses]
+        for name in names
+    }
+
+
+def to_records(synapses):
+
+    if isinstance(synapses, list):
+        return synapses
+
+    names = list(synapses.keys())
+    columns = [
+        as_list(synapses[name])
+        for name in names
+    ]
+    return [
+        dict(zip(names, values))
+        for values in zip(*columns)
+    ]
+
+
+def as_list(values):
+
+    # plain Python values, None for missing
+    if isinstance(values, Categorical):
+        # code -1 picks the appended None
+        lookup = np.append(values.categories, None)
+        return lookup[values.codes].tolist()
+    if hasattr(values, 'isna'):
+        missing = np.asarray(values.isna())
+        values = values.to_numpy(dtype=object, copy=True)
+        values[missing] = None
+        return [
+            v.item() if isinstance(v, np.generic) else v
+            for v in values
+        ]
+    if isinstance(values, np.ma.MaskedArray):
+        return values.tolist(fill_value=None)
+    if isinstance(values, np.ndarray):
+        return values.tolist()
+    return list(values)
@@ -0,0 +1,319 @@
+"""Synapses as a table of typed columns, instead of a list of dicts.
+
+Numeric columns are ``int64``/``float64``/``bool`` arrays (masked arrays if values are
+missing), string columns (neurotransmitter, hemi lineage, region, ...) are
+``synapse_io.Categorical`` codes, anything else is an object array. Rows are
+only turned into dicts (documents) where needed, e.g., when writing them to
+the DB::
+
+    table = read_table('synapses.npz')
+    table = table.select(table.codes('neurotransmitter') >= 0)
+    values, first, codes = table.factorize('skeleton_id')
+    writer.write(synapses=table)  # iterates over documents, in chunks
+"""
+from synapse_io import Categorical, as_list, iter_synapses, read_columns
+import itertools
+import numpy as np
+
+
+def is_masked(values):
+
+    return isinstance(values, np.ma.MaskedArray)
+
+
+def column_length(values):
+
+    if isinstance(values, Categorical):
+        return len(values.codes)
+    return len(values)
+
+
+def take(values, index):
+
+    if isinstance(values, Categorical):
+        return Categorical(values.codes[index], values.categories)
+    return values[index]
+
+
+def to_objects(values):
+
+    objects = np.empty(column_length(values), dtype=object)
+    objects[:] = as_list(values)
+    return objects
+
+
+def is_all_missing(values):
+
+    # an object column of only None, as encode_values returns it for a chunk
+    # without values
+    return (
+        not isinstance(values, Categorical) and
+        values.dtype == object and
+        all(v is None for v in values))
+
+
+def missing(length, like):
+
+    # a column of only missing values, of the same kind as `like`
+    if isinstance(like, Categorical):
+        return Categorical(np.full(length, -1, dtype=np.int32), like.categories)
+    if like.dtype.kind in 'biuf':
+        return np.ma.MaskedArray(
+            np.zeros(length, dtype=like.dtype),
+            np.ones(length, dtype=bool))
+    return np.full(length, None, dtype=object)
+
+
+def encode_values(values):
+    """Column from a list of Python values, as ``as_list`` would return
+    them."""
+
+    values = np.array(values + [None], dtype=object)[:-1]
+    absent = np.array([v is None for v in values], dtype=bool)
+    present = values[~absent]
+
+    if len(present) > 0 and all(isinstance(v, str) for v in present):
+        categories, codes = np.unique(present.astype(str), return_inverse=True)
+        all_codes = np.full(len(values), -1, dtype=np.int32)
+        all_codes[~absent] = codes
+        return Categorical(all_codes, categories.astype(object))
+
+    for dtype, types in [(np.int64, int), (np.float64, float), (bool, bool)]:
+        if len(present) == 0 or not all(
+                type(v) is types for v in present):
+            continue
+        try:
+            data = np.zeros(len(values), dtype=dtype)
+            data[~absent] = present.astype(dtype)
+        except OverflowError:
+            break
+        if absent.any():
+            return np.ma.MaskedArray(data, absent)
+        return data
+
+    return values
+
+
+def concatenate_columns(columns):
+
+    if all(isinstance(c, Categorical) for c in columns):
+        categories = np.unique(np.concatenate(
+            [c.categories.astype(str) for c in columns])).astype(object)
+        codes = []
+        for c in columns:
+            # -1 (missing) stays -1
+            remap = np.append(
+                np.searchsorted(
+                    categories.astype(str),
+                    c.categories.astype(str)),
+                -1).astype(np.int32)
+            codes.append(remap[c.codes])
+        return Categorical(np.concatenate(codes), categories)
+
+    if all(
+            not isinstance(c, Categorical) and c.dtype.kind in 'biuf'
+            for c in columns):
+        if any(is_masked(c) for c in columns):
+            return np.ma.concatenate([np.ma.asarray(c) for c in columns])
+        return np.concatenate(columns)
+
+    return np.concatenate([to_objects(c) for c in columns])
+
+
+class SynapseTable:
+    """Columns of equal length, by attribute name (see the module
+    documentation). Iterating over a table yields its rows as dicts."""
+
+    def __init__(self, columns):
+
+        self.columns = dict(columns)
+        lengths = set(column_length(c) for c in self.columns.values())
+        if len(lengths) > 1:
+            raise ValueError(f"Columns have different lengths: {lengths}")
+        self.length = lengths.pop() if lengths else 0
+
+    @staticmethod
+    def from_records(records):
+
+        names = list(dict.fromkeys(
+            name
+            for record in records
+            for name in record.keys()))
+        return SynapseTable({
+            name: encode_values([record.get(name) for record in records])
+            for name in names
+        })
+
+    def __len__(self):
+
+        return self.length
+
+    def __contains__(self, name):
+
+        return name in self.columns
+
+    def __getitem__(self, name):
+
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+
+        if column_length(values) != self.length:
+            raise ValueError(
+                f"Column {name} has length {column_length(values)}, "
+                f"expected {self.length}")
+        self.columns[name] = values
+
+    def names(self):
+
+        return list(self.columns.keys())
+
+    def select(self, index):
+        """A new table with the rows selected by ``index`` (a boolean mask or
+        row indices)."""
+
+        index = np.asarray(index)
+        table = SynapseTable({})
+        table.columns = {
+            name: take(values, index)
+            for name, values in self.columns.items()
+        }
+        table.length = (
+            int(np.count_nonzero(index)) if index.dtype == bool
+            else len(index))
+        return table
+
+    def codes(self, name):
+        """Codes of a categorical column, ``-1`` for missing values."""
+
+        return self.columns[name].codes
+
+    def categories(self, name):
+
+        return self.columns[name].categories
+
+    def is_missing(self, name):
+
+        values = self.columns[name]
+        if isinstance(values, Categorical):
+            return values.codes < 0
+        if is_masked(values):
+            return np.ma.getmaskarray(values)
+        if values.dtype == object:
+            return np.array([v is None for v in values], dtype=bool)
+        return np.zeros(self.length, dtype=bool)
+
+    def values(self, name):
+        """The values of a column as a list of Python values, ``None`` for
+        missing values."""
+
+        return as_list(self.columns[name])
+
+    def factorize(self, name):
+        """Distinct values of a column in the order of their first
+        occurrence (including ``None``, if values are missing).
+
+        Returns the list of values, the index of the first row of each
+        value, and for each row the index of its value.
+        """
+
+        values = self.columns[name]
+
+        if isinstance(values, Categorical):
+            keys = values.codes
+        elif not is_masked(values) and values.dtype.kind in 'biuf':
+            keys = values
+        else:
+            # anything hashable, by first occurrence
+            index = {}
+            keys = np.fromiter(
+                (index.setdefault(v, len(index)) for v in as_list(values)),
+                dtype=np.int64,
+                count=self.length)
+
+        _, first, inverse = np.unique(
+            keys,
+            return_index=True,
+            return_inverse=True)
+        order = np.argsort(first, kind='stable')
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        first = first[order]
+
+        return (
+            as_list(take(values, first)),
+            first,
+            rank[inverse.reshape(-1)])
+
+    def row(self, index):
+        """Row ``index`` as a dict."""
+
+        return {
+            name: as_list(take(values, slice(index, index + 1)))[0]
+            for name, values in self.columns.items()
+        }
+
+    def to_documents(self, chunk_size=100000):
+        """Iterate over rows as dicts, converting ``chunk_size`` rows at a
+        time."""
+
+        names = self.names()
+        for begin in range(0, self.length, chunk_size):
+            rows = slice(begin, min(begin + chunk_size, self.length))
+            values = [
+                as_list(take(self.columns[name], rows))
+                for name in names
+            ]
+            for row in zip(*values):
+                yield dict(zip(names, row))
+
+    def __iter__(self):
+
+        return self.to_documents()
+
+
+def concatenate(tables):
+    """Concatenate the rows of ``tables``. Columns missing in some of them
+    (or without any values) are filled with missing values of the type they
+    have in the others."""
+
+    names = list(dict.fromkeys(
+        name
+        for table in tables
+        for name in table.names()))
+
+    columns = {}
+    for name in names:
+        parts = [
+            table[name]
+            if name in table and not is_all_missing(table[name]) else None
+            for table in tables
+        ]
+        like = next(
+            (part for part in parts if part is not None),
+            np.zeros(0, dtype=object))
+        columns[name] = concatenate_columns([
+            part if part is not None else missing(len(table), like)
+            for table, part in zip(tables, parts)
+        ])
+    return SynapseTable(columns)
+
+
+def read_table(filename, chunk_size=10000):
+    """Read a consolidated synapse file (``.npz`` or JSON) into a table.
+
+    JSON files are decoded and encoded ``chunk_size`` synapses at a time, so
+    only one chunk of synapse dicts is in memory at once.
+    """
+
+    if filename.endswith('.npz'):
+        return SynapseTable(read_columns(filename, categorical=True))
+
+    synapses = iter_synapses(filename)
+    tables = []
+    while True:
+        chunk = list(itertools.islice(synapses, chunk_size))
+        if not chunk:
+            break
+        tables.append(SynapseTable.from_records(chunk))
+    return concatenate(tables)
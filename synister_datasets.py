@@ -0,0 +1,70 @@
+"""Datasets known to ``ingest.py``, with their consolidated synapse files
+and voxel sizes (zyx, in nm)."""
+
+DATASETS = {
+    "fafb": {
+        "files": [
+            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_connectors_by_hemi_lineage_v4.csv',
+            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_verified_predicted_synapses_by_transmitter_v4.csv',
+        ],
+        "holdout_files": [
+            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_connectors_by_hemi_lineage_confident_v4.csv',
+        ],
+        "voxel_size": (40, 4, 4),
+        "db_name": 'synister_fafb_v4',
+        "test_fraction": 0.2,       # fraction of whole dataset to use for testing
+        "validation_fraction": 0.2  # fraction of remaining data to use for validation
+    },
+    "fafb_confident": {
+        "files": [
+            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_connectors_by_hemi_lineage_confident_v4.csv',
+        ],
+        "voxel_size": (40, 4, 4),
+        "db_name": 'synister_fafb_v4_confident',
+        "test_fraction": 0.0,       # fraction of whole dataset to use for testing
+        "validation_fraction": 1.0  # fraction of remaining data to use for validation
+    },
+    "fafb_v3updated": {
+        "files": [
+            'fafb/consolidated/2021-12-08/2021-11-23_FAFB_connectors_by_hemi_lineage_v3.csv',
+        ],
+        "holdout_files": [
+            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_connectors_by_hemi_lineage_confident_v4.csv',
+        ],
+        "voxel_size": (40, 4, 4),
+        "db_name": 'synister_fafb_v4_v3updated',
+        "test_fraction": 0.2,       # fraction of whole dataset to use for testing
+        "validation_fraction": 0.2  # fraction of remaining data to use for validation
+    },
+    "fafb_v3updatedKC": {
+        "files": [
+            'fafb/consolidated/2021-12-08/2021-11-23_FAFB_connectors_by_hemi_lineage_v3.csv',
+            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_connectors_by_hemi_lineage_v4_KC_only.csv',
+        ],
+        "holdout_files": [
+            'fafb/consolidated/2021-12-08/2021-12-08_FAFB_connectors_by_hemi_lineage_confident_v4.csv',
+        ],
+        "voxel_size": (40, 4, 4),
+        "db_name": 'synister_fafb_v4_v3updatedKC',
+        "test_fraction": 0.2,       # fraction of whole dataset to use for testing
+        "validation_fraction": 0.2  # fraction of remaining data to use for validation
+    },
+    "hemi": {
+        "files": [
+            'hemi/consolidated/2021-10-27/hemibrain_connectors_by_hemi_lineage_October2021.json'
+        ],
+        "voxel_size": (8, 8, 8),
+        "db_name": 'synister_hemi_v1',
+        "test_fraction": 0.2,       # fraction of whole dataset to use for testing
+        "validation_fraction": 0.2  # fraction of remaining data to use for validation
+    },
+    "malevnc": {
+        "files": [
+            'malevnc/consolidated/vnc_filtered_090621/synapses.json'
+        ],
+        "voxel_size": (8, 8, 8),
+        "db_name": 'synister_malevnc_v0',
+        "test_fraction": 0.2,       # fraction of whole dataset to use for testing
+        "validation_fraction": 0.2  # fraction of remaining data to use for validation
+    }
+}
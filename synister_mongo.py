@@ -0,0 +1,285 @@
+"""Direct access to the MongoDB behind a ``SynisterDb``, for bulk ingestion."""
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from configparser import ConfigParser
+import datetime
+import itertools
+from pymongo import (
+    DeleteMany,
+    InsertOne,
+    MongoClient,
+    ReplaceOne,
+    UpdateMany)
+import uuid
+
+COLLECTIONS = ['synapses', 'skeletons', 'hemi_lineages']
+
+# index_information() entries that are not options of create_index()
+INDEX_FIELDS = {'key', 'v', 'ns'}
+
+# collection for the documents below, separate from synister's own
+# collections (including its 'meta')
+META_COLLECTION = 'ingest_meta'
+# document marking the last modification of a database
+LAST_MODIFIED = 'last_modified'
+# document describing how a database was created, see pipeline.py
+PROVENANCE = 'provenance'
+
+
+def get_client(credentials):
+    """Create a ``MongoClient`` from a synister credentials file."""
+
+    config = ConfigParser()
+    with open(credentials, 'r') as f:
+        config.read_file(f)
+
+    user = config.get('Credentials', 'user')
+    password = config.get('Credentials', 'password')
+    host = config.get('Credentials', 'host')
+    port = config.get('Credentials', 'port')
+
+    return MongoClient(
+        f'mongodb://{user}:{password}@{host}:{port}',
+        connect=False)
+
+
+def get_database(credentials, db_name, client=None):
+
+    if client is None:
+        client = get_client(credentials)
+    return client[db_name]
+
+
+def read_provenance(database):
+
+    return database[META_COLLECTION].find_one({'_id': PROVENANCE})
+
+
+def write_provenance(database, provenance):
+
+    database[META_COLLECTION].replace_one(
+        {'_id': PROVENANCE},
+        {**provenance, '_id': PROVENANCE},
+        upsert=True)
+
+
+def touch(database):
+    """Mark ``database`` as modified, to invalidate cached queries."""
+
+    database[META_COLLECTION].replace_one(
+        {'_id': LAST_MODIFIED},
+        {
+            '_id': LAST_MODIFIED,
+            'time': datetime.datetime.now(datetime.timezone.utc),
+            'version': uuid.uuid4().hex
+        },
+        upsert=True)
+
+
+def chunks(items, chunk_size):
+
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BulkWriter:
+    """Writes synapses, skeletons, hemi lineages and splits to a synister
+    database with unordered bulk operations, ``chunk_size`` documents per
+    request, spread over ``num_workers`` threads sharing one connection pool.
+
+    If ``synister_db`` (a ``SynisterDb``) is given, new documents are
+    inserted through its ``write()``, a chunk at a time. Splits are written
+    to the ``splits.<split name>`` fields of synapses, as
+    ``SynisterDb.make_split`` does.
+    """
+
+    def __init__(self, database, chunk_size=10000, num_workers=4, synister_db=None):
+
+        self.database = database
+        self.chunk_size = chunk_size
+        self.num_workers = num_workers
+        self.synister_db = synister_db
+        self.dropped_indexes = {}
+
+    def drop_indexes(self):
+        """Drop the indexes (except ``_id``) of all collections, to be
+        recreated with ``create_indexes`` after loading."""
+
+        existing = self.database.list_collection_names()
+        for collection in COLLECTIONS:
+            if collection not in existing:
+                continue
+            indexes = {
+                name: info
+                for name, info in self.database[collection].index_information().items()
+                if name != '_id_'
+            }
+            for name in indexes.keys():
+                self.database[collection].drop_index(name)
+            self.dropped_indexes[collection] = indexes
+
+    def create_indexes(self):
+        """Recreate the dropped indexes, with their names and options."""
+
+        for collection, indexes in self.dropped_indexes.items():
+            for name, info in indexes.items():
+                options = {
+                    option: value
+                    for option, value in info.items()
+                    if option not in INDEX_FIELDS
+                }
+                self.database[collection].create_index(
+                    info['key'],
+                    name=name,
+                    **options)
+        self.dropped_indexes = {}
+
+    def write(self, synapses=None, skeletons=None, hemi_lineages=None):
+
+        documents = {
+            'synapses': synapses,
+            'skeletons': skeletons,
+            'hemi_lineages': hemi_lineages
+        }
+
+        for collection, docs in documents.items():
+            if not docs:
+                continue
+            print(f"Writing {len(docs)} {collection}...")
+            # copies, inserting adds an _id to the documents
+            copies = (dict(doc) for doc in docs)
+            if self.synister_db is not None:
+                self.run(
+                    lambda chunk: self.synister_db.write(**{collection: chunk}),
+                    chunks(copies, self.chunk_size))
+                continue
+            self.bulk_write(
+                collection,
+                chunks(
+                    (InsertOne(doc) for doc in copies),
+                    self.chunk_size))
+
+    def replace(self, collection, key, documents):
+        """Replace (or insert) documents, identified by field ``key``."""
+
+        if not documents:
+            return
+        print(f"Replacing {len(documents)} {collection}...")
+        self.bulk_write(
+            collection,
+            chunks(
+                (
+                    ReplaceOne({key: doc[key]}, doc, upsert=True)
+                    for doc in documents
+                ),
+                self.chunk_size))
+
+    def delete(self, collection, key, values):
+        """Delete all documents with field ``key`` in ``values``."""
+
+        if not values:
+            return
+        print(f"Deleting {len(values)} {collection}...")
+        self.bulk_write(
+            collection,
+            [
+                [DeleteMany({key: {'$in': chunk}})]
+                for chunk in chunks(values, self.chunk_size)
+            ])
+
+    def write_splits(self, splits, unassigned=None):
+        """Store several splits at once.
+
+        ``splits`` maps split names to ``(train, test, validation)`` lists of
+        synapse IDs. ``unassigned`` optionally maps split names to synapse
+        IDs to remove from these splits. Synapses with the same partitions
+        across all splits are updated together, such that each synapse is
+        touched only once.
+        """
+
+        assignments = defaultdict(dict)
+        for split_name, partitions in splits.items():
+            for partition, synapse_ids in zip(
+                    ['train', 'test', 'validation'],
+                    partitions):
+                for synapse_id in synapse_ids:
+                    assignments[synapse_id][f'splits.{split_name}'] = partition
+        for split_name, synapse_ids in (unassigned or {}).items():
+            for synapse_id in synapse_ids:
+                # None unsets the partition
+                assignments[synapse_id][f'splits.{split_name}'] = None
+
+        synapse_ids_by_assignment = defaultdict(list)
+        for synapse_id, assignment in assignments.items():
+            key = tuple(sorted(assignment.items()))
+            synapse_ids_by_assignment[key].append(synapse_id)
+        del assignments
+
+        def update(assignment):
+            operations = {
+                '$set': {
+                    field: partition
+                    for field, partition in assignment
+                    if partition is not None
+                },
+                '$unset': {
+                    field: ''
+                    for field, partition in assignment
+                    if partition is None
+                }
+            }
+            return {
+                operator: fields
+                for operator, fields in operations.items()
+                if fields
+            }
+
+        print(
+            f"Writing splits {sorted(set(splits) | set(unassigned or {}))} in "
+            f"{len(synapse_ids_by_assignment)} groups...")
+        # one UpdateMany already covers a whole chunk of synapses, send them
+        # separately to spread them over the workers
+        self.bulk_write(
+            'synapses',
+            [
+                [UpdateMany(
+                    {'synapse_id': {'$in': chunk}},
+                    update(assignment))]
+                for assignment, synapse_ids
+                in synapse_ids_by_assignment.items()
+                for chunk in chunks(synapse_ids, self.chunk_size)
+            ])
+
+    def bulk_write(self, collection, batches):
+
+        collection = self.database[collection]
+        self.run(
+            lambda batch: collection.bulk_write(batch, ordered=False),
+            batches)
+
+    def run(self, write_batch, batches):
+
+        # batches are taken from the (possibly lazy) iterable only as workers
+        # become free, so at most 2 * num_workers batches exist at once
+        max_pending = 2 * self.num_workers
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            pending = set()
+            for batch in batches:
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        # re-raise exceptions from the workers
+                        future.result()
+                pending.add(pool.submit(write_batch, batch))
+            for future in pending:
+                future.result()
+
+        self.touch()
+
+    def touch(self):
+
+        touch(self.database)
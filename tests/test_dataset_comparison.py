@@ -0,0 +1,56 @@
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+pytest.importorskip('matplotlib')
+
+from dataset_comparison import (  # noqa: E402
+    FIELDS,
+    aggregate_dataset,
+    count,
+    dataset_to_dataframe,
+    fetch)
+
+
+def make_database():
+
+    database = mongomock.MongoClient()['synister_test']
+    database['skeletons'].insert_many([
+        {'skeleton_id': 1, 'nt_known': ['gaba']},
+        {'skeleton_id': 2, 'nt_known': ['gaba']},
+        {'skeleton_id': 3, 'nt_known': ['acetylcholine']},
+        {'skeleton_id': 4, 'nt_known': None},
+    ])
+    partitions = ['train', 'test', 'validation']
+    database['synapses'].insert_many([
+        {
+            'synapse_id': i,
+            'skeleton_id': i % 5 if i % 5 else None,
+            'splits': {
+                'skeleton': partitions[i % 3],
+                **({'synapse': partitions[i % 2]} if i % 7 else {})
+            }
+        }
+        for i in range(100)
+    ])
+    return database
+
+
+def test_aggregate_matches_synapse_counts():
+
+    database = make_database()
+    splits = ['skeleton', 'synapse']
+
+    aggregated = aggregate_dataset(database, 'test', splits)
+    synapses = dataset_to_dataframe('test', {
+        collection: fetch(database, collection)
+        for collection in FIELDS
+    })
+
+    # one row per NT and partitions, not per skeleton
+    assert len(aggregated) <= 3 * 3 * 3
+    assert aggregated['count'].sum() == len(synapses)
+    for split in splits:
+        by = ['nt', f'split_{split}']
+        expected = count(synapses, by)
+        counted = count(aggregated, by)
+        assert counted.to_dict() == expected.to_dict()
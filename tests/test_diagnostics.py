@@ -0,0 +1,66 @@
+import json
+import numpy as np
+
+from diagnostics import Diagnostics
+
+
+def test_record_many_keeps_all_events_below_sample_size():
+
+    events = Diagnostics(sample_size=10)
+    events.record_many('skipped', 4, lambda i: i)
+    events.record_many('skipped', 3, lambda i: 10 + i)
+
+    assert events.counts == {'skipped': 7}
+    assert events.samples['skipped'] == [0, 1, 2, 3, 10, 11, 12]
+
+
+def test_record_many_creates_details_of_sampled_events_only():
+
+    events = Diagnostics(sample_size=10)
+    created = []
+
+    def detail(i):
+        created.append(i)
+        return i
+
+    events.record_many('skipped', 100000, detail)
+
+    assert events.counts == {'skipped': 100000}
+    assert len(events.samples['skipped']) == 10
+    # the first sample_size events, and the ones replacing an entry
+    # (about sample_size * ln(num / sample_size) of them)
+    assert created[:10] == list(range(10))
+    assert len(created) < 200
+    assert set(events.samples['skipped']) <= set(created)
+
+
+def test_record_many_samples_uniformly():
+
+    num, sample_size, trials = 50, 5, 4000
+    hits = np.zeros(num, dtype=np.int64)
+    for seed in range(trials):
+        events = Diagnostics(sample_size=sample_size, seed=seed)
+        # mixed with single records, which share the reservoir
+        events.record('skipped', 0)
+        events.record_many('skipped', num - 1, lambda i: i + 1)
+        hits[events.samples['skipped']] += 1
+
+    # each event is sampled with probability sample_size / num
+    expected = trials * sample_size / num
+    assert np.all(np.abs(hits - expected) < 0.25 * expected)
+
+
+def test_record_many_writes_all_details(tmp_path):
+
+    events = Diagnostics(sample_size=2)
+    events.enable_detail(str(tmp_path / 'detail.jsonl'))
+    events.record_many('skipped', 5, lambda i: {'skid': np.int64(i)})
+    events.report()
+
+    with open(tmp_path / 'detail.jsonl') as f:
+        lines = [json.loads(line) for line in f]
+    assert lines == [
+        {'event': 'skipped', 'detail': {'skid': i}}
+        for i in range(5)
+    ]
+    events.reset()
@@ -0,0 +1,45 @@
+import pytest
+
+pytest.importorskip('funlib.math')
+pytest.importorskip('synister')
+
+from ingest import differs_from_first, find_duplicates  # noqa: E402
+from synapse_table import SynapseTable  # noqa: E402
+
+
+def test_duplicates_are_compared_by_value():
+
+    synapses = SynapseTable.from_records([
+        {'synapse_id': 1, 'x': 0, 'tags': ['a']},
+        {'synapse_id': 2, 'x': 0, 'tags': ['a']},
+        {'synapse_id': 1, 'x': 0, 'tags': ['a']},
+        {'synapse_id': 3, 'x': 0, 'tags': ['a']},
+        {'synapse_id': 2, 'x': 0, 'tags': ['b']},
+        {'synapse_id': 1, 'x': 0, 'tags': ['a']},
+        # equal to the first, not to the one before
+        {'synapse_id': 2, 'x': 0, 'tags': ['a']},
+    ])
+
+    differs = differs_from_first(synapses)
+    assert differs.tolist() == [
+        False, False, False, False, True, False, False]
+
+    duplicates = find_duplicates(synapses['synapse_id'], differs)
+    assert duplicates['identical']['ids'].tolist() == [1]
+    assert duplicates['identical']['counts'].tolist() == [3]
+    assert duplicates['conflicting']['ids'].tolist() == [2]
+    assert duplicates['retain'].tolist() == [0, 3]
+
+
+def test_no_duplicates():
+
+    synapses = SynapseTable.from_records([
+        {'synapse_id': i, 'x': i}
+        for i in range(5)
+    ])
+
+    duplicates = find_duplicates(
+        synapses['synapse_id'],
+        differs_from_first(synapses))
+    assert duplicates['num_duplicate_ids'] == 0
+    assert duplicates['retain'].tolist() == list(range(5))
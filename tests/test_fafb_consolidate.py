@@ -0,0 +1,63 @@
+import diagnostics
+import math
+import pytest
+
+pytest.importorskip('pandas')
+
+from fafb.consolidate import read_csv  # noqa: E402
+
+HEADER = (
+    'skid,known.classic.transmitter,known.other.transmitter,'
+    'ItoLee.Hemilineage,ItoLee.Lineage,connector_id,x,y,z\n')
+
+
+def test_malformed_connector_id_of_skipped_skeleton_is_ignored(tmp_path):
+
+    filename = tmp_path / 'synapses.csv'
+    filename.write_text(
+        HEADER +
+        '1,gaba,unknown,LB7,LB,10,1,2,43\n'
+        # skeleton 2 is skipped at its first row
+        '2,unknown,unknown,NA,NA,bad,1,2,3\n'
+        '2,gaba,unknown,NA,NA,bad,1,2,3\n'
+        '1,gaba,unknown,LB7,LB,unknown,x,2,3\n')
+
+    synapses = read_csv(str(filename), classic_other=True, num_workers=1)
+
+    assert synapses['skid'].tolist() == [1]
+    assert synapses['connector_id'].tolist() == [10]
+    assert synapses['z'].tolist() == [3.0]
+
+
+def test_malformed_connector_id_of_kept_skeleton_fails(tmp_path):
+
+    filename = tmp_path / 'synapses.csv'
+    filename.write_text(
+        HEADER +
+        '1,gaba,unknown,LB7,LB,10,1,2,43\n'
+        '1,gaba,unknown,LB7,LB,bad,1,2,43\n')
+
+    with pytest.raises(ValueError, match="'bad'"):
+        read_csv(str(filename), classic_other=True, num_workers=1)
+
+
+def test_coordinates_are_parsed_like_float(tmp_path):
+
+    filename = tmp_path / 'synapses.csv'
+    filename.write_text(
+        HEADER +
+        '1,gaba,unknown,LB7,LB,10,nan,1_000,43\n'
+        '1,gaba,unknown,LB7,LB,11,1,unknown,43\n')
+
+    diagnostics.reset()
+    synapses = read_csv(str(filename), classic_other=True, num_workers=1)
+
+    # float() accepts 'nan' and '1_000'
+    assert synapses['connector_id'].tolist() == [10]
+    assert math.isnan(synapses['x'][0])
+    assert synapses['y'][0] == 1000.0
+
+    [bad] = diagnostics.report()[diagnostics.BAD_COORDINATES]['samples']
+    assert bad['connector_id'] == 11
+    assert bad['error'] == \
+        "(1, unknown, 43): could not convert string to float: 'unknown'"
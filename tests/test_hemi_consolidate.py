@@ -0,0 +1,83 @@
+import diagnostics
+import numpy as np
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('synistereq')
+
+import hemi.consolidate  # noqa: E402
+from hemi.consolidate import read_csv  # noqa: E402
+
+HEADER = (
+    'bodyid,known.classic.transmitter,known.other.transmitter,'
+    'ItoLee.Hemilineage,inside,connector_id,x,y,z\n')
+
+
+class Repository:
+    """Stands in for HemiNeuprint, positions beyond z = 100 can't be
+    transformed."""
+
+    def transform_positions(self, positions):
+        if (positions[:, 0] > 100).any():
+            raise ValueError("out of bounds")
+        return positions * 2
+
+
+@pytest.fixture
+def repository(monkeypatch):
+    monkeypatch.setattr(hemi.consolidate, 'HemiNeuprint', Repository)
+
+
+def test_skeletons_are_skipped_from_their_first_row_without_nt(
+        tmp_path,
+        repository):
+
+    filename = tmp_path / 'synapses.csv'
+    filename.write_text(
+        HEADER +
+        '1,gaba,unknown,LB7,TRUE,10,1,2,3\n'
+        '2,gaba,unknown,NA,TRUE,20,1,2,3\n'
+        # body 1 is skipped from here on, body 2 is not
+        '1,unknown,unknown,LB7,TRUE,11,1,2,3\n'
+        '1,gaba,unknown,LB7,TRUE,bad,1,2,3\n'
+        '2,unknown,KC_acetylcholine,NA,FALSE,21,4,5,6\n'
+        '2,gaba,unknown,NA,TRUE,unknown,x,5,6\n'
+        '2,gaba,unknown,NA,TRUE,23,1,2,300\n')
+
+    diagnostics.reset()
+    synapses = read_csv(str(filename), num_workers=1)
+
+    assert synapses['body_id'].tolist() == [1, 2, 2]
+    assert synapses['connector_id'].tolist() == [10, 20, 21]
+    assert synapses['neurotransmitter'].tolist() == \
+        ['gaba', 'gaba', 'acetylcholine']
+    assert synapses['hemilineage'].isna().tolist() == [False, True, True]
+    assert np.array_equal(synapses[['z', 'y', 'x']], [[6, 4, 2]] * 2 + [[12, 10, 8]])
+
+    report = diagnostics.report()
+    assert report[diagnostics.SKIPPED_SKELETON]['samples'] == \
+        [{'body_id': 1, 'reason': "no known NT"}]
+    assert report[diagnostics.BAD_COORDINATES]['samples'] == [
+        {
+            'connector_id': None,
+            'body_id': 2,
+            'error': "could not convert string to float: 'x'"
+        },
+        {
+            'connector_id': 23,
+            'body_id': 2,
+            'error': "transform failed: out of bounds"
+        }
+    ]
+
+
+def test_malformed_connector_id_of_kept_skeleton_fails(tmp_path, repository):
+
+    filename = tmp_path / 'synapses.csv'
+    filename.write_text(
+        HEADER +
+        '1,gaba,unknown,LB7,TRUE,10,1,2,3\n'
+        '1,gaba,unknown,LB7,TRUE,bad,1,2,3\n')
+
+    with pytest.raises(ValueError, match="'bad'"):
+        read_csv(str(filename), num_workers=1)
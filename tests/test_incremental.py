@@ -0,0 +1,148 @@
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from incremental import (  # noqa: E402
+    changed_split_assignments,
+    content_hash,
+    read_state,
+    update_database,
+    update_synapse_split)
+from synapse_table import SynapseTable  # noqa: E402
+from synister_mongo import BulkWriter  # noqa: E402
+
+
+def synapse(synapse_id, skeleton_id, neurotransmitter, x=0):
+
+    document = {
+        'synapse_id': synapse_id,
+        'skeleton_id': skeleton_id,
+        'neurotransmitter': neurotransmitter,
+        'x': x
+    }
+    document['content_hash'] = content_hash(document)
+    return document
+
+
+def table(documents):
+
+    return SynapseTable.from_records([dict(d) for d in documents])
+
+
+def partitions(database):
+
+    return {
+        document['synapse_id']: document.get('splits', {}).get('skeleton')
+        for document in database['synapses'].find()
+    }
+
+
+@pytest.fixture
+def database():
+
+    database = mongomock.MongoClient()['synister_test']
+    writer = BulkWriter(database, chunk_size=2, num_workers=1)
+
+    # acetylcholine split by skeleton, gaba randomly per synapse
+    writer.write(synapses=[
+        synapse(1, 10, 'acetylcholine'),
+        synapse(2, 10, 'acetylcholine'),
+        synapse(3, 11, 'acetylcholine'),
+        synapse(4, 12, 'acetylcholine'),
+        synapse(5, 20, 'gaba'),
+        synapse(6, 20, 'gaba'),
+        synapse(7, 21, 'gaba'),
+    ])
+    writer.write_splits({
+        'skeleton': ([1, 2, 5], [3, 6], [4, 7])
+    })
+    return database
+
+
+def update(database, documents):
+
+    writer = BulkWriter(database, chunk_size=2, num_workers=1)
+    previous = read_state(database)
+    synapses = table(documents)
+    update_database(writer, previous, synapses, skeletons=[], hemi_lineages=[])
+    split = update_synapse_split(
+        synapses,
+        'skeleton_id',
+        'skeleton',
+        previous,
+        test_fraction=0.2,
+        validation_fraction=0.2)
+    changed, unassigned = changed_split_assignments(
+        {'skeleton': split},
+        previous)
+    writer.write_splits(changed, unassigned)
+    return changed, unassigned
+
+
+def test_existing_synapses_keep_their_partition(database):
+
+    changed, unassigned = update(database, [
+        # changed content
+        synapse(1, 10, 'acetylcholine', x=1),
+        synapse(2, 10, 'acetylcholine'),
+        synapse(3, 11, 'acetylcholine'),
+        synapse(4, 12, 'acetylcholine'),
+        synapse(5, 20, 'gaba'),
+        synapse(6, 20, 'gaba'),
+        synapse(7, 21, 'gaba'),
+        # new synapses of existing skeletons
+        synapse(8, 11, 'acetylcholine'),
+        synapse(9, 12, 'acetylcholine'),
+    ])
+
+    assert changed == {'skeleton': ([], [8], [9])}
+    assert unassigned == {'skeleton': []}
+    assert partitions(database) == {
+        1: 'train', 2: 'train', 3: 'test', 4: 'validation',
+        5: 'train', 6: 'test', 7: 'validation',
+        8: 'test', 9: 'validation'
+    }
+    assert database['synapses'].find_one({'synapse_id': 1})['x'] == 1
+
+
+def test_new_skeletons_and_random_split_neurotransmitters(database):
+
+    update(database, [
+        synapse(1, 10, 'acetylcholine'),
+        synapse(2, 10, 'acetylcholine'),
+        synapse(3, 11, 'acetylcholine'),
+        synapse(4, 12, 'acetylcholine'),
+        synapse(5, 20, 'gaba'),
+        synapse(6, 20, 'gaba'),
+        synapse(7, 21, 'gaba'),
+        # a new skeleton is assigned as a whole
+        synapse(30, 13, 'acetylcholine'),
+        synapse(31, 13, 'acetylcholine'),
+        # gaba was split per synapse, skeleton 20 is in train and test
+        *[synapse(40 + i, 20, 'gaba') for i in range(10)],
+    ])
+
+    assigned = partitions(database)
+    assert assigned[30] == assigned[31]
+    gaba = [assigned[40 + i] for i in range(10)]
+    assert len(set(gaba)) > 1
+    assert all(gaba)
+
+
+def test_removed_synapses_leave_the_split(database):
+
+    changed, unassigned = update(database, [
+        synapse(1, 10, 'acetylcholine'),
+        synapse(2, 10, None),
+        synapse(3, 11, 'acetylcholine'),
+        synapse(5, 20, 'gaba'),
+        synapse(6, 20, 'gaba'),
+        synapse(7, 21, 'gaba'),
+    ])
+
+    assert unassigned == {'skeleton': [2, 4]}
+    assigned = partitions(database)
+    assert 4 not in assigned
+    assert assigned[2] is None
+    assert 'skeleton' not in database['synapses'].find_one(
+        {'synapse_id': 2})['splits']
@@ -0,0 +1,25 @@
+import pytest
+
+pytest.importorskip('funlib.math')
+pytest.importorskip('synister')
+
+from pipeline import BASE_DIR, consolidate_stage  # noqa: E402
+
+
+def test_consolidation_depends_on_shared_modules():
+
+    stage = consolidate_stage('malevnc', {'files': {}, 'stages': {}})
+
+    assert set(stage['code']) == {
+        'malevnc/consolidate.py',
+        'chunked_csv.py',
+        'diagnostics.py',
+        'spatial_index.py',
+        'synapse_io.py'
+    }
+    assert stage['command'][1:] == ['-m', 'malevnc.consolidate']
+    assert stage['cwd'] == BASE_DIR
+
+    # hemi parses its columns with fafb's helpers
+    stage = consolidate_stage('hemi', {'files': {}, 'stages': {}})
+    assert 'fafb/consolidate.py' in stage['code']
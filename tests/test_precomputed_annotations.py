@@ -0,0 +1,122 @@
+import json
+import numpy as np
+import os
+
+from precomputed_annotations import (
+    is_current,
+    load_columns,
+    source_description,
+    write_annotations,
+    write_by_id)
+
+
+def read_by_id(directory, sharding, annotation_id):
+    """Look up an annotation as neuroglancer does for sharded by_id
+    indices."""
+
+    minishard_bits = sharding['minishard_bits']
+    shard_bits = sharding['shard_bits']
+    minishard = annotation_id & ((1 << minishard_bits) - 1)
+    shard = (annotation_id >> minishard_bits) & ((1 << shard_bits) - 1)
+    name = format(shard, 'x').zfill(int(np.ceil(shard_bits / 4)))
+
+    with open(os.path.join(directory, 'by_id', f'{name}.shard'), 'rb') as f:
+        data = f.read()
+    header_size = 16 << minishard_bits
+    start, end = np.frombuffer(data, dtype='<u8', count=2, offset=16 * minishard)
+    index = np.frombuffer(
+        data[header_size + int(start):header_size + int(end)],
+        dtype='<u8').reshape(3, -1)
+    keys = np.cumsum(index[0])
+    offsets = np.cumsum(index[1] + np.append(0, index[2][:-1]))
+
+    i = int(np.flatnonzero(keys == annotation_id)[0])
+    chunk_start = header_size + int(offsets[i])
+    return data[chunk_start:chunk_start + int(index[2][i])]
+
+
+def test_by_id_is_sharded(tmp_path):
+
+    num_synapses = 3000
+    random = np.random.RandomState(0)
+    synapses = {
+        'z': random.uniform(0, 1000, num_synapses),
+        'y': random.uniform(0, 1000, num_synapses),
+        'x': random.uniform(0, 1000, num_synapses),
+        'neurotransmitter': random.choice(['gaba', 'glutamate'], num_synapses)
+    }
+    write_annotations(
+        synapses,
+        str(tmp_path),
+        limit=100,
+        properties=['neurotransmitter'])
+
+    with open(tmp_path / 'info') as f:
+        info = json.load(f)
+    sharding = info['by_id']['sharding']
+    labels = info['properties'][0]['enum_labels']
+
+    assert len(os.listdir(tmp_path / 'by_id')) == 1 << sharding['shard_bits']
+    for annotation_id in [0, 1, 63, 64, 1234, num_synapses - 1]:
+        record = np.frombuffer(
+            read_by_id(str(tmp_path), sharding, annotation_id),
+            dtype=[('point', '<f4', 3), ('neurotransmitter', 'u1'),
+                   ('padding', 'u1', 3)])[0]
+        expected = [synapses[d][annotation_id] for d in 'zyx']
+        assert np.allclose(record['point'], expected)
+        assert labels[record['neurotransmitter']] == \
+            synapses['neurotransmitter'][annotation_id]
+
+
+def test_by_id_is_split_into_shards(tmp_path):
+
+    records = np.arange(5000, dtype='<u4')
+    ids = np.arange(5000, dtype='<u8')
+
+    sharding = write_by_id(
+        str(tmp_path),
+        records,
+        ids,
+        annotations_per_shard=256)
+
+    assert sharding['shard_bits'] == 5
+    assert len(os.listdir(tmp_path / 'by_id')) == 32
+    for annotation_id in [0, 255, 256, 4095, 4096, 4999]:
+        record = read_by_id(str(tmp_path), sharding, annotation_id)
+        assert np.frombuffer(record, dtype='<u4')[0] == annotation_id
+
+
+def test_annotations_are_rewritten_for_a_different_source(tmp_path):
+
+    synapse_file = tmp_path / 'synapses.json'
+    synapse_file.write_text('[]')
+    output_dir = str(tmp_path / 'annotations')
+
+    source = source_description(str(synapse_file))
+    assert not is_current(output_dir, source)
+
+    write_annotations({d: [] for d in 'zyx'}, output_dir, source=source)
+    assert is_current(output_dir, source)
+
+    synapse_file.write_text('[{}]')
+    assert not is_current(output_dir, source_description(str(synapse_file)))
+
+
+def test_json_source_is_loaded_as_columns(tmp_path):
+
+    synapse_file = str(tmp_path / 'synapses.json')
+    with open(synapse_file, 'w') as f:
+        json.dump([
+            {'x': 1.0, 'y': 2.0, 'z': 3.0, 'neurotransmitter': 'gaba'},
+            {'x': 4.0, 'y': 5.0, 'z': 6.0, 'neurotransmitter': None},
+        ], f)
+
+    columns = load_columns(synapse_file)
+    assert columns['neurotransmitter'].tolist() == ['gaba', None]
+    output_dir = tmp_path / 'annotations'
+    write_annotations(columns, str(output_dir), properties=['neurotransmitter'])
+
+    with open(output_dir / 'info') as f:
+        info = json.load(f)
+    assert info['properties'][0]['enum_labels'] == ['gaba', 'none']
+    assert info['lower_bound'] == [3.0, 2.0, 1.0]
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+from spatial_index import SpatialIndex, write_index
+from synapse_io import write_synapses
+
+VOXEL_SIZE = (40, 4, 4)
+CHUNK_VOXELS = (2, 10, 10)
+
+
+@pytest.fixture
+def synapses(tmp_path):
+    """An indexed synapse file, and the positions (zyx) of its synapses,
+    NaN where a coordinate is missing."""
+
+    random = np.random.RandomState(0)
+    num_synapses = 2000
+    positions = random.uniform(-200, 600, size=(num_synapses, 3))
+    # missing (None) and NaN coordinates
+    missing = random.rand(num_synapses, 3) < 0.02
+    not_a_number = random.rand(num_synapses, 3) < 0.02
+
+    records = []
+    for i, (position, absent, nan) in enumerate(
+            zip(positions, missing, not_a_number)):
+        coordinates = {
+            d: None if absent[j] else float('nan') if nan[j] else position[j]
+            for j, d in enumerate('zyx')
+        }
+        records.append({'synapse_id': i, **coordinates})
+    positions[missing | not_a_number] = np.nan
+
+    filename = str(tmp_path / 'synapses.npz')
+    write_synapses(records, filename)
+    write_index(filename, VOXEL_SIZE, CHUNK_VOXELS)
+
+    return SpatialIndex(filename), positions
+
+
+def brute_force(positions, inside):
+
+    valid = np.isfinite(positions).all(axis=1)
+    with np.errstate(invalid='ignore'):
+        return np.flatnonzero(valid & inside(positions))
+
+
+def test_rows_without_position_are_not_indexed(synapses):
+
+    index, positions = synapses
+
+    assert np.isnan(positions).any()
+    assert sorted(index.rows.tolist()) == \
+        np.flatnonzero(np.isfinite(positions).all(axis=1)).tolist()
+
+
+def test_query_roi_matches_brute_force(synapses):
+
+    index, positions = synapses
+    random = np.random.RandomState(1)
+
+    for _ in range(50):
+        begin = random.uniform(-300, 600, size=3)
+        end = begin + random.uniform(0, 400, size=3)
+        expected = brute_force(
+            positions,
+            lambda p: np.all((p >= begin) & (p < end), axis=1))
+        assert sorted(index.query_roi(begin, end).tolist()) == \
+            expected.tolist()
+
+
+def test_query_radius_matches_brute_force(synapses):
+
+    index, positions = synapses
+    random = np.random.RandomState(2)
+
+    for _ in range(50):
+        center = random.uniform(-300, 700, size=3)
+        radius = random.uniform(0, 300)
+        expected = brute_force(
+            positions,
+            lambda p: np.sum((p - center)**2, axis=1) <= radius**2)
+        assert sorted(index.query_radius(center, radius).tolist()) == \
+            expected.tolist()
+
+
+def test_query_chunk_matches_brute_force(synapses):
+
+    index, positions = synapses
+    chunk_size = np.array(VOXEL_SIZE) * CHUNK_VOXELS
+
+    # all chunks around the synapses, including negative grid coordinates
+    valid = np.isfinite(positions).all(axis=1)
+    chunks = np.floor(positions[valid] / chunk_size).astype(np.int64)
+    first = chunks.min(axis=0) - 1
+    last = chunks.max(axis=0) + 1
+
+    found = []
+    for chunk in np.ndindex(*(last - first + 1)):
+        chunk = first + chunk
+        expected = brute_force(
+            positions,
+            lambda p: np.all(np.floor(p / chunk_size) == chunk, axis=1))
+        rows = index.query_chunk(chunk)
+        assert sorted(rows.tolist()) == expected.tolist()
+        found += rows.tolist()
+
+    # all indexed synapses are in one of these chunks
+    assert sorted(found) == sorted(index.rows.tolist())
+    assert len(index.query_chunk((100, 100, 100))) == 0
@@ -0,0 +1,185 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('funlib.math')
+pytest.importorskip('synister')
+
+from ingest import (  # noqa: E402
+    ImpossibleSplit,
+    create_solver_inputs,
+    create_split_lookups,
+    create_synapse_split,
+    find_optimal_split_or_fallback)
+import ingest  # noqa: E402
+from synapse_table import SynapseTable  # noqa: E402
+
+
+def make_synapses(num_skeletons=20, synapses_per_skeleton=10):
+
+    neurotransmitters = ['acetylcholine', 'gaba']
+    return SynapseTable.from_records([
+        {
+            'synapse_id': skeleton * synapses_per_skeleton + i,
+            'skeleton_id': skeleton,
+            'brain_region': f'R{skeleton % 4}',
+            'neurotransmitter': neurotransmitters[skeleton % 2]
+        }
+        for skeleton in range(num_skeletons)
+        for i in range(synapses_per_skeleton)
+    ])
+
+
+def split(lookups, synapse_idxs, neurotransmitters, synapse_split_nts, fraction):
+
+    return find_optimal_split_or_fallback(
+        lookups=lookups,
+        solver_inputs=create_solver_inputs(lookups),
+        synapse_idxs=synapse_idxs,
+        neurotransmitters=neurotransmitters,
+        synapse_split_nts=synapse_split_nts,
+        set_b_fraction=fraction,
+        set_a_name='a',
+        set_b_name='b',
+        split_attribute='skeleton_id')
+
+
+def test_fallback_without_neurotransmitters_to_optimize():
+
+    lookups = create_split_lookups(make_synapses(), 'skeleton_id')
+    synapse_idxs = np.arange(len(lookups['synapse_ids']))
+
+    # all NTs fell back to a random split already
+    a, b, neurotransmitters, synapse_split_nts = split(
+        lookups,
+        synapse_idxs,
+        neurotransmitters=[],
+        synapse_split_nts=[0, 1],
+        fraction=0.5)
+
+    assert neurotransmitters == []
+    assert synapse_split_nts == [0, 1]
+    assert len(a) == len(b) == 100
+    assert sorted(np.concatenate([a, b]).tolist()) == synapse_idxs.tolist()
+
+
+def fake_solver(calls, impossible):
+    """Stands in for synister's solver: supersets divisible by 5 go to B,
+    ``impossible`` NTs raise ``ImpossibleSplit``."""
+
+    def find_optimal_split(
+            synapse_ids,
+            superset_by_synapse_id,
+            nt_by_synapse_id,
+            neurotransmitters,
+            supersets,
+            train_fraction):
+
+        calls.append(list(neurotransmitters))
+        for nt in neurotransmitters:
+            if nt in impossible:
+                raise ImpossibleSplit(nt, 0.0, train_fraction)
+
+        a_set = {}
+        b_set = {}
+        for synapse_id in synapse_ids:
+            assert nt_by_synapse_id[synapse_id] in neurotransmitters
+            superset = superset_by_synapse_id[synapse_id]
+            target = b_set if superset % 5 == 0 else a_set
+            target.setdefault(superset, []).append(synapse_id)
+        return a_set, b_set
+
+    return find_optimal_split
+
+
+def test_impossible_split_falls_back_to_random_split(monkeypatch):
+
+    calls = []
+    monkeypatch.setattr(
+        ingest,
+        'find_optimal_split',
+        fake_solver(calls, impossible=[('gaba',)]))
+
+    synapses = make_synapses()
+    lookups = create_split_lookups(synapses, 'skeleton_id')
+    a, b, neurotransmitters, synapse_split_nts = split(
+        lookups,
+        np.arange(len(lookups['synapse_ids'])),
+        neurotransmitters=[0, 1],
+        synapse_split_nts=[],
+        fraction=0.5)
+
+    # the solver is retried without the NT that can't be split
+    assert calls == [[('acetylcholine',), ('gaba',)], [('acetylcholine',)]]
+    assert neurotransmitters == [0]
+    assert synapse_split_nts == [1]
+
+    skeletons = lookups['superset_codes']
+    nt_codes = lookups['nt_codes']
+    # acetylcholine by superset, gaba randomly per synapse
+    assert set(skeletons[a[nt_codes[a] == 0]] % 5) == {2, 4, 1, 3}
+    assert set(skeletons[b[nt_codes[b] == 0]] % 5) == {0}
+    assert np.sum(nt_codes[a] == 1) == np.sum(nt_codes[b] == 1) == 50
+    assert sorted(np.concatenate([a, b]).tolist()) == list(range(200))
+
+
+def test_infeasible_neurotransmitters_are_detected_up_front(monkeypatch):
+
+    calls = []
+    monkeypatch.setattr(ingest, 'find_optimal_split', fake_solver(calls, []))
+
+    # acetylcholine is spread evenly over five skeletons, but 84 of the 100
+    # gaba synapses are in skeleton 1
+    synapses = SynapseTable.from_records([
+        {
+            'synapse_id': i,
+            'skeleton_id': 1 if i % 2 and i < 160 else i % 10,
+            'neurotransmitter': 'gaba' if i % 2 else 'acetylcholine'
+        }
+        for i in range(200)
+    ])
+    lookups = create_split_lookups(synapses, 'skeleton_id')
+
+    for max_deviation, expected_calls, expected_split_nts in [
+            (None, [[('acetylcholine',), ('gaba',)]], []),
+            (0.4, [[('acetylcholine',), ('gaba',)]], []),
+            (0.1, [[('acetylcholine',)]], [1])]:
+
+        calls.clear()
+        a, b, neurotransmitters, synapse_split_nts = find_optimal_split_or_fallback(
+            lookups=lookups,
+            solver_inputs=create_solver_inputs(lookups),
+            synapse_idxs=np.arange(200),
+            neurotransmitters=[0, 1],
+            synapse_split_nts=[],
+            set_b_fraction=0.5,
+            set_a_name='a',
+            set_b_name='b',
+            split_attribute='skeleton_id',
+            max_deviation=max_deviation)
+
+        # gaba's split deviates at least 0.84 - 0.5 from the target
+        assert calls == expected_calls
+        assert synapse_split_nts == expected_split_nts
+        assert sorted(np.concatenate([a, b]).tolist()) == list(range(200))
+
+
+def test_split_partitions_synapses(monkeypatch):
+
+    monkeypatch.setattr(
+        ingest,
+        'find_optimal_split',
+        fake_solver([], impossible=[('gaba',)]))
+
+    synapses = make_synapses()
+    lookups = create_split_lookups(synapses, 'skeleton_id')
+    train, test, validation = create_synapse_split(
+        lookups,
+        'skeleton_id',
+        'skeleton',
+        test_fraction=0.2,
+        validation_fraction=0.2)
+
+    # fallback NTs are only split once per level, no synapse is assigned twice
+    synapse_ids = train + test + validation
+    assert len(synapse_ids) == len(set(synapse_ids)) == len(synapses)
+    assert set(synapse_ids) == set(synapses.values('synapse_id'))
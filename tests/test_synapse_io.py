@@ -0,0 +1,187 @@
+import json
+import numpy as np
+import pytest
+
+from synapse_io import (
+    Categorical,
+    iter_json_list,
+    iter_synapses,
+    read_columns,
+    read_synapses,
+    write_synapses)
+from synapse_table import SynapseTable, read_table
+
+SYNAPSES = [
+    {
+        'x': 1, 'y': 2, 'z': 3,
+        'connector_id': 2**62 + 1,
+        'skid': 7,
+        'neurotransmitter': 'gaba',
+        'hemilineage': 'LB7',
+        'score': 0.5,
+        'inside': True
+    },
+    {
+        'x': 4, 'y': 5, 'z': 6,
+        'connector_id': None,
+        'skid': 8,
+        'neurotransmitter': 'acetylcholine',
+        'hemilineage': None,
+        'score': None,
+        'inside': False
+    },
+    {
+        'x': 7, 'y': 8, 'z': 9,
+        'connector_id': 3,
+        'skid': 7,
+        'neurotransmitter': 'gaba',
+        'hemilineage': 'LB7',
+        'score': 1.5,
+        'inside': None
+    },
+]
+
+
+def test_npz_round_trip(tmp_path):
+
+    filename = str(tmp_path / 'synapses.npz')
+    write_synapses(SYNAPSES, filename)
+
+    assert read_synapses(filename) == SYNAPSES
+    assert list(iter_synapses(filename)) == SYNAPSES
+
+    # and from columns, as written by the consolidators
+    columns = read_columns(filename)
+    write_synapses(columns, str(tmp_path / 'copy.npz'))
+    assert read_synapses(str(tmp_path / 'copy.npz')) == SYNAPSES
+
+
+def test_npz_column_types(tmp_path):
+
+    filename = str(tmp_path / 'synapses.npz')
+    write_synapses(SYNAPSES, filename)
+
+    columns = read_columns(filename, categorical=True)
+    assert list(columns.keys()) == list(SYNAPSES[0].keys())
+    assert columns['x'].dtype == np.int64
+    assert columns['connector_id'].dtype == np.int64
+    assert columns['connector_id'].mask.tolist() == [False, True, False]
+    assert columns['score'].dtype == np.float64
+    assert columns['inside'].dtype == bool
+    assert isinstance(columns['neurotransmitter'], Categorical)
+    assert columns['hemilineage'].codes.tolist() == [0, -1, 0]
+
+    mapped = read_columns(filename, mmap=True)
+    assert isinstance(mapped['x'].base, np.memmap) or \
+        isinstance(mapped['x'], np.memmap)
+    assert mapped['x'].tolist() == [1, 4, 7]
+
+
+def test_json_round_trip(tmp_path):
+
+    filename = str(tmp_path / 'synapses.json')
+    write_synapses(SYNAPSES, filename)
+
+    assert read_synapses(filename) == SYNAPSES
+    assert list(iter_synapses(filename)) == SYNAPSES
+
+
+def test_table_round_trip(tmp_path):
+
+    for name in ['synapses.npz', 'synapses.json']:
+
+        filename = str(tmp_path / name)
+        write_synapses(SYNAPSES, filename)
+        table = read_table(filename)
+
+        assert len(table) == len(SYNAPSES)
+        assert list(table) == SYNAPSES
+        assert table.is_missing('hemilineage').tolist() == [False, True, False]
+
+        write_synapses(table.columns, str(tmp_path / 'copy.npz'))
+        assert read_synapses(str(tmp_path / 'copy.npz')) == SYNAPSES
+
+
+def test_json_table_is_read_in_chunks(tmp_path):
+
+    filename = str(tmp_path / 'synapses.json')
+    write_synapses(SYNAPSES, filename)
+    expected = SynapseTable.from_records(SYNAPSES)
+
+    # with one synapse per chunk, the chunk of the second synapse has no
+    # hemilineage and score, and the last none for 'inside'
+    for chunk_size in [1, 2, 100]:
+        table = read_table(filename, chunk_size=chunk_size)
+        assert list(table) == SYNAPSES
+        for name in SYNAPSES[0]:
+            assert type(table[name]) is type(expected[name])
+        assert table['hemilineage'].codes.tolist() == [0, -1, 0]
+        assert table['score'].mask.tolist() == [False, True, False]
+
+    filename = str(tmp_path / 'empty.json')
+    write_synapses([], filename)
+    assert len(read_table(filename)) == 0
+
+
+def test_json_table_is_streamed(tmp_path, monkeypatch):
+
+    filename = str(tmp_path / 'synapses.json')
+    write_synapses(SYNAPSES, filename)
+
+    def load(*args, **kwargs):
+        raise AssertionError("the whole file was loaded")
+
+    monkeypatch.setattr(json, 'load', load)
+    assert list(read_table(filename, chunk_size=2)) == SYNAPSES
+
+
+def test_table_from_records_matches_npz(tmp_path):
+
+    filename = str(tmp_path / 'synapses.npz')
+    write_synapses(SYNAPSES, filename)
+
+    from_npz = read_table(filename)
+    from_records = SynapseTable.from_records(SYNAPSES)
+
+    for name in SYNAPSES[0]:
+        assert from_npz.values(name) == from_records.values(name)
+    assert from_npz.factorize('skid')[0] == [7, 8]
+    assert from_npz.factorize('neurotransmitter')[0] == \
+        ['gaba', 'acetylcholine']
+
+
+def test_iter_synapses_in_small_chunks(tmp_path):
+
+    synapses = [
+        dict(synapse, x=i, neurotransmitter=f'nt{i % 3}')
+        for i, synapse in enumerate(SYNAPSES * 50)
+    ]
+
+    filename = str(tmp_path / 'synapses.npz')
+    write_synapses(synapses, filename)
+    assert list(iter_synapses(filename, chunk_size=7)) == synapses
+
+    filename = str(tmp_path / 'synapses.json')
+    write_synapses(synapses, filename)
+    with open(filename) as f:
+        assert list(iter_json_list(f, block_size=5)) == synapses
+
+
+def test_iter_json_list_edge_cases(tmp_path):
+
+    filename = tmp_path / 'list.json'
+    for text, items in [
+            ('[]', []),
+            (' [ ] ', []),
+            ('[12345, -1.5e3,"a,]b" , {"c": [1, 2]}, null]',
+             [12345, -1.5e3, 'a,]b', {'c': [1, 2]}, None])]:
+        filename.write_text(text)
+        for block_size in [1, 2, 3, 100]:
+            with open(filename) as f:
+                assert list(iter_json_list(f, block_size)) == items
+
+    for text in ['', '{}', '[1, 2', '[1 2]']:
+        filename.write_text(text)
+        with open(filename) as f:
+            with pytest.raises(ValueError):
+                list(iter_json_list(f, 2))
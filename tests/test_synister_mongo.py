@@ -0,0 +1,118 @@
+import pytest
+
+mongomock = pytest.importorskip('mongomock')
+
+from synister_mongo import (  # noqa: E402
+    LAST_MODIFIED,
+    META_COLLECTION,
+    BulkWriter)
+
+
+def test_indexes_are_recreated_with_names_and_options():
+
+    database = mongomock.MongoClient()['synister_test']
+    synapses = database['synapses']
+    synapses.create_index([('synapse_id', 1)], name='synapse_id', unique=True)
+    synapses.create_index(
+        [('z', 1), ('y', 1), ('x', 1)],
+        name='position',
+        sparse=True)
+    before = synapses.index_information()
+
+    writer = BulkWriter(database)
+    writer.drop_indexes()
+    assert not {'synapse_id', 'position'} & set(synapses.index_information())
+
+    writer.write(synapses=[{'synapse_id': 1, 'x': 0, 'y': 0, 'z': 0}])
+    writer.create_indexes()
+    assert synapses.index_information() == before
+
+
+def test_written_documents_are_copies():
+
+    database = mongomock.MongoClient()['synister_test']
+    documents = [{'synapse_id': i} for i in range(5)]
+
+    BulkWriter(database, chunk_size=2).write(synapses=documents)
+
+    assert documents == [{'synapse_id': i} for i in range(5)]
+    assert database['synapses'].count_documents({}) == 5
+
+
+def test_documents_are_written_through_synister():
+
+    class SynisterDb:
+
+        def __init__(self):
+            self.written = []
+
+        def write(self, synapses=None, skeletons=None, hemi_lineages=None):
+            self.written.append((synapses, skeletons, hemi_lineages))
+
+    database = mongomock.MongoClient()['synister_test']
+    synister_db = SynisterDb()
+    BulkWriter(database, chunk_size=2, synister_db=synister_db).write(
+        synapses=[{'synapse_id': i} for i in range(3)],
+        skeletons=[{'skeleton_id': 1}])
+
+    assert sorted(synister_db.written, key=str) == sorted([
+        ([{'synapse_id': 0}, {'synapse_id': 1}], None, None),
+        ([{'synapse_id': 2}], None, None),
+        (None, [{'skeleton_id': 1}], None),
+    ], key=str)
+    assert database['synapses'].count_documents({}) == 0
+
+
+def test_writes_and_splits_mark_the_database_as_modified():
+
+    database = mongomock.MongoClient()['synister_test']
+
+    def version():
+        marker = database[META_COLLECTION].find_one({'_id': LAST_MODIFIED})
+        return marker and marker['version']
+
+    assert version() is None
+    writer = BulkWriter(database)
+    writer.write(synapses=[{'synapse_id': 1}])
+    written = version()
+    assert written is not None
+
+    writer.write_splits({'synapse': ([1], [], [])})
+    assert version() not in (None, written)
+    assert 'meta' not in database.list_collection_names()
+
+
+def test_batches_are_taken_as_workers_become_free():
+
+    writer = BulkWriter(mongomock.MongoClient()['synister_test'], num_workers=2)
+    created = []
+    written = []
+
+    def batches():
+        for i in range(50):
+            created.append(i)
+            yield i
+
+    # number of batches created, but not written yet, at each write
+    ahead = []
+
+    def write_batch(batch):
+        written.append(batch)
+        ahead.append(len(created) - len(written))
+
+    writer.run(write_batch, batches())
+
+    assert sorted(written) == list(range(50))
+    assert max(ahead) <= 2 * writer.num_workers
+
+
+def test_worker_errors_are_raised():
+
+    writer = BulkWriter(mongomock.MongoClient()['synister_test'], num_workers=2)
+
+    def write_batch(batch):
+        if batch == 7:
+            raise ValueError(batch)
+
+    with pytest.raises(ValueError):
+        writer.run(write_batch, iter(range(20)))
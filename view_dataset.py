@@ -1,8 +1,13 @@
 from funlib.show.neuroglancer import add_layer
+from synister_mongo import get_database
 import configargparse
 import daisy
-import json
+import hashlib
+import itertools
 import neuroglancer
+import numpy as np
+import os
+import precomputed_annotations
 
 parser = configargparse.ArgParser()
 parser.add(
@@ -15,8 +20,246 @@ parser.add(
     required=True)
 parser.add(
     '--synapse-dataset',
-    help="JSON file of synapses to show",
+    help="Consolidated synapse file (JSON or .npz) of synapses to show",
     required=True)
+parser.add(
+    '--annotation-dir',
+    help="Show synapses from a precomputed annotation source in this "
+         "directory (written from --synapse-dataset if it doesn't exist yet) "
+         "instead of the first 100 synapses")
+parser.add(
+    '--annotation-host',
+    help="Host name under which the viewer can reach the annotation server",
+    default='localhost')
+parser.add(
+    '--annotation-port',
+    help="Port to serve the precomputed annotation source on",
+    type=int,
+    default=9000)
+parser.add(
+    '--neurotransmitter',
+    help="Only select synapses with this neurotransmitter")
+parser.add(
+    '--split',
+    help="Only select synapses in this split partition (e.g., "
+         "'skeleton:test'), read from --db-name")
+parser.add(
+    '--credentials',
+    help="MongoDB credential file, for --split")
+parser.add(
+    '--db-name',
+    help="Synister database to read --split from")
+parser.add(
+    '--sample',
+    help="Select a random sample of this many synapses",
+    type=int)
+parser.add(
+    '--num-shown',
+    help="Number of selected synapses to show as local annotations",
+    type=int,
+    default=100)
+parser.add(
+    '--roi-from-synapses',
+    help="Only show raw data around the selected synapses",
+    action='store_true')
+parser.add(
+    '--roi-context',
+    help="Context (in nm) to add around the selected synapses",
+    type=int,
+    default=1000)
+parser.add(
+    '--downsample-levels',
+    help="Number of downsampled levels to generate for the raw data",
+    type=int,
+    default=0)
+parser.add(
+    '--pyramid-cache',
+    help="Zarr container to store downsampled raw data in",
+    default='raw_pyramid.zarr')
+
+
+def select_synapses(options):
+    """Positions (zyx, in nm) of the selected synapses."""
+
+    if options.split is not None:
+        split_name, partition = options.split.split(':')
+        query = {f'splits.{split_name}': partition}
+        if options.neurotransmitter is not None:
+            query['neurotransmitter'] = options.neurotransmitter
+        synapses = get_database(options.credentials, options.db_name)[
+            'synapses'].find(query, {'_id': False, 'z': True, 'y': True, 'x': True})
+        positions = np.array(
+            [[s['z'], s['y'], s['x']] for s in synapses],
+            dtype=np.float64).reshape(-1, 3)
+    else:
+        columns = precomputed_annotations.load_columns(options.synapse_dataset)
+        positions = np.stack(
+            [np.asarray(columns[d], dtype=np.float64) for d in ['z', 'y', 'x']],
+            axis=1)
+        if options.neurotransmitter is not None:
+            selected = np.asarray(
+                columns['neurotransmitter'], dtype=object) == \
+                options.neurotransmitter
+            positions = positions[selected]
+
+    if options.sample is not None and options.sample < len(positions):
+        random = np.random.RandomState(1912)
+        positions = positions[np.sort(random.choice(
+            len(positions),
+            options.sample,
+            replace=False))]
+
+    # an empty selection has no ROI, and nothing to show
+    if len(positions) == 0:
+        source = options.db_name if options.split is not None \
+            else options.synapse_dataset
+        filters = [
+            f"--{name} {getattr(options, name)}"
+            for name in ['neurotransmitter', 'split', 'sample']
+            if getattr(options, name) is not None
+        ]
+        parser.error(
+            f"no synapses selected from {source}" +
+            (f" with {' '.join(filters)}" if filters else ""))
+
+    print(f"Selected {len(positions)} synapses")
+    return positions
+
+
+def synapse_roi(raw, positions, context):
+
+    begin = np.floor(positions.min(axis=0)).astype(int) - context
+    end = np.floor(positions.max(axis=0)).astype(int) + 1 + context
+    roi = daisy.Roi(
+        daisy.Coordinate(begin.tolist()),
+        daisy.Coordinate((end - begin).tolist()))
+    roi = roi.snap_to_grid(raw.voxel_size, mode='grow').intersect(raw.roi)
+    # a view, nothing is read here
+    return raw[roi]
+
+
+def downsample_factor(voxel_size):
+
+    # downsample the finer axes first, all axes once isotropic
+    if len(set(voxel_size)) == 1:
+        return daisy.Coordinate((2,) * len(voxel_size))
+    return daisy.Coordinate(
+        2 if v < max(voxel_size) else 1
+        for v in voxel_size)
+
+
+def channel_shape(array):
+
+    # leading non-spatial axes (e.g., color channels)
+    return array.data.shape[:len(array.data.shape) - len(array.voxel_size)]
+
+
+def cache_name(container, dataset):
+
+    # the same dataset name in different containers is different data
+    path = os.path.abspath(container)
+    digest = hashlib.sha1(path.encode()).hexdigest()[:8]
+    name = os.path.basename(os.path.normpath(path))
+    return f'{name}-{digest}/{dataset}'
+
+
+def build_pyramid(raw, num_levels, cache_container, name):
+    """Downsampled versions of ``raw``, restricted to ``raw.roi``. Levels are
+    stored in ``cache_container`` under ``name`` (see ``cache_name``) and
+    reused if they cover ``raw.roi``."""
+
+    channels = channel_shape(raw)
+    if len(channels) > 1:
+        raise ValueError(
+            f"Can not downsample data with more than one channel axis "
+            f"(shape {raw.data.shape})")
+
+    levels = [raw]
+    for level in range(1, num_levels + 1):
+
+        previous = levels[-1]
+        voxel_size = previous.voxel_size * downsample_factor(
+            previous.voxel_size)
+        roi = previous.roi.snap_to_grid(voxel_size, mode='shrink')
+        dataset = f'{name}/s{level}'
+
+        if os.path.exists(os.path.join(cache_container, dataset)):
+            cached = daisy.open_ds(cache_container, dataset)
+            if (
+                    cached.voxel_size == voxel_size and
+                    cached.roi.contains(roi) and
+                    channel_shape(cached) == channels):
+                print(f"Using cached {dataset} in {cache_container}")
+                levels.append(cached[roi])
+                continue
+
+        print(f"Downsampling {roi} to voxel size {voxel_size}...")
+        array = daisy.prepare_ds(
+            cache_container,
+            dataset,
+            roi,
+            voxel_size,
+            previous.dtype,
+            num_channels=channels[0] if channels else None,
+            delete=True)
+        downsample(previous, array)
+        levels.append(array)
+
+    return levels
+
+
+def downsample(source, target, block_voxels=None):
+    """Downsample ``source`` into ``target`` by averaging, ``block_voxels``
+    (of ``target``) at a time. Leading channel axes are kept."""
+
+    dims = len(target.voxel_size)
+    if block_voxels is None:
+        block_voxels = (64, 256, 256)[-dims:] if dims <= 3 else (64,) * dims
+
+    factor = target.voxel_size / source.voxel_size
+    block_size = target.voxel_size * daisy.Coordinate(block_voxels)
+    channels = channel_shape(source)
+    # the factor axes of the reshaped data
+    axes = tuple(len(channels) + 2 * d + 1 for d in range(dims))
+
+    for offset in itertools.product(*[
+            range(b, e, s)
+            for b, e, s in zip(
+                target.roi.get_begin(),
+                target.roi.get_end(),
+                block_size)]):
+
+        block = daisy.Roi(offset, block_size).intersect(target.roi)
+        data = source.to_ndarray(block)
+        shape = block.get_shape() / target.voxel_size
+        data = data.reshape(channels + sum(
+            ((s, f) for s, f in zip(shape, factor)),
+            ())).mean(axis=axes)
+        target[block] = data.astype(target.dtype)
+
+
+def serve_precomputed(options):
+
+    # rewrite the annotations if they were written from a different synapse
+    # file (or an older version of it)
+    source = precomputed_annotations.source_description(
+        options.synapse_dataset)
+    if not precomputed_annotations.is_current(options.annotation_dir, source):
+        precomputed_annotations.write_annotations(
+            precomputed_annotations.load_columns(options.synapse_dataset),
+            options.annotation_dir,
+            source=source)
+
+    precomputed_annotations.serve(
+        options.annotation_dir,
+        options.annotation_port)
+    source = (
+        f'precomputed://http://{options.annotation_host}:'
+        f'{options.annotation_port}')
+    print(f"Serving synapse annotations at {source}")
+
+    return neuroglancer.AnnotationLayer(source=source)
+
 
 if __name__ == '__main__':
 
@@ -27,36 +270,50 @@ if __name__ == '__main__':
         options.raw_dataset)
     print(f"Found raw data in roi {raw.roi}, voxel size {raw.voxel_size}")
 
-    with open(options.synapse_dataset, 'r') as f:
-        synapses = json.load(f)
-    synapse_annotations = [
-        neuroglancer.PointAnnotation(
-            id=i,
-            point=[
-                synapses[i]['z'],
-                synapses[i]['y'],
-                synapses[i]['x']
-            ])
-        for i in range(100)
-    ]
-    print(f"Showing {len(synapse_annotations)} synapses in neuroglancer")
-    print("Positions (zyx, in nm) of first 10 synapses:")
-    for i in range(10):
-        print(list(synapses[i][k] for k in ['z', 'y', 'x']))
+    # the precomputed source streams all synapses, no selection needed
+    if options.annotation_dir is None or options.roi_from_synapses:
+        positions = select_synapses(options)
+
+    if options.roi_from_synapses:
+        raw = synapse_roi(raw, positions, options.roi_context)
+        print(f"Restricted raw data to roi {raw.roi}")
+
+    if options.downsample_levels > 0:
+        raw = build_pyramid(
+            raw,
+            options.downsample_levels,
+            options.pyramid_cache,
+            cache_name(options.raw_container, options.raw_dataset))
+
+    if options.annotation_dir is not None:
+        synapse_layer = serve_precomputed(options)
+    else:
+        shown = positions[:options.num_shown]
+        synapse_annotations = [
+            neuroglancer.PointAnnotation(id=i, point=position.tolist())
+            for i, position in enumerate(shown)
+        ]
+        print(f"Showing {len(synapse_annotations)} synapses in neuroglancer")
+        print("Positions (zyx, in nm) of first 10 synapses:")
+        for position in shown[:10]:
+            print(position.tolist())
 
-    neuroglancer.set_server_bind_address('0.0.0.0')
-    viewer = neuroglancer.Viewer()
-    with viewer.txn() as s:
-        add_layer(s, raw, 'raw')
         dimensions = neuroglancer.CoordinateSpace(
             names=['z', 'y', 'x'],
             units='nm',
             scales=(1, 1, 1))
+        synapse_layer = neuroglancer.LocalAnnotationLayer(
+            dimensions=dimensions,
+            annotations=synapse_annotations)
+
+    neuroglancer.set_server_bind_address('0.0.0.0')
+    viewer = neuroglancer.Viewer()
+    with viewer.txn() as s:
+        # a list of arrays is shown as a multi-scale layer
+        add_layer(s, raw, 'raw')
         s.layers.append(
             name="synapses",
-            layer=neuroglancer.LocalAnnotationLayer(
-                dimensions=dimensions,
-                annotations=synapse_annotations))
+            layer=synapse_layer)
 
     print(viewer)
     input("Press ENTER to quit")